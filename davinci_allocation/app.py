@@ -1,11 +1,14 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
 import os
 from dotenv import load_dotenv
-from app.models import Allocation
+from app.models import Allocation, AllocationStatus
 from app.data_processor import DataProcessor
-from app.teacher_matcher import TeacherMatcher
+from app.teacher_matcher_algorithm import TeacherMatcher
 from app.email_service import EmailService
 from app.crimson_api import CrimsonAPI
+from app.crimson_api_async import AsyncCrimsonAPI
+from app.job_queue import JobQueue
+from app.jobs import AllocationJobs
 
 # grab our env vars
 load_dotenv()
@@ -15,24 +18,71 @@ app.secret_key = os.getenv('SECRET_KEY', 'dev_key_for_testing')
 
 # setup all our services
 data_processor = DataProcessor()
-teacher_matcher = TeacherMatcher()
 email_service = EmailService()
 crimson_api = CrimsonAPI(
     api_key=os.getenv('CRIMSON_APP_API_KEY', 'test_key')
 )
+# everything shares crimson_api's response cache, so when an invitation
+# drops a teacher's cached workload nobody else keeps serving the old one
+teacher_matcher = TeacherMatcher(crimson_api=crimson_api)
+# for fanning lots of calls out at once (e.g. invitations)
+async_crimson_api = AsyncCrimsonAPI(crimson_api)
+
+# matching, invitations + emails run in the background off this queue
+job_queue = JobQueue(os.getenv('JOB_QUEUE_PATH', os.path.join(data_processor.data_dir, 'jobs.db')))
+AllocationJobs(job_queue, data_processor, teacher_matcher, crimson_api,
+               async_crimson_api, email_service)
+job_queue.start()
+
+# dashboard sections -> (status, how they're sorted unless ?sort= says otherwise)
+DASHBOARD_SECTIONS = {
+    'pending': (AllocationStatus.PENDING, 'date_created'),
+    'in_progress': (AllocationStatus.IN_PROGRESS, 'date_created'),
+    'completed': (AllocationStatus.COMPLETED, '-date_completed')
+}
 
 @app.route('/')
 def dashboard():
-    """main page showing what allocations we've got"""
-    pending_allocations = data_processor.get_pending_allocations()
-    in_progress_allocations = data_processor.get_in_progress_allocations()
-    completed_allocations = data_processor.get_completed_allocations()
+    """
+    main page showing what allocations we've got
+    one page of each section at a time (?pending=<cursor> etc move them on)
+    so it stays quick however many completed ones pile up
+    """
+    page_size = int(os.getenv('DASHBOARD_PAGE_SIZE', 25))
+    search = request.args.get('q', '').strip()
+    sort = request.args.get('sort', '')
+    
+    pages = {}
+    for section, (status, default_sort) in DASHBOARD_SECTIONS.items():
+        try:
+            pages[section] = data_processor.list_allocations(
+                status=status, limit=page_size, sort=sort or default_sort,
+                search=search, cursor=request.args.get(section))
+        except ValueError as e:
+            flash(str(e), 'danger')
+            pages[section] = data_processor.list_allocations(
+                status=status, limit=page_size, sort=default_sort, search=search)
+        
+        # links that move just this section on (or back to its first page)
+        args = request.args.to_dict()
+        args.pop(section, None)
+        next_cursor = pages[section]['next_cursor']
+        pages[section]['next_url'] = (url_for('dashboard', **args, **{section: next_cursor})
+                                      if next_cursor else None)
+        pages[section]['first_url'] = (url_for('dashboard', **args)
+                                       if request.args.get(section) else None)
+    
+    # badge counts come from the running totals, not from loading everything
+    stats = data_processor.get_statistics()
     
     return render_template(
         'dashboard.html',
-        pending=pending_allocations,
-        in_progress=in_progress_allocations,
-        completed=completed_allocations
+        pending=pages['pending'],
+        in_progress=pages['in_progress'],
+        completed=pages['completed'],
+        counts=stats,
+        search=search,
+        sort=sort
     )
 
 @app.route('/allocation/<allocation_id>', methods=['GET'])
@@ -43,7 +93,20 @@ def view_allocation(allocation_id):
         flash('Allocation not found', 'error')
         return redirect(url_for('dashboard'))
     
-    return render_template('allocation_details.html', allocation=allocation)
+    # we only keep ids + scores - fill in everything else in one call
+    teacher_ids = [teacher['id'] for teacher in allocation.matching_teachers]
+    teacher_info = crimson_api.get_teachers_info(teacher_ids)
+    matching_teachers = [
+        dict(teacher_info[teacher['id']], score=teacher.get('score'))
+        for teacher in allocation.matching_teachers
+        if teacher_info.get(teacher['id'])  # skip anyone crimson doesn't know any more
+    ]
+    
+    # live workloads for the teachers on the page, in one call
+    workloads = crimson_api.get_teachers_workload(teacher_ids)
+    
+    return render_template('allocation_details.html', allocation=allocation,
+                           matching_teachers=matching_teachers, workloads=workloads)
 
 @app.route('/allocation/<allocation_id>/start', methods=['POST'])
 def start_allocation(allocation_id):
@@ -70,14 +133,19 @@ def match_teachers(allocation_id):
         flash('Allocation not found', 'error')
         return redirect(url_for('dashboard'))
     
-    # run our matching algo
-    matching_teachers = teacher_matcher.find_matching_teachers(allocation)
+    # the matcher runs in the background - the page polls the job
+    job_id = job_queue.enqueue('match', {'allocation_id': allocation_id})
     
-    # save the results
-    data_processor.update_matching_teachers(allocation_id, matching_teachers)
+    flash('Teacher matching started', 'info')
+    return redirect(url_for('view_allocation', allocation_id=allocation_id, job=job_id))
+
+@app.route('/allocations/plan', methods=['POST'])
+def plan_allocations():
+    """match every in-progress allocation that hasn't invited anyone yet, all together"""
+    job_queue.enqueue('plan')
     
-    flash('Teacher matching completed', 'success')
-    return redirect(url_for('view_allocation', allocation_id=allocation_id))
+    flash('Planning teachers for all in-progress allocations in the background', 'info')
+    return redirect(url_for('dashboard'))
 
 @app.route('/allocation/<allocation_id>/invite', methods=['POST'])
 def send_invitations(allocation_id):
@@ -92,14 +160,12 @@ def send_invitations(allocation_id):
         flash('No teachers selected', 'error')
         return redirect(url_for('view_allocation', allocation_id=allocation_id))
     
-    # send out the invites via crimson
-    for teacher_id in selected_teacher_ids:
-        success = crimson_api.send_teacher_invitation(allocation, teacher_id)
-        if success:
-            data_processor.add_invited_teacher(allocation_id, teacher_id)
+    # the invites go out (all at once) in the background
+    job_id = job_queue.enqueue('invite', {'allocation_id': allocation_id,
+                                          'teacher_ids': selected_teacher_ids})
     
-    flash('Invitations sent to teachers', 'success')
-    return redirect(url_for('view_allocation', allocation_id=allocation_id))
+    flash('Sending invitations to teachers', 'info')
+    return redirect(url_for('view_allocation', allocation_id=allocation_id, job=job_id))
 
 @app.route('/allocation/<allocation_id>/confirm', methods=['POST'])
 def confirm_teacher(allocation_id):
@@ -114,17 +180,10 @@ def confirm_teacher(allocation_id):
         flash('No teacher specified', 'error')
         return redirect(url_for('view_allocation', allocation_id=allocation_id))
     
-    # save the teacher's info
-    teacher_info = crimson_api.get_teacher_info(teacher_id)
-    data_processor.confirm_teacher(allocation_id, teacher_info)
-    
-    # send out the emails
-    email_service.send_confirmation_email(allocation, teacher_info)
-    
-    # mark it as done
-    data_processor.mark_as_completed(allocation_id)
+    # saving the teacher + the emails happen in the background
+    job_queue.enqueue('confirm', {'allocation_id': allocation_id, 'teacher_id': teacher_id})
     
-    flash('Teacher confirmed and emails sent', 'success')
+    flash('Teacher confirmed - emails are on their way', 'success')
     return redirect(url_for('dashboard'))
 
 @app.route('/sync', methods=['POST'])
@@ -140,5 +199,18 @@ def statistics():
     stats = data_processor.get_statistics()
     return render_template('statistics.html', stats=stats)
 
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    """how a background job is getting on, for pages to poll"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/analytics')
+def analytics():
+    """time-to-start/complete percentiles as json, for digging into what's slow"""
+    return jsonify(data_processor.get_analytics())
+
 if __name__ == '__main__':
     app.run(debug=True) 
\ No newline at end of file
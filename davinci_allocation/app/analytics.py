@@ -0,0 +1,220 @@
+import math
+import os
+
+# what we measure, in hours: created -> started, created -> completed
+METRICS = ('time_to_start', 'time_to_complete')
+QUANTILES = (0.5, 0.9, 0.99)
+
+class QuantileSketch:
+    """
+    a DDSketch - keeps a count per log-sized bucket instead of every value,
+    so quantiles come back within relative_accuracy (2% by default) of the
+    real answer no matter how many values went in
+    - values are clamped to [min_value, max_value] hours (1 minute .. ~10
+      years), which caps the number of buckets at a few hundred
+    - counts are exact, so a value can be taken back out (weight=-1) and
+      two sketches can just be added together
+    """
+    def __init__(self, relative_accuracy=0.02, min_value=1 / 60, max_value=24 * 365 * 10,
+                 bins=None, zero_count=0):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = dict(bins or {})
+        self.zero_count = zero_count
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.bins.values())
+
+    def is_empty(self):
+        return not self.zero_count and not self.bins
+
+    def add(self, value, weight=1):
+        """count a value (negative weight takes one back out)"""
+        if value < self.min_value:
+            # anything under a minute counts as "straight away"
+            self.zero_count += weight
+            return
+
+        index = math.ceil(math.log(min(value, self.max_value)) / self._log_gamma)
+        self._add_to_bin(index, weight)
+
+    def merge(self, other):
+        """add another sketch's counts onto this one (same accuracy settings)"""
+        self.zero_count += other.zero_count
+        for index, count in other.bins.items():
+            self._add_to_bin(index, count)
+
+    def _add_to_bin(self, index, count):
+        count += self.bins.get(index, 0)
+        if count:
+            self.bins[index] = count
+        else:
+            self.bins.pop(index, None)
+
+    def quantile(self, q):
+        """roughly the value q of the way through (0.5 = median) - None if empty"""
+        total = self.count
+        if total <= 0:
+            return None
+
+        rank = q * (total - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                # the middle of the bucket, so we're never more than
+                # relative_accuracy away from anything that landed in it
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def summary(self):
+        """{'count', 'p50', 'p90', 'p99'} in hours"""
+        result = {'count': self.count}
+        for q in QUANTILES:
+            value = self.quantile(q)
+            result[f"p{round(q * 100)}"] = round(value, 2) if value is not None else None
+        return result
+
+    def to_dict(self):
+        # json object keys have to be strings
+        return {'zero_count': self.zero_count,
+                'bins': {str(index): count for index, count in self.bins.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(bins={int(index): count for index, count in data['bins'].items()},
+                   zero_count=data['zero_count'])
+
+class AllocationAnalytics:
+    """
+    p50/p90/p99 of how long allocations wait to be started and to be
+    completed - overall, per subject, per staff member and per week
+    one QuantileSketch for each, and only the last max_weeks weeks are kept
+    (ANALYTICS_MAX_WEEKS, default 26), so this stays the same size however
+    much history there is
+    like StatisticsAggregates it's all plain sums, so it's kept up to date
+    with count(old, -1) / count(new, +1) and merge()
+    """
+    GROUPS = ('subject', 'staff_member', 'week')
+
+    def __init__(self, sketches=None, max_weeks=None):
+        self.max_weeks = max_weeks or int(os.getenv('ANALYTICS_MAX_WEEKS', 26))
+        # metric -> {'overall': sketch, group -> {key: sketch}}
+        self.sketches = sketches or {
+            metric: {'overall': QuantileSketch(), **{group: {} for group in self.GROUPS}}
+            for metric in METRICS
+        }
+
+    def is_empty(self):
+        return all(groups['overall'].is_empty() and not any(groups[group] for group in self.GROUPS)
+                   for groups in self.sketches.values())
+
+    def count(self, allocation, sign=1):
+        """add an allocation's timings in (sign=-1 takes them back out)"""
+        for metric, hours, when in _timings(allocation):
+            self._add(metric, 'overall', None, hours, sign)
+            for subject in _subjects(allocation):
+                self._add(metric, 'subject', subject, hours, sign)
+            if allocation.staff_member:
+                self._add(metric, 'staff_member', allocation.staff_member, hours, sign)
+            # bucketed by the week it was started / completed in
+            year, week, _ = when.isocalendar()
+            self._add(metric, 'week', f"{year}-W{week:02d}", hours, sign)
+        self._trim_weeks()
+
+    def _add(self, metric, group, key, hours, sign):
+        sketches = self.sketches[metric]
+        if group == 'overall':
+            sketches['overall'].add(hours, sign)
+            return
+        sketch = sketches[group].setdefault(key, QuantileSketch())
+        sketch.add(hours, sign)
+        if sketch.is_empty():
+            del sketches[group][key]
+
+    def merge(self, other):
+        """add another set of sketches (e.g. one transaction's changes) onto these"""
+        for metric, groups in other.sketches.items():
+            mine = self.sketches[metric]
+            mine['overall'].merge(groups['overall'])
+            for group in self.GROUPS:
+                for key, sketch in groups[group].items():
+                    merged = mine[group].setdefault(key, QuantileSketch())
+                    merged.merge(sketch)
+                    if merged.is_empty():
+                        del mine[group][key]
+        self._trim_weeks()
+
+    def _trim_weeks(self):
+        """forget all but the newest max_weeks weeks ("2024-W03" sorts by date)"""
+        for groups in self.sketches.values():
+            weeks = groups['week']
+            for week in sorted(weeks)[:-self.max_weeks]:
+                del weeks[week]
+
+    def summary(self):
+        """
+        {metric: {'overall': {...}, 'subject': {name: {...}}, ...}} where
+        each {...} is {'count', 'p50', 'p90', 'p99'} in hours
+        """
+        return {
+            metric: {
+                'overall': groups['overall'].summary(),
+                **{group: {key: groups[group][key].summary() for key in sorted(groups[group])}
+                   for group in self.GROUPS}
+            }
+            for metric, groups in self.sketches.items()
+        }
+
+    def to_dict(self):
+        return {
+            metric: {
+                'overall': groups['overall'].to_dict(),
+                **{group: {key: sketch.to_dict() for key, sketch in groups[group].items()}
+                   for group in self.GROUPS}
+            }
+            for metric, groups in self.sketches.items()
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls({
+            metric: {
+                'overall': QuantileSketch.from_dict(data[metric]['overall']),
+                **{group: {key: QuantileSketch.from_dict(sketch)
+                           for key, sketch in data[metric][group].items()}
+                   for group in cls.GROUPS}
+            }
+            for metric in METRICS
+        })
+
+def _timings(allocation):
+    """
+    (metric, hours, when it happened) for the steps this allocation has got
+    through. split-off kids get the parent's start date but a newer created
+    date, so anything that comes out negative is skipped
+    """
+    if not allocation.date_created:
+        return []
+
+    timings = []
+    if allocation.date_started:
+        hours = (allocation.date_started - allocation.date_created).total_seconds() / 3600
+        if hours >= 0:
+            timings.append(('time_to_start', hours, allocation.date_started))
+    if allocation.date_completed:
+        hours = (allocation.date_completed - allocation.date_created).total_seconds() / 3600
+        if hours >= 0:
+            timings.append(('time_to_complete', hours, allocation.date_completed))
+    return timings
+
+def _subjects(allocation):
+    if allocation.current_subject:
+        return [allocation.current_subject]
+    return list(dict.fromkeys(allocation.subjects))
@@ -0,0 +1,96 @@
+import time
+import threading
+from collections import OrderedDict
+
+class CacheEntry:
+    """one cached response + when it stops being fresh"""
+    __slots__ = ('value', 'etag', 'expires_at')
+
+    def __init__(self, value, etag, expires_at):
+        self.value = value
+        self.etag = etag
+        self.expires_at = expires_at
+
+class TTLCache:
+    """
+    in-memory response cache for the crimson api
+    - every entry has its own time-to-live
+    - holds at most max_entries, least recently used gets dropped first
+    - expired entries hang around (until evicted) so they can be
+      revalidated with their ETag instead of downloaded again
+    anything with the same lookup/store/touch/invalidate/stats methods can
+    be handed to CrimsonAPI instead (e.g. something backed by redis)
+    """
+    def __init__(self, max_entries=1024, clock=time.monotonic):
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """
+        returns (entry, fresh) - entry is None if we've got nothing at all
+        counts a hit only for fresh entries
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, False
+
+            self._entries.move_to_end(key)
+            fresh = entry.expires_at > self._clock()
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry, fresh
+
+    def store(self, key, value, ttl, etag=None):
+        """cache a value for ttl seconds"""
+        with self._lock:
+            self._entries[key] = CacheEntry(value, etag, self._clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def touch(self, key, ttl):
+        """the server said our copy is still good (304) - make it fresh again"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.expires_at = self._clock() + ttl
+                self.revalidated += 1
+
+    def invalidate(self, key):
+        """forget one entry"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_endpoint(self, endpoint):
+        """forget every entry for one endpoint (keys are (endpoint, ...))"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == endpoint]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """hit/miss counters so we can see how much load we're saving"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'revalidated': self.revalidated,
+                'evictions': self.evictions,
+                'entries': len(self._entries)
+            }
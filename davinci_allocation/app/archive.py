@@ -0,0 +1,120 @@
+import os
+import uuid
+from types import SimpleNamespace
+from . import codec
+from .models import Allocation, AllocationStatus
+from .statistics import StatisticsAggregates
+
+# the columns the stats need - read on their own, without the rest of the record
+STATISTICS_COLUMNS = ['id', 'status', 'subjects', 'current_subject', 'staff_member',
+                      'date_created', 'date_started', 'date_completed']
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("the completed allocation archive needs pyarrow (pip install pyarrow)")
+    return pyarrow
+
+class AllocationArchive:
+    """
+    long-finished allocations, moved out of the main store into parquet
+    files - one folder per month they were completed in:
+        data/archive/month=2024-01/<random>.parquet
+    each row has the columns the stats use (status, subjects, dates...)
+    pulled out + typed, so those can be read without touching anything
+    else, and the full record as json in `record` for get()
+    nothing in here ever changes - archiving just adds another file
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _dataset(self):
+        """the whole archive as one pyarrow dataset (None if it's empty)"""
+        if not os.path.isdir(self.path):
+            return None
+        pa = _pyarrow()
+        dataset = pa.dataset.dataset(self.path, format='parquet', partitioning='hive')
+        return dataset if dataset.files else None
+
+    def add(self, allocations):
+        """write these (completed) allocations into their month's folder"""
+        pa = _pyarrow()
+        by_month = {}
+        for allocation in allocations:
+            by_month.setdefault(allocation.date_completed.strftime('%Y-%m'), []).append(allocation)
+
+        for month, month_allocations in by_month.items():
+            folder = os.path.join(self.path, f"month={month}")
+            os.makedirs(folder, exist_ok=True)
+            table = self._table(pa, month_allocations)
+            # written under a temp name first so readers never see half a file
+            path = os.path.join(folder, f"{uuid.uuid4().hex}.parquet")
+            tmp_path = os.path.join(folder, f".{uuid.uuid4().hex}.tmp")
+            pa.parquet.write_table(table, tmp_path)
+            os.replace(tmp_path, path)
+
+    def _table(self, pa, allocations):
+        text = pa.string()
+        when = pa.timestamp('us')
+        return pa.table({
+            'id': pa.array([a.id for a in allocations], text),
+            'status': pa.array([a.status.value for a in allocations], text),
+            'student_name': pa.array([a.student_name for a in allocations], text),
+            'subjects': pa.array([list(a.subjects) for a in allocations], pa.list_(text)),
+            'current_subject': pa.array([a.current_subject for a in allocations], text),
+            'staff_member': pa.array([a.staff_member for a in allocations], text),
+            'date_created': pa.array([a.date_created for a in allocations], when),
+            'date_started': pa.array([a.date_started for a in allocations], when),
+            'date_completed': pa.array([a.date_completed for a in allocations], when),
+            'record': pa.array([codec.dumps(a.to_dict()).decode('utf-8') for a in allocations], text)
+        })
+
+    def get(self, allocation_id):
+        """
+        find one archived allocation by id (or None)
+        only the id column gets scanned - plus the parquet min/max stats let
+        whole row groups be skipped
+        """
+        dataset = self._dataset()
+        if dataset is None:
+            return None
+
+        pa = _pyarrow()
+        table = dataset.to_table(columns=['record'],
+                                 filter=pa.dataset.field('id') == allocation_id)
+        if not table.num_rows:
+            return None
+        return Allocation.from_dict(codec.loads(table.column('record')[0].as_py()))
+
+    def load_all(self):
+        """every archived allocation (slow - reads every full record)"""
+        dataset = self._dataset()
+        if dataset is None:
+            return []
+        return [Allocation.from_dict(codec.loads(record))
+                for record in dataset.to_table(columns=['record']).column('record').to_pylist()]
+
+    def statistics(self, skip_ids=()):
+        """
+        StatisticsAggregates for everything in the archive, from just the
+        columns they need. skip_ids = allocations to leave out (ones that
+        are still in the main store, e.g. after a crash mid-archive)
+        """
+        aggregates = StatisticsAggregates()
+        dataset = self._dataset()
+        if dataset is None:
+            return aggregates
+
+        columns = dataset.to_table(columns=STATISTICS_COLUMNS).to_pydict()
+        seen = set(skip_ids)
+        for row in zip(*(columns[name] for name in STATISTICS_COLUMNS)):
+            values = dict(zip(STATISTICS_COLUMNS, row))
+            if values['id'] in seen:
+                continue
+            seen.add(values['id'])
+            values['status'] = AllocationStatus(values['status'])
+            aggregates.count(SimpleNamespace(**values))
+        return aggregates
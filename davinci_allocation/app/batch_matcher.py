@@ -0,0 +1,167 @@
+import os
+import numpy as np
+from .schedule import BITMAP_WORDS, popcount, student_bitmap, teacher_bitmap
+
+# cost for pairs that can't happen (teacher doesn't teach the subject) -
+# anything's better than that, even leaving the allocation unassigned
+INFEASIBLE = 1e9
+
+def _workload_points(student_counts):
+    """the workload part of the matcher score, for an array of student counts"""
+    return np.select(
+        [student_counts > 30, student_counts > 20, student_counts < 10],
+        [-20, -10, 10], default=0)
+
+def teacher_capacity(workload):
+    """
+    how many more students a teacher can take, from their workload's
+    available_capacity (hours) / HOURS_PER_STUDENT (default 1.5)
+    """
+    if not workload:
+        return 0
+    hours_per_student = float(os.getenv('HOURS_PER_STUDENT', 1.5))
+    return max(0, int(workload.get('available_capacity', 0) // hours_per_student))
+
+def _compatibility_matrix(student_bitmaps, teacher_bitmaps, chunk_rows=64, dtype=float):
+    """
+    schedule compatibility for every (student, teacher) pair, same rules as
+    schedule.bitmap_compatibility - done a few students at a time so the
+    (students x teachers x words) AND doesn't get huge
+    """
+    student_slots = popcount(student_bitmaps)
+    teacher_slots = popcount(teacher_bitmaps)
+    matrix = np.empty((len(student_bitmaps), len(teacher_bitmaps)), dtype=dtype)
+
+    for start in range(0, len(student_bitmaps), chunk_rows):
+        chunk = student_bitmaps[start:start + chunk_rows]
+        overlap = popcount(chunk[:, None, :] & teacher_bitmaps[None, :, :])
+        slots = student_slots[start:start + chunk_rows, None]
+        matrix[start:start + chunk_rows] = overlap / np.maximum(slots, 1)
+
+    matrix[student_slots == 0, :] = 0.5
+    matrix[:, teacher_slots == 0] = 0.5
+    return matrix
+
+def _replica_counts(teaches, capacities):
+    """
+    how many columns (copies) each teacher gets: no more than their capacity,
+    or the allocations they could take at all, or BATCH_REPLICA_HEADROOM
+    (default 2) x their fair share - each allocation split between the
+    teachers who could take it in proportion to the room they've got (so
+    a full teacher takes no share, and a roomy one isn't held to an even
+    split with nearly full ones). the fair share cap is what keeps the
+    matrix small when a few subjects have lots of roomy teachers
+    """
+    headroom = float(os.getenv('BATCH_REPLICA_HEADROOM', 2))
+    eligible = teaches.sum(axis=0)
+    room = np.minimum(capacities, eligible)
+    weights = teaches * room[None, :]
+    takers_room = np.maximum(weights.sum(axis=1, keepdims=True), 1)
+    fair_share = (weights / takers_room).sum(axis=0)
+    return np.minimum.reduce([room, np.ceil(fair_share * headroom).astype(int)])
+
+def plan_assignments(allocations, teachers, capacities, teacher_bitmaps=None,
+                     chunk_rows=256):
+    """
+    assign each allocation at most one teacher so the total match score is
+    as high as possible, without giving any teacher more new students than
+    capacities[teacher_id]
+    - every teacher gets one column per student they can still take (up to
+      a cap, see _replica_counts), and the k-th extra student is scored as
+      if they already had k more (so the busier they get the less
+      attractive they are)
+    - solved as one assignment problem with scipy's linear_sum_assignment,
+      or greedily (best pair first) if scipy isn't installed
+    - the cost matrix is float32 and filled in chunk_rows rows at a time,
+      so the only full-size array is the cost matrix itself
+    returns {allocation_id: {'id': teacher_id, 'score': score}} - allocations
+    nobody could take are left out
+    """
+    if not allocations or not teachers:
+        return {}
+
+    # which teachers can take which allocation (they teach the subject)
+    subjects = [allocation.current_subject or (allocation.subjects or [None])[0]
+                for allocation in allocations]
+    teaches = np.array([[subject in teacher.get('subjects', []) for teacher in teachers]
+                        for subject in subjects], dtype=bool)
+
+    # teacher columns
+    student_counts = np.array([teacher.get('active_students', 0) for teacher in teachers], dtype=float)
+    expertise_points = np.array([(teacher.get('subject_expertise', 3) - 3) * 5
+                                 for teacher in teachers], dtype=float)
+    rating_points = np.array([(teacher.get('average_rating', 4.0) - 4.0) * 10
+                              for teacher in teachers], dtype=float)
+    replicas = _replica_counts(
+        teaches, np.array([capacities.get(teacher['id'], 0) for teacher in teachers]))
+
+    column_teacher = np.repeat(np.arange(len(teachers)), replicas)
+    # 0, 1, 2... within each teacher's copies = how many extra students they'd have
+    column_extra = np.arange(len(column_teacher)) - np.repeat(np.cumsum(replicas) - replicas, replicas)
+    column_base = (100 + _workload_points(student_counts[column_teacher] + column_extra)
+                   + expertise_points[column_teacher])
+
+    # score for every (allocation, teacher copy), added up the way the matcher does
+    if teacher_bitmaps is None:
+        teacher_bitmaps = np.stack([teacher_bitmap(teacher.get('availability'))
+                                    for teacher in teachers])
+    teacher_bitmaps = np.asarray(teacher_bitmaps, dtype=np.uint64).reshape(-1, BITMAP_WORDS)
+    student_bitmaps = np.stack([student_bitmap(allocation.student_availability)
+                                for allocation in allocations])
+    compatibility = _compatibility_matrix(student_bitmaps, teacher_bitmaps, dtype=np.float32)
+    column_points = (column_base + rating_points[column_teacher]).astype(np.float32)
+
+    # allocations no teacher can take don't need a row at all
+    rows = np.flatnonzero(teaches[:, column_teacher].any(axis=1) if len(column_teacher)
+                          else np.zeros(len(allocations), dtype=bool))
+    columns = len(column_teacher)
+    # -score for every (allocation, teacher copy), plus one "nobody" column
+    # per row (cost 0) so every row has a way out
+    cost = np.zeros((len(rows), columns + len(rows)), dtype=np.float32)
+    for start in range(0, len(rows), chunk_rows):
+        chunk = rows[start:start + chunk_rows]
+        block = cost[start:start + chunk_rows, :columns]
+        block[:] = compatibility[chunk][:, column_teacher]
+        block *= -20
+        block -= column_points
+        block[~teaches[chunk][:, column_teacher]] = INFEASIBLE
+    del compatibility
+
+    plan = {}
+    for row, column in _solve(cost):
+        if column < columns and cost[row, column] < INFEASIBLE:
+            allocation = rows[row]
+            teacher = column_teacher[column]
+            # scored again in float64, same sum as the matcher
+            compatibility = _compatibility_matrix(student_bitmaps[allocation:allocation + 1],
+                                                  teacher_bitmaps[teacher:teacher + 1])[0, 0]
+            score = column_base[column] + compatibility * 20 + rating_points[teacher]
+            plan[allocations[allocation].id] = {
+                'id': teachers[teacher]['id'],
+                'score': round(score.item(), 2)
+            }
+    return plan
+
+def _solve(cost):
+    """min cost assignment of rows to columns -> [(row, column)]"""
+    try:
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        return _solve_greedy(cost)
+
+    row_ids, column_ids = linear_sum_assignment(cost)
+    return list(zip(row_ids.tolist(), column_ids.tolist()))
+
+def _solve_greedy(cost):
+    """no scipy - take the cheapest pairs first (good, just not always optimal)"""
+    taken_rows = set()
+    taken_columns = set()
+    pairs = []
+    for flat in np.argsort(cost, axis=None, kind='stable').tolist():
+        row, column = divmod(flat, cost.shape[1])
+        if row in taken_rows or column in taken_columns or cost[row, column] >= 0:
+            continue
+        taken_rows.add(row)
+        taken_columns.add(column)
+        pairs.append((row, column))
+    return pairs
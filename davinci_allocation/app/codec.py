@@ -0,0 +1,42 @@
+# json encoding/decoding for the allocation store
+# uses orjson or msgspec if one of them is installed (both are a lot faster
+# than the stdlib json module), otherwise falls back to plain json
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson is not None:
+    BACKEND = 'orjson'
+    DecodeError = ValueError
+elif msgspec is not None:
+    BACKEND = 'msgspec'
+    DecodeError = (ValueError, msgspec.DecodeError)
+    _encoder = msgspec.json.Encoder()
+    _decoder = msgspec.json.Decoder()
+else:
+    BACKEND = 'json'
+    DecodeError = ValueError
+
+def dumps(data):
+    """encode to compact json bytes"""
+    if BACKEND == 'orjson':
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    if BACKEND == 'msgspec':
+        return _encoder.encode(data)
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+def loads(data):
+    """decode json from bytes or str"""
+    if BACKEND == 'orjson':
+        return orjson.loads(data)
+    if BACKEND == 'msgspec':
+        return _decoder.decode(data)
+    return json.loads(data)
@@ -1,27 +1,90 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import os
-from datetime import datetime, timedelta
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import random
+from .api_cache import TTLCache
+from .teacher_catalogue import get_catalogue
+
+# statuses worth trying again - rate limited or the server having a moment
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# the only ones where we know a POST wasn't acted on, so it's safe to resend
+POST_RETRY_STATUSES = {429, 503}
+
+# how a request failed when there's no response to look at - decides
+# whether it's safe to send again (see CrimsonAPI._should_retry)
+CONNECT_FAILED = 'connect'  # never reached the server, so it can't have acted
+TRANSPORT_FAILED = 'transport'  # broke after connecting - it may have gone through
+
+# upstream says it doesn't have a bulk endpoint (or won't take our ids
+# list, e.g. 414 url too long) - use per-id calls instead from then on
+BULK_UNSUPPORTED_STATUSES = {400, 404, 405, 414, 501}
+
+# how long (seconds) a cached answer from each read endpoint stays fresh
+DEFAULT_CACHE_TTLS = {
+    'teacher_info': 300,
+    'teacher_workload': 30,
+    'available_teachers': 60
+}
 
 class CrimsonAPI:
     """
     connects to the crimson app for getting student/teacher data
     and doing teacher assignments
     """
-    def __init__(self, api_key=None, base_url=None):
+    def __init__(self, api_key=None, base_url=None, timeout=None, max_retries=None,
+                 backoff_factor=None, max_backoff=None, pool_size=None,
+                 cache=None, cache_ttls=None, bulk_chunk_size=None):
         self.api_key = api_key or os.getenv('CRIMSON_APP_API_KEY', 'test_key')
         self.base_url = base_url or os.getenv('CRIMSON_APP_API_URL', 'https://api.crimsonapp.example.com')
         
         # if testing, use the fake mock API instead of real one
         self.use_mock = (self.api_key == 'test_key')
         
+        # (connect, read) timeouts in seconds - nothing waits forever
+        self.timeout = timeout or (
+            float(os.getenv('CRIMSON_APP_CONNECT_TIMEOUT', 3.05)),
+            float(os.getenv('CRIMSON_APP_READ_TIMEOUT', 10))
+        )
+        # retries back off exponentially (with jitter) from backoff_factor
+        # seconds, and never wait longer than max_backoff between tries
+        self.max_retries = max_retries if max_retries is not None else int(
+            os.getenv('CRIMSON_APP_MAX_RETRIES', 3))
+        self.backoff_factor = backoff_factor if backoff_factor is not None else float(
+            os.getenv('CRIMSON_APP_BACKOFF_FACTOR', 0.5))
+        self.max_backoff = max_backoff if max_backoff is not None else float(
+            os.getenv('CRIMSON_APP_MAX_BACKOFF', 10))
+        
+        # one keep-alive session for every call, so we're not doing a fresh
+        # TCP + TLS handshake each time
+        self.pool_size = pool_size or int(os.getenv('CRIMSON_APP_POOL_SIZE', 10))
+        self.session = self._create_session(self.pool_size)
+        
+        # cache for the read endpoints - CRIMSON_APP_CACHE_SIZE=0 turns it off
+        if cache is None:
+            cache_size = int(os.getenv('CRIMSON_APP_CACHE_SIZE', 1024))
+            cache = TTLCache(max_entries=cache_size) if cache_size > 0 else None
+        self.cache = cache
+        self.cache_ttls = dict(DEFAULT_CACHE_TTLS, **(cache_ttls or {}))
+        # endpoint -> False once we know the bulk version isn't there
+        self._bulk_supported = {}
+        # ids per bulk call, so the ?ids= url stays well under server limits
+        self.bulk_chunk_size = bulk_chunk_size or int(
+            os.getenv('CRIMSON_APP_BULK_CHUNK_SIZE', 100))
+        
         # need a place to store our fake data
         if self.use_mock and not os.path.exists('data'):
             os.makedirs('data')
             
             # create some teachers etc
             self._initialize_mock_data()
+        
+        # the fake teachers, loaded once + indexed by id and subject
+        self.teacher_catalogue = get_catalogue('data/mock_teachers.json')
     
     def get_student_info(self, student_id):
         """grab basic info about a student"""
@@ -29,10 +92,7 @@ class CrimsonAPI:
             return self._mock_get_student_info(student_id)
             
         url = f"{self.base_url}/students/{student_id}"
-        headers = self._get_headers()
-        
-        response = requests.get(url, headers=headers)
-        return self._handle_response(response)
+        return self._request('GET', url)
     
     def add_subject(self, student_id, subject_info):
         """add a new subject to a student's list"""
@@ -40,10 +100,7 @@ class CrimsonAPI:
             return self._mock_add_subject(student_id, subject_info)
             
         url = f"{self.base_url}/students/{student_id}/subjects"
-        headers = self._get_headers()
-        
-        response = requests.post(url, headers=headers, json=subject_info)
-        return self._handle_response(response)
+        return self._request('POST', url, json=subject_info)
     
     def get_available_teachers(self, subject):
         """find teachers who can teach this subject"""
@@ -51,11 +108,9 @@ class CrimsonAPI:
             return self._mock_get_available_teachers(subject)
             
         url = f"{self.base_url}/teachers/available"
-        headers = self._get_headers()
         params = {'subject': subject}
         
-        response = requests.get(url, headers=headers, params=params)
-        return self._handle_response(response)
+        return self._cached_get('available_teachers', subject, url, params=params)
     
     def send_teacher_invitation(self, allocation, teacher_id):
         """invite a teacher to take on this student"""
@@ -63,9 +118,15 @@ class CrimsonAPI:
             return self._mock_send_teacher_invitation(allocation, teacher_id)
             
         url = f"{self.base_url}/invitations"
-        headers = self._get_headers()
-        
-        invitation_data = {
+        result = self._request('POST', url, json=self._invitation_data(allocation, teacher_id))
+        if result:
+            # they've (maybe) got another student now
+            self._invalidate_teacher(teacher_id)
+        return result
+    
+    def _invitation_data(self, allocation, teacher_id):
+        """what we post to /invitations for one teacher"""
+        return {
             'teacher_id': teacher_id,
             'student_id': allocation.student_id,
             'subject': allocation.current_subject or allocation.subjects[0],
@@ -77,9 +138,6 @@ class CrimsonAPI:
                                f"Holiday Schedule: {allocation.holiday_schedule}\n"
                                f"Notes: {allocation.additional_notes}"
         }
-        
-        response = requests.post(url, headers=headers, json=invitation_data)
-        return self._handle_response(response)
     
     def get_teacher_info(self, teacher_id):
         """get details about a specific teacher"""
@@ -87,10 +145,7 @@ class CrimsonAPI:
             return self._mock_get_teacher_info(teacher_id)
             
         url = f"{self.base_url}/teachers/{teacher_id}"
-        headers = self._get_headers()
-        
-        response = requests.get(url, headers=headers)
-        return self._handle_response(response)
+        return self._cached_get('teacher_info', teacher_id, url)
     
     def get_teacher_workload(self, teacher_id):
         """check how many students a teacher has, hours, etc"""
@@ -98,11 +153,228 @@ class CrimsonAPI:
             return self._mock_get_teacher_workload(teacher_id)
             
         url = f"{self.base_url}/teachers/{teacher_id}/workload"
-        headers = self._get_headers()
+        return self._cached_get('teacher_workload', teacher_id, url)
+    
+    def get_teachers_info(self, teacher_ids):
+        """details for a bunch of teachers at once -> {teacher_id: info (or None)}"""
+        if self.use_mock:
+            return {teacher_id: self._mock_get_teacher_info(teacher_id)
+                    for teacher_id in dict.fromkeys(teacher_ids)}
         
-        response = requests.get(url, headers=headers)
+        return self._get_many('teacher_info', teacher_ids, f"{self.base_url}/teachers/bulk",
+                              lambda teacher_id: f"{self.base_url}/teachers/{teacher_id}")
+    
+    def get_teachers_workload(self, teacher_ids):
+        """workloads for a bunch of teachers at once -> {teacher_id: workload (or None)}"""
+        if self.use_mock:
+            return {teacher_id: self._mock_get_teacher_workload(teacher_id)
+                    for teacher_id in dict.fromkeys(teacher_ids)}
+        
+        return self._get_many('teacher_workload', teacher_ids,
+                              f"{self.base_url}/teachers/bulk/workload",
+                              lambda teacher_id: f"{self.base_url}/teachers/{teacher_id}/workload")
+    
+    def _create_session(self, pool_size):
+        """a requests session with a connection pool big enough for pool_size threads"""
+        session = requests.Session()
+        # we do our own retries (see _request), so the adapter shouldn't
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update(self._get_headers())
+        return session
+    
+    def cache_stats(self):
+        """hit/miss numbers for the response cache (None if it's off)"""
+        return self.cache.stats() if self.cache else None
+    
+    def _cached_get(self, endpoint, key, url, params=None):
+        """
+        GET through the response cache
+        fresh entry -> no request at all. stale entry with an ETag -> ask the
+        server with If-None-Match and keep our copy if it says 304
+        """
+        if not self.cache:
+            return self._request('GET', url, params=params)
+        
+        entry, fresh = self.cache.lookup((endpoint, key))
+        if fresh:
+            return entry.value
+        return self._fetch(endpoint, key, entry, url, params)
+    
+    def _fetch(self, endpoint, key, entry, url, params=None):
+        """
+        go to the server for something the cache didn't have fresh
+        (entry = the stale copy, if any, so we can send its ETag)
+        """
+        headers = {'If-None-Match': entry.etag} if entry and entry.etag else None
+        response = self._send('GET', url, params=params, headers=headers)
+        return self._cache_response(endpoint, key, entry, response)
+    
+    def _cache_response(self, endpoint, key, entry, response):
+        """turn a (maybe 304) response into data + remember it"""
+        if response is None:
+            return None
+        
+        if response.status_code == 304 and entry:
+            self.cache.touch((endpoint, key), self.cache_ttls[endpoint])
+            return entry.value
+        
+        result = self._handle_response(response)
+        if result is not None and self.cache:
+            self.cache.store((endpoint, key), result, self.cache_ttls[endpoint],
+                             etag=response.headers.get('ETag'))
+        return result
+    
+    def _get_many(self, endpoint, keys, bulk_url, url_for):
+        """
+        look up lots of keys on one endpoint
+        1. whatever's fresh in the cache
+        2. the rest from the bulk endpoint (GET bulk_url?ids=a,b,c), at most
+           bulk_chunk_size ids per call
+        3. if there's no bulk endpoint (or it failed), one call per key,
+           all at once over the connection pool
+        """
+        keys = list(dict.fromkeys(keys))
+        results, stale = self._cached_many(endpoint, keys)
+        missing = [key for key in keys if key not in results]
+        
+        for chunk in self._bulk_chunks(endpoint, missing):
+            response = self._send('GET', bulk_url, params={'ids': ','.join(chunk)})
+            results.update(self._bulk_results(endpoint, chunk, response))
+        missing = [key for key in keys if key not in results]
+        
+        if missing:
+            workers = min(self.pool_size, len(missing))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                fetched = executor.map(
+                    lambda key: self._fetch(endpoint, key, stale.get(key), url_for(key)),
+                    missing)
+                results.update(zip(missing, fetched))
+        
+        return {key: results[key] for key in keys}
+    
+    def _bulk_chunks(self, endpoint, keys):
+        """
+        keys in bulk_chunk_size lists - stops handing them out as soon as
+        the endpoint turns out not to support bulk calls
+        """
+        for start in range(0, len(keys), self.bulk_chunk_size):
+            if not self._bulk_supported.get(endpoint, True):
+                return
+            yield keys[start:start + self.bulk_chunk_size]
+    
+    def _cached_many(self, endpoint, keys):
+        """split keys into fresh cached values + stale entries worth revalidating"""
+        results = {}
+        stale = {}
+        if not self.cache:
+            return results, stale
+        
+        for key in keys:
+            entry, fresh = self.cache.lookup((endpoint, key))
+            if fresh:
+                results[key] = entry.value
+            elif entry:
+                stale[key] = entry
+        return results, stale
+    
+    def _bulk_results(self, endpoint, keys, response):
+        """
+        unpack a bulk response ({id: data}) + cache each piece
+        gives back {} when the bulk call didn't work, so everything falls back
+        """
+        if response is None:
+            return {}
+        if response.status_code in BULK_UNSUPPORTED_STATUSES:
+            self._bulk_supported[endpoint] = False
+            return {}
+        
+        data = self._handle_response(response)
+        if response.status_code in (200, 201, 204) and not isinstance(data, dict):
+            # answered, just not with {id: data} - not a bulk endpoint we can use
+            self._bulk_supported[endpoint] = False
+        if not isinstance(data, dict):
+            return {}
+        
+        results = {key: data.get(key) for key in keys}
+        if self.cache:
+            for key, value in results.items():
+                if value is not None:
+                    self.cache.store((endpoint, key), value, self.cache_ttls[endpoint])
+        return results
+    
+    def _invalidate_teacher(self, teacher_id):
+        """drop anything cached that includes this teacher's workload"""
+        if not self.cache:
+            return
+        self.cache.invalidate(('teacher_workload', teacher_id))
+        self.cache.invalidate(('teacher_info', teacher_id))
+        # the available lists carry active_students too
+        self.cache.invalidate_endpoint('available_teachers')
+    
+    def _request(self, method, url, **kwargs):
+        """send a request and turn the response into data (None if it failed)"""
+        response = self._send(method, url, **kwargs)
+        if response is None:
+            return None
         return self._handle_response(response)
     
+    def _send(self, method, url, **kwargs):
+        """send a request through our session with timeouts + retries (see _should_retry)"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except requests.RequestException as e:
+                if not self._should_retry(method, attempt, failure=_failure_of(e)):
+                    print(f"API Error: {method} {url} failed - {e}")
+                    return None
+                time.sleep(self._backoff_delay(attempt))
+                continue
+            
+            if not self._should_retry(method, attempt, status=response.status_code):
+                return response
+            time.sleep(self._retry_delay(response, attempt))
+    
+    def _should_retry(self, method, attempt, status=None, failure=None):
+        """
+        whether to send a request again after this try - AsyncCrimsonAPI
+        uses it too, so both clients always follow the same rules
+        GETs are retried on connection errors, timeouts, 429 and 5xx.
+        POSTs only when we know the server didn't act on them (couldn't
+        connect, 429, 503) so we don't send the same invitation twice
+        status = what the response said, or failure = CONNECT_FAILED /
+        TRANSPORT_FAILED / None (not worth retrying) if there wasn't one
+        """
+        if attempt >= self.max_retries:
+            return False
+        is_post = method.upper() == 'POST'
+        if status is not None:
+            return status in (POST_RETRY_STATUSES if is_post else RETRY_STATUSES)
+        return failure == CONNECT_FAILED or (failure == TRANSPORT_FAILED and not is_post)
+    
+    def _backoff_delay(self, attempt):
+        """exponential backoff with full jitter - spreads retries out"""
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * (2 ** attempt)))
+    
+    def _retry_delay(self, response, attempt):
+        """how long to wait before retrying - Retry-After if the server told us"""
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    retry_at = parsedate_to_datetime(retry_after)
+                    delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                # still capped, so one bad header can't stall a request for ages
+                return min(self.max_backoff, max(0.0, delay))
+        
+        return self._backoff_delay(attempt)
+    
     def _get_headers(self):
         """setup auth headers for API calls"""
         return {
@@ -204,15 +476,8 @@ class CrimsonAPI:
     
     def _mock_get_available_teachers(self, subject):
         """fake version of get_available_teachers"""
-        teachers = self._get_mock_data('mock_teachers.json')
-        
-        # find teachers who know this subject
-        available_teachers = []
-        for teacher in teachers:
-            if subject in teacher['subjects']:
-                available_teachers.append(teacher)
-        
-        return available_teachers
+        # straight out of the subject index
+        return self.teacher_catalogue.for_subject(subject)
     
     def _mock_send_teacher_invitation(self, allocation, teacher_id):
         """fake version of send_teacher_invitation"""
@@ -221,25 +486,25 @@ class CrimsonAPI:
     
     def _mock_get_teacher_info(self, teacher_id):
         """fake version of get_teacher_info"""
-        teachers = self._get_mock_data('mock_teachers.json')
-        
-        for teacher in teachers:
-            if teacher['id'] == teacher_id:
-                return teacher
-        
-        return None
+        return self.teacher_catalogue.get(teacher_id)
     
     def _mock_get_teacher_workload(self, teacher_id):
         """fake version of get_teacher_workload"""
-        teachers = self._get_mock_data('mock_teachers.json')
-        
-        for teacher in teachers:
-            if teacher['id'] == teacher_id:
-                # make up some workload numbers
-                return {
-                    'active_students': teacher['active_students'],
-                    'hours_per_week': round(teacher['active_students'] * 1.5, 1),
-                    'available_capacity': max(0, 50 - teacher['active_students'] * 1.5)
-                }
+        teacher = self.teacher_catalogue.get(teacher_id)
+        if not teacher:
+            return None
         
-        return None 
\ No newline at end of file
+        # make up some workload numbers
+        return {
+            'active_students': teacher['active_students'],
+            'hours_per_week': round(teacher['active_students'] * 1.5, 1),
+            'available_capacity': max(0, 50 - teacher['active_students'] * 1.5)
+        } 
+
+def _failure_of(error):
+    """what kind of failure a requests exception is (see CrimsonAPI._should_retry)"""
+    if isinstance(error, requests.ConnectTimeout):
+        return CONNECT_FAILED
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return TRANSPORT_FAILED
+    return None
@@ -0,0 +1,236 @@
+import asyncio
+import os
+import threading
+import httpx
+from .crimson_api import CrimsonAPI, CONNECT_FAILED, TRANSPORT_FAILED
+
+class AsyncCrimsonAPI:
+    """
+    asyncio version of the crimson client, for when we need lots of calls at
+    once (e.g. inviting 20 teachers) - they all go out together instead of
+    one after the other
+    - wraps a CrimsonAPI (hand in the app's one, or it makes its own from
+      the same arguments) and uses its settings, retry rules, response
+      cache + mock data, so only the sending itself is different
+    - at most max_concurrency requests in flight at a time
+    - every api method is a coroutine. from normal (flask) code hand them to
+      run(), which keeps one event loop + connection pool going in the
+      background so connections get reused between requests
+    """
+    def __init__(self, sync_api=None, max_concurrency=None, **kwargs):
+        self.sync_api = sync_api or CrimsonAPI(**kwargs)
+        self.max_concurrency = max_concurrency or int(
+            os.getenv('CRIMSON_APP_MAX_CONCURRENCY', 10))
+        self._client = None
+        self._semaphore = None
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    @property
+    def use_mock(self):
+        return self.sync_api.use_mock
+
+    @property
+    def base_url(self):
+        return self.sync_api.base_url
+
+    def cache_stats(self):
+        """hit/miss numbers for the (shared) response cache"""
+        return self.sync_api.cache_stats()
+
+    def run(self, coroutine):
+        """run one of our coroutines from sync code and wait for the answer"""
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def close(self):
+        """shut the connection pool + background loop down"""
+        if self._loop is None:
+            return
+        self.run(self.aclose())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    # the mock answers come straight from the sync client - nothing to wait on
+
+    async def get_student_info(self, student_id):
+        """grab basic info about a student"""
+        if self.use_mock:
+            return self.sync_api.get_student_info(student_id)
+
+        return await self._request('GET', f"{self.base_url}/students/{student_id}")
+
+    async def add_subject(self, student_id, subject_info):
+        """add a new subject to a student's list"""
+        if self.use_mock:
+            return self.sync_api.add_subject(student_id, subject_info)
+
+        return await self._request('POST', f"{self.base_url}/students/{student_id}/subjects",
+                                   json=subject_info)
+
+    async def get_available_teachers(self, subject):
+        """find teachers who can teach this subject"""
+        if self.use_mock:
+            return self.sync_api.get_available_teachers(subject)
+
+        url = f"{self.base_url}/teachers/available"
+        return await self._cached_get('available_teachers', subject, url,
+                                      params={'subject': subject})
+
+    async def get_teacher_info(self, teacher_id):
+        """get details about a specific teacher"""
+        if self.use_mock:
+            return self.sync_api.get_teacher_info(teacher_id)
+
+        url = f"{self.base_url}/teachers/{teacher_id}"
+        return await self._cached_get('teacher_info', teacher_id, url)
+
+    async def get_teacher_workload(self, teacher_id):
+        """check how many students a teacher has, hours, etc"""
+        if self.use_mock:
+            return self.sync_api.get_teacher_workload(teacher_id)
+
+        url = f"{self.base_url}/teachers/{teacher_id}/workload"
+        return await self._cached_get('teacher_workload', teacher_id, url)
+
+    async def get_teachers_info(self, teacher_ids):
+        """details for a bunch of teachers at once -> {teacher_id: info (or None)}"""
+        if self.use_mock:
+            return self.sync_api.get_teachers_info(teacher_ids)
+
+        return await self._get_many('teacher_info', teacher_ids, f"{self.base_url}/teachers/bulk",
+                                    lambda teacher_id: f"{self.base_url}/teachers/{teacher_id}")
+
+    async def get_teachers_workload(self, teacher_ids):
+        """workloads for a bunch of teachers at once -> {teacher_id: workload (or None)}"""
+        if self.use_mock:
+            return self.sync_api.get_teachers_workload(teacher_ids)
+
+        return await self._get_many('teacher_workload', teacher_ids,
+                                    f"{self.base_url}/teachers/bulk/workload",
+                                    lambda teacher_id: f"{self.base_url}/teachers/{teacher_id}/workload")
+
+    async def send_teacher_invitation(self, allocation, teacher_id):
+        """invite a teacher to take on this student"""
+        if self.use_mock:
+            return self.sync_api.send_teacher_invitation(allocation, teacher_id)
+
+        url = f"{self.base_url}/invitations"
+        result = await self._request('POST', url,
+                                     json=self.sync_api._invitation_data(allocation, teacher_id))
+        if result:
+            # they've (maybe) got another student now
+            self.sync_api._invalidate_teacher(teacher_id)
+        return result
+
+    async def send_teacher_invitations(self, allocation, teacher_ids):
+        """
+        invite a bunch of teachers at once
+        returns {teacher_id: result} - result is None/falsy for the ones that failed
+        """
+        teacher_ids = list(dict.fromkeys(teacher_ids))  # no double invites
+        results = await asyncio.gather(*(
+            self.send_teacher_invitation(allocation, teacher_id)
+            for teacher_id in teacher_ids))
+        return dict(zip(teacher_ids, results))
+
+    def _get_client(self):
+        """the shared async client (made on first use, inside the running loop)"""
+        if self._client is None:
+            connect_timeout, read_timeout = self.sync_api.timeout
+            self._client = httpx.AsyncClient(
+                headers=self.sync_api._get_headers(),
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency)
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def _cached_get(self, endpoint, key, url, params=None):
+        """same as CrimsonAPI._cached_get, but async"""
+        cache = self.sync_api.cache
+        if not cache:
+            return await self._request('GET', url, params=params)
+
+        entry, fresh = cache.lookup((endpoint, key))
+        if fresh:
+            return entry.value
+        return await self._fetch(endpoint, key, entry, url, params)
+
+    async def _fetch(self, endpoint, key, entry, url, params=None):
+        headers = {'If-None-Match': entry.etag} if entry and entry.etag else None
+        response = await self._send('GET', url, params=params, headers=headers)
+        return self.sync_api._cache_response(endpoint, key, entry, response)
+
+    async def _get_many(self, endpoint, keys, bulk_url, url_for):
+        """same as CrimsonAPI._get_many, with the per-key fallback done via gather"""
+        api = self.sync_api
+        keys = list(dict.fromkeys(keys))
+        results, stale = api._cached_many(endpoint, keys)
+        missing = [key for key in keys if key not in results]
+
+        for chunk in api._bulk_chunks(endpoint, missing):
+            response = await self._send('GET', bulk_url, params={'ids': ','.join(chunk)})
+            results.update(api._bulk_results(endpoint, chunk, response))
+        missing = [key for key in keys if key not in results]
+
+        if missing:
+            fetched = await asyncio.gather(*(
+                self._fetch(endpoint, key, stale.get(key), url_for(key))
+                for key in missing))
+            results.update(zip(missing, fetched))
+
+        return {key: results[key] for key in keys}
+
+    async def _request(self, method, url, **kwargs):
+        """send a request and turn the response into data (None if it failed)"""
+        response = await self._send(method, url, **kwargs)
+        if response is None:
+            return None
+        return self.sync_api._handle_response(response)
+
+    async def _send(self, method, url, **kwargs):
+        """
+        send a request with the sync client's retry rules + backoff (its
+        _should_retry), holding a semaphore slot per try
+        """
+        api = self.sync_api
+        client = self._get_client()
+
+        for attempt in range(api.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    response = await client.request(method, url, **kwargs)
+            except httpx.HTTPError as e:
+                if not api._should_retry(method, attempt, failure=_failure_of(e)):
+                    print(f"API Error: {method} {url} failed - {e!r}")
+                    return None
+                await asyncio.sleep(api._backoff_delay(attempt))
+                continue
+
+            if not api._should_retry(method, attempt, status=response.status_code):
+                return response
+            await asyncio.sleep(api._retry_delay(response, attempt))
+
+def _failure_of(error):
+    """what kind of failure an httpx exception is (see CrimsonAPI._should_retry)"""
+    if isinstance(error, httpx.ConnectTimeout):
+        return CONNECT_FAILED
+    if isinstance(error, httpx.TransportError):
+        return TRANSPORT_FAILED
+    return None
@@ -1,87 +1,215 @@
 import os
-import json
+import base64
+import hashlib
+import itertools
+import threading
 import pandas as pd
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from .models import Allocation, AllocationStatus
+from . import codec
+from .archive import AllocationArchive
+from .job_forms import JOB_FORM_COLUMNS, read_job_forms
+from .repository import SORT_FIELDS, sort_key
+from .statistics import StatisticsAggregates
+from .storage import create_storage, atomic_write_json
 
 class DataProcessor:
     """
     deals with spreadsheet data & manages where we store all the allocation info
     """
-    def __init__(self, data_dir='data'):
+    def __init__(self, data_dir='data', storage=None):
         self.data_dir = data_dir
         self.allocations_file = os.path.join(data_dir, 'allocations.json')
+        self.sync_state_file = os.path.join(data_dir, 'sync_state.json')
+        self.statistics_file = os.path.join(data_dir, 'statistics.json')
         
         # make sure we have somewhere to save stuff
         if not os.path.exists(data_dir):
             os.makedirs(data_dir)
         
-        # create empty json file if needed
-        if not os.path.exists(self.allocations_file):
-            with open(self.allocations_file, 'w') as f:
-                json.dump([], f)
+        # json file by default, or whatever backend we got handed / configured
+        self.storage = storage or create_storage(data_dir)
+        # long-completed allocations get moved out to here (see archive_completed)
+        self.archive = AllocationArchive(os.path.join(data_dir, 'archive'))
+        # per thread: how the stats move in the transaction we're inside of
+        self._local = threading.local()
+    
+    @contextmanager
+    def transaction(self):
+        """
+        locked read-modify-write on the allocation store:
+            with data_processor.transaction() as repo:
+                ...
+        everything changed on repo is saved (atomically) when the block ends
+        anything that changes a status, the subjects or the dates should
+        also go through _count_change so the stats totals stay right
+        """
+        if getattr(self._local, 'statistics_delta', None) is not None:
+            # nested - the outer transaction saves the stats
+            with self.storage.transaction() as repo:
+                yield repo
+            return
+        
+        with self.storage.transaction() as repo:
+            self._local.statistics_delta = delta = StatisticsAggregates()
+            try:
+                yield repo
+            finally:
+                self._local.statistics_delta = None
+            # only once the changes are saved - but still holding the write
+            # lock, so nobody else can be updating the totals file meanwhile
+            if delta:
+                self.storage.after_commit(lambda: self._apply_statistics(repo, delta))
+    
+    def _count_change(self, allocation, sign):
+        """
+        note an allocation going into (+1) or out of (-1) the stats totals -
+        call with -1 before changing it and +1 after
+        """
+        self._local.statistics_delta.count(allocation, sign)
     
     def _load_allocations(self):
-        """grab everything from our json file"""
-        with open(self.allocations_file, 'r') as f:
-            allocations_data = json.load(f)
-        
-        return [Allocation.from_dict(data) for data in allocations_data]
+        """grab everything from storage"""
+        return self.storage.load_all()
     
     def _save_allocations(self, allocations):
-        """dump everything to json"""
-        allocations_data = [allocation.to_dict() for allocation in allocations]
-        
-        with open(self.allocations_file, 'w') as f:
-            json.dump(allocations_data, f, indent=2)
+        """replace everything in storage with this list"""
+        with self.storage.transaction():
+            self.storage.save_all(allocations)
+            self.storage.after_commit(
+                lambda: self._write_statistics(self._count_everything(allocations)))
     
-    def sync_from_spreadsheet(self, file_path=None):
+    def sync_from_spreadsheet(self, file_path=None, full=False):
         """
-        pull in new data from the job form xlsx
+        pull in new data from the job form export (xlsx, csv, parquet or
+        jsonl - see read_job_forms)
+        we remember how far we got last time (a watermark per file), so an
+        unchanged file isn't even opened and a changed one only has the rows
+        added since then read. full=True ignores the watermark
         returns how many new ones we found
         """
         if file_path is None:
             file_path = os.getenv('JOB_FORM_SPREADSHEET', 'data/sample_job_forms.xlsx')
         
-        # get what we already have
-        allocations = self._load_allocations()
-        existing_emails = {a.student_email for a in allocations}
+        sync_state = self._load_sync_state()
+        key = os.path.abspath(file_path)
+        watermark = {} if full else sync_state.get(key, {})
         
-        # open the spreadsheet
-        df = pd.read_excel(file_path)
+        # same mtime + size as last time? nothing to do
+        stat = os.stat(file_path)
+        signature = [stat.st_mtime_ns, stat.st_size]
+        if watermark.get('signature') == signature:
+            return 0
         
-        # go through each new entry
-        new_count = 0
-        for index, row in df.iterrows():
-            # skip if we've already got this one
-            if row['student_email'] in existing_emails:
-                continue
-                
-            # make a new allocation from row data
-            allocation = Allocation(
-                student_name=row['student_name'],
-                student_email=row['student_email'],
-                guardian_email=row['guardian_email'],
-                request_email=row['request_email'],
-                subjects=self._parse_subjects(row['subjects']),
-                start_date=row['start_date'],
-                package_hours=row['package_hours'],
-                session_frequency=row['session_frequency'],
-                student_availability=row['student_availability'],
-                holiday_schedule=row['holiday_schedule'],
-                additional_notes=row['additional_notes']
-            )
-            
-            # add it to our list
-            allocations.append(allocation)
-            existing_emails.add(allocation.student_email)
-            new_count += 1
+        # touched but the contents are the same (e.g. re-saved) - still nothing
+        file_hash = self._hash_file(file_path)
+        if watermark.get('sha256') == file_hash:
+            watermark['signature'] = signature
+            self._save_sync_state(sync_state)
+            return 0
         
-        # save everything back
-        self._save_allocations(allocations)
+        chunks, rows_seen = self._read_new_rows(file_path, watermark)
+        last_email = watermark.get('last_email')
+        
+        # one transaction per chunk so we never hold the lock for the whole file
+        new_count = 0
+        for chunk in chunks:
+            with self.transaction() as repo:
+                new_count += self._import_rows(repo, chunk)
+            rows_seen += len(chunk)
+            if len(chunk):
+                last_email = chunk['student_email'].iloc[-1]
+        
+        sync_state[key] = {
+            'signature': signature,
+            'sha256': file_hash,
+            'rows': rows_seen,
+            'last_email': last_email if isinstance(last_email, str) else None
+        }
+        self._save_sync_state(sync_state)
         
         return new_count
     
+    def _read_new_rows(self, file_path, watermark):
+        """
+        chunks of just the rows after the watermark
+        returns (chunk generator, how many rows came before them)
+        we re-read the last row we saw too, to check nothing got inserted or
+        deleted above it - if it did, we look at the whole file again (the
+        email check stops anyone being imported twice)
+        """
+        rows_seen = watermark.get('rows', 0)
+        if rows_seen:
+            chunks = read_job_forms(file_path, skip_rows=rows_seen - 1)
+            first = next(chunks, None)
+            if (first is not None and len(first)
+                    and first['student_email'].iloc[0] == watermark.get('last_email')):
+                return itertools.chain([first.iloc[1:]], chunks), rows_seen
+            chunks.close()
+        
+        return read_job_forms(file_path), 0
+    
+    def _hash_file(self, file_path):
+        """sha256 of the file contents"""
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    def _load_sync_state(self):
+        """where each job form file got up to last time we synced it"""
+        if not os.path.exists(self.sync_state_file):
+            return {}
+        with open(self.sync_state_file, 'rb') as f:
+            return codec.loads(f.read())
+    
+    def _save_sync_state(self, sync_state):
+        atomic_write_json(self.sync_state_file, sync_state)
+    
+    def _import_rows(self, repo, df):
+        """add allocations for the rows whose student we don't have yet"""
+        # skip students we've already got + repeats further down the sheet
+        emails = df['student_email'].dropna().unique().tolist()
+        new_rows = df[~df['student_email'].isin(repo.existing_emails(emails))]
+        new_rows = new_rows.drop_duplicates(subset='student_email', keep='first')
+        if new_rows.empty:
+            return 0
+        
+        # pull each column out as a plain list once instead of a Series per row
+        subjects = self._parse_subjects_column(new_rows['subjects'])
+        columns = {name: new_rows[name].tolist()
+                   for name in JOB_FORM_COLUMNS if name != 'subjects'}
+        
+        new_allocations = [
+            Allocation(subjects=row_subjects,
+                       **{name: values[i] for name, values in columns.items()})
+            for i, row_subjects in enumerate(subjects)
+        ]
+        repo.add_many(new_allocations, event='create')
+        for allocation in new_allocations:
+            self._count_change(allocation, 1)
+        
+        return len(new_allocations)
+    
+    def _parse_subjects_column(self, subjects):
+        """
+        same as _parse_subjects but for a whole column at once with pandas
+        string ops - gives back a list of subject lists in the same order
+        """
+        subjects = subjects.reset_index(drop=True)
+        subjects = subjects.where(subjects.map(lambda value: isinstance(value, str)), '')
+        has_semicolon = subjects.str.contains(';', regex=False)
+        
+        # split on ; where there is one, otherwise on commas
+        parts = subjects.str.split(';').where(has_semicolon, subjects.str.split(','))
+        parts = parts.explode().dropna().str.strip()
+        parts = parts[parts != '']
+        
+        by_row = parts.groupby(level=0, sort=False).agg(list)
+        return [by_row.get(i) or [] for i in range(len(subjects))]
+    
     def _parse_subjects(self, subjects_str):
         """split up subjects from comma/semicolon list"""
         if not subjects_str or pd.isna(subjects_str):
@@ -94,72 +222,133 @@ class DataProcessor:
     
     def get_pending_allocations(self):
         """get all the ones waiting to be worked on"""
-        allocations = self._load_allocations()
-        return [a for a in allocations if a.status == AllocationStatus.PENDING]
+        return self.storage.find_by_status(AllocationStatus.PENDING)
     
     def get_in_progress_allocations(self):
         """get all the ones someone is actively working on"""
-        allocations = self._load_allocations()
-        return [a for a in allocations if a.status == AllocationStatus.IN_PROGRESS]
+        return self.storage.find_by_status(AllocationStatus.IN_PROGRESS)
     
     def get_completed_allocations(self):
-        """get all the finished ones"""
-        allocations = self._load_allocations()
-        return [a for a in allocations if a.status == AllocationStatus.COMPLETED]
+        """get all the finished ones (not the archived ones - see archive_completed)"""
+        return self.storage.find_by_status(AllocationStatus.COMPLETED)
+    
+    def list_allocations(self, status=None, limit=25, sort='date_created', search=None, cursor=None):
+        """
+        one page of allocations for the dashboard
+        - status: just this AllocationStatus (None = all of them)
+        - sort: one of SORT_FIELDS, with a leading '-' for newest/last first
+        - search: only ones whose student name or a subject contains this
+        - cursor: the next_cursor from the page before (None = first page)
+        pages are keyset based - the cursor remembers the last allocation's
+        sort key, not how many we've skipped - so page 50 is as quick as
+        page 1 and nothing gets skipped/repeated if allocations come and go
+        returns {'allocations': [...], 'next_cursor': str or None}
+        """
+        descending = sort.startswith('-')
+        field = sort.lstrip('-')
+        if field not in SORT_FIELDS:
+            raise ValueError(f"can't sort allocations by {sort!r}")
+        
+        allocations, more = self.storage.page(
+            status=status, sort=field, descending=descending,
+            after=self._decode_cursor(cursor), limit=limit, search=search or None)
+        
+        next_cursor = None
+        if more and allocations:
+            next_cursor = self._encode_cursor(sort_key(allocations[-1], field))
+        return {'allocations': allocations, 'next_cursor': next_cursor}
+    
+    def _encode_cursor(self, key):
+        return base64.urlsafe_b64encode(codec.dumps(list(key))).decode('ascii')
+    
+    def _decode_cursor(self, cursor):
+        """cursor -> sort key (None for no/garbled cursor, i.e. start at the top)"""
+        if not cursor:
+            return None
+        try:
+            value, allocation_id = codec.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            return (str(value), str(allocation_id))
+        except (ValueError, TypeError, codec.DecodeError) as e:
+            print(f"Ignoring bad page cursor {cursor!r}: {e!r}")
+            return None
     
     def get_allocation_by_id(self, allocation_id):
-        """find a specific allocation by ID"""
-        allocations = self._load_allocations()
-        for allocation in allocations:
-            if allocation.id == allocation_id:
-                return allocation
-        return None
+        """find a specific allocation by ID (archived ones too)"""
+        return self.storage.get(allocation_id) or self.archive.get(allocation_id)
+    
+    def archive_completed(self, days=None):
+        """
+        move allocations completed more than `days` ago (ARCHIVE_AFTER_DAYS,
+        default 90) out of the main store and into the parquet archive, so
+        the store everything else reads stays small
+        they still count in the stats + can still be looked up by id, they
+        just can't be changed any more
+        returns how many got moved
+        """
+        if days is None:
+            days = int(os.getenv('ARCHIVE_AFTER_DAYS', 90))
+        cutoff = datetime.now() - timedelta(days=days)
+        
+        with self.transaction() as repo:
+            old = [allocation for allocation in repo.by_status(AllocationStatus.COMPLETED)
+                   if allocation.date_completed and allocation.date_completed < cutoff]
+            if not old:
+                return 0
+            
+            # archive first - if that fails nothing has left the store yet
+            self.archive.add(old)
+            for allocation in old:
+                repo.remove(allocation.id, event='archive')
+        
+        return len(old)
     
     def mark_as_in_progress(self, allocation_id, staff_member):
         """somebody's started working on this one"""
-        allocations = self._load_allocations()
-        
-        for allocation in allocations:
-            if allocation.id == allocation_id:
-                allocation.status = AllocationStatus.IN_PROGRESS
-                allocation.staff_member = staff_member
-                allocation.date_started = datetime.now()
-                break
-        
-        self._save_allocations(allocations)
+        with self.transaction() as repo:
+            allocation = repo.get(allocation_id)
+            if not allocation:
+                return
+            
+            self._count_change(allocation, -1)
+            allocation.status = AllocationStatus.IN_PROGRESS
+            allocation.staff_member = staff_member
+            allocation.date_started = datetime.now()
+            
+            repo.update(allocation, fields=('status', 'staff_member', 'date_started'), event='status')
+            self._count_change(allocation, 1)
     
     def mark_as_completed(self, allocation_id):
         """mark it as done!"""
-        allocations = self._load_allocations()
-        
-        for allocation in allocations:
-            if allocation.id == allocation_id:
-                allocation.status = AllocationStatus.COMPLETED
-                allocation.date_completed = datetime.now()
-                break
-        
-        self._save_allocations(allocations)
+        with self.transaction() as repo:
+            allocation = repo.get(allocation_id)
+            if not allocation:
+                return
+            
+            self._count_change(allocation, -1)
+            allocation.status = AllocationStatus.COMPLETED
+            allocation.date_completed = datetime.now()
+            
+            repo.update(allocation, fields=('status', 'date_completed'), event='status')
+            self._count_change(allocation, 1)
     
     def split_subjects(self, allocation_id):
         """
         break a multi-subject req into separate ones for each subject
         returns the IDs of the new allocations we created
         """
-        allocations = self._load_allocations()
-        parent_allocation = None
-        
+        with self.transaction() as repo:
+            return self._split_subjects(repo, allocation_id)
+    
+    def _split_subjects(self, repo, allocation_id):
         # gotta find the main one first
-        for allocation in allocations:
-            if allocation.id == allocation_id:
-                parent_allocation = allocation
-                break
+        parent_allocation = repo.get(allocation_id)
         
         if not parent_allocation or len(parent_allocation.subjects) <= 1:
             # nothing to split or can't find it
             return []
         
         # make new allocations for each subject
-        child_ids = []
+        children = []
         for subject in parent_allocation.subjects:
             # copy most info from the parent
             child = Allocation(
@@ -185,15 +374,22 @@ class DataProcessor:
             child.current_subject = subject
             
             # add it to our records
-            allocations.append(child)
-            child_ids.append(child.id)
+            children.append(child)
         
         # update the parent to link to kids
+        self._count_change(parent_allocation, -1)
+        child_ids = [child.id for child in children]
         parent_allocation.child_allocation_ids = child_ids
         parent_allocation.status = AllocationStatus.COMPLETED  # parent's job is done
         
-        # save everything
-        self._save_allocations(allocations)
+        # save the parent + kids together
+        repo.update(parent_allocation, fields=('child_allocation_ids', 'status'), event='split')
+        for child in children:
+            repo.add(child, event='split')
+        
+        self._count_change(parent_allocation, 1)
+        for child in children:
+            self._count_change(child, 1)
         
         return child_ids
     
@@ -217,70 +413,119 @@ class DataProcessor:
         return '\n'.join(relevant_lines)
     
     def update_matching_teachers(self, allocation_id, matching_teachers):
-        """save a list of teachers that might work for this allocation"""
-        allocations = self._load_allocations()
-        
-        for allocation in allocations:
-            if allocation.id == allocation_id:
-                allocation.matching_teachers = matching_teachers
-                break
-        
-        self._save_allocations(allocations)
+        """
+        save a list of teachers that might work for this allocation
+        just their ids + scores - the rest comes from crimson when we need it
+        """
+        self.update_matching_teachers_many({allocation_id: matching_teachers})
+    
+    def update_matching_teachers_many(self, matches):
+        """save matching teachers for lots of allocations ({id: teachers}) in one write"""
+        with self.transaction() as repo:
+            for allocation_id, matching_teachers in matches.items():
+                allocation = repo.get(allocation_id)
+                if not allocation:
+                    continue
+                
+                allocation.matching_teachers = [
+                    {'id': teacher['id'], 'score': teacher.get('score')}
+                    for teacher in matching_teachers
+                ]
+                repo.update(allocation, fields=('matching_teachers',), event='match')
     
     def add_invited_teacher(self, allocation_id, teacher_id):
         """track that we invited a teacher"""
-        allocations = self._load_allocations()
-        
-        for allocation in allocations:
-            if allocation.id == allocation_id:
-                if teacher_id not in allocation.invited_teachers:
-                    allocation.invited_teachers.append(teacher_id)
-                break
-        
-        self._save_allocations(allocations)
+        self.add_invited_teachers(allocation_id, [teacher_id])
+    
+    def add_invited_teachers(self, allocation_id, teacher_ids):
+        """track a whole batch of invites in one write"""
+        with self.transaction() as repo:
+            allocation = repo.get(allocation_id)
+            if not allocation:
+                return
+            
+            new_ids = [teacher_id for teacher_id in dict.fromkeys(teacher_ids)
+                       if teacher_id not in allocation.invited_teachers]
+            if not new_ids:
+                return
+            
+            allocation.invited_teachers.extend(new_ids)
+            repo.update(allocation, fields=('invited_teachers',), event='invite')
     
     def confirm_teacher(self, allocation_id, teacher_info):
         """a teacher said yes! save their info"""
-        allocations = self._load_allocations()
-        
-        for allocation in allocations:
-            if allocation.id == allocation_id:
-                allocation.confirmed_teacher = teacher_info
-                break
-        
-        self._save_allocations(allocations)
+        with self.transaction() as repo:
+            allocation = repo.get(allocation_id)
+            if not allocation:
+                return
+            
+            allocation.confirmed_teacher = teacher_info
+            repo.update(allocation, fields=('confirmed_teacher',), event='confirm')
     
     def get_statistics(self):
-        """grab some stats about our allocations for the dashboard"""
-        allocations = self._load_allocations()
-        
-        # basic counts
-        total = len(allocations)
-        pending = sum(1 for a in allocations if a.status == AllocationStatus.PENDING)
-        in_progress = sum(1 for a in allocations if a.status == AllocationStatus.IN_PROGRESS)
-        completed = sum(1 for a in allocations if a.status == AllocationStatus.COMPLETED)
-        
-        # how long it takes to complete allocations
-        completion_times = []
-        for allocation in allocations:
-            if (allocation.status == AllocationStatus.COMPLETED and 
-                allocation.date_completed and allocation.date_created):
-                time_diff = allocation.date_completed - allocation.date_created
-                completion_times.append(time_diff.total_seconds() / 3600)  # in hrs
-        
-        avg_completion_time = sum(completion_times) / len(completion_times) if completion_times else 0
-        
-        # what subjects are popular
-        subjects_count = {}
-        for allocation in allocations:
-            for subject in allocation.subjects:
-                subjects_count[subject] = subjects_count.get(subject, 0) + 1
-        
-        return {
-            'total_allocations': total,
-            'pending_allocations': pending,
-            'in_progress_allocations': in_progress,
-            'completed_allocations': completed,
-            'avg_completion_time_hours': avg_completion_time,
-            'subjects_count': subjects_count
-        } 
\ No newline at end of file
+        """
+        grab some stats about our allocations for the dashboard
+        just reads the running totals (kept up to date by every change) -
+        only if they're missing do we go through all the allocations
+        """
+        aggregates = self._read_statistics()
+        if aggregates is None:
+            aggregates = self.rebuild_statistics()
+        return aggregates.summary()
+    
+    def get_analytics(self):
+        """
+        p50/p90/p99 time-to-start + time-to-complete (hours), overall and
+        per subject / staff member / week - see analytics.py
+        """
+        return self.get_statistics()['analytics']
+    
+    def rebuild_statistics(self):
+        """
+        work the stats totals out again from every allocation + save them
+        for fixing them up if they ever drift (e.g. someone edited the
+        allocation store by hand) - see rebuild_statistics.py
+        """
+        with self.storage.transaction() as repo:
+            aggregates = self._count_everything(repo.all())
+            self._write_statistics(aggregates)
+        return aggregates
+    
+    def _count_everything(self, allocations):
+        """stats totals for these allocations + the whole archive"""
+        aggregates = StatisticsAggregates.from_allocations(allocations)
+        aggregates.merge(self.archive.statistics(
+            skip_ids={allocation.id for allocation in allocations}))
+        return aggregates
+    
+    def _apply_statistics(self, repo, delta):
+        """add one (saved) transaction's changes onto the saved totals"""
+        aggregates = self._read_statistics()
+        if aggregates is None:
+            # nothing saved yet - repo already has the changes in it
+            aggregates = self._count_everything(repo.all())
+        else:
+            aggregates.merge(delta)
+        try:
+            self._write_statistics(aggregates)
+        except OSError as e:
+            # the changes are saved but the totals aren't - drop them so
+            # they're counted again from scratch next time
+            print(f"Error saving {self.statistics_file}, it'll be rebuilt: {e!r}")
+            if os.path.exists(self.statistics_file):
+                os.remove(self.statistics_file)
+    
+    def _read_statistics(self):
+        """the saved stats totals, or None if there aren't any (or they're broken)"""
+        if not os.path.exists(self.statistics_file):
+            return None
+        try:
+            with open(self.statistics_file, 'rb') as f:
+                return StatisticsAggregates.from_dict(codec.loads(f.read()))
+        except (codec.DecodeError, TypeError, KeyError) as e:
+            # KeyError = saved by an older version without everything in it
+            print(f"Error reading {self.statistics_file}, rebuilding it: {e!r}")
+            return None
+    
+    def _write_statistics(self, aggregates):
+        atomic_write_json(self.statistics_file, aggregates.to_dict())
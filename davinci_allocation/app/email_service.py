@@ -43,8 +43,8 @@ class EmailService:
         
         msg.attach(MIMEText(body, 'plain'))
         
-        # off it goes!
-        self._send_email(
+        # off it goes! (True if it did)
+        return self._send_email(
             to_email=allocation.student_email,
             cc_emails=[allocation.guardian_email, teacher_email, allocation.request_email],
             msg=msg
@@ -0,0 +1,80 @@
+import os
+import pandas as pd
+
+# job form columns that get copied onto each new allocation
+JOB_FORM_COLUMNS = [
+    'student_name', 'student_email', 'guardian_email', 'request_email',
+    'subjects', 'start_date', 'package_hours', 'session_frequency',
+    'student_availability', 'holiday_schedule', 'additional_notes'
+]
+
+def _wanted_column(name):
+    # usecols callable - ignores any extra columns the export has
+    return name in JOB_FORM_COLUMNS
+
+def read_job_forms(file_path, skip_rows=0, chunk_size=None):
+    """
+    reads a job form export in chunks of at most chunk_size rows (a
+    generator of DataFrames), starting after the first skip_rows rows
+    the format comes from the extension: .csv, .parquet, .jsonl/.ndjson,
+    or .xlsx/.xls. csv, parquet and jsonl are streamed so memory stays flat
+    however big the file is - excel has to be read in one go, but at least
+    only the columns we use
+    """
+    chunk_size = chunk_size or int(os.getenv('JOB_FORM_CHUNK_ROWS', 10000))
+    extension = os.path.splitext(file_path)[1].lower()
+
+    if extension == '.csv':
+        return _read_csv(file_path, skip_rows, chunk_size)
+    if extension == '.parquet':
+        return _read_parquet(file_path, skip_rows, chunk_size)
+    if extension in ('.jsonl', '.ndjson'):
+        return _read_jsonl(file_path, skip_rows, chunk_size)
+    if extension in ('.xlsx', '.xls'):
+        return _read_excel(file_path, skip_rows, chunk_size)
+
+    raise ValueError(f"don't know how to read job forms from {file_path}")
+
+def _read_csv(file_path, skip_rows, chunk_size):
+    yield from pd.read_csv(
+        file_path,
+        usecols=_wanted_column,
+        skiprows=range(1, skip_rows + 1),
+        chunksize=chunk_size
+    )
+
+def _read_parquet(file_path, skip_rows, chunk_size):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("reading parquet job forms needs pyarrow (pip install pyarrow)")
+
+    parquet_file = pq.ParquetFile(file_path)
+    columns = [name for name in parquet_file.schema_arrow.names if _wanted_column(name)]
+    batches = parquet_file.iter_batches(batch_size=chunk_size, columns=columns)
+    yield from _skip(
+        (batch.to_pandas() for batch in batches), skip_rows)
+
+def _read_jsonl(file_path, skip_rows, chunk_size):
+    with pd.read_json(file_path, lines=True, chunksize=chunk_size) as reader:
+        for chunk in _skip(reader, skip_rows):
+            yield chunk[[name for name in chunk.columns if _wanted_column(name)]]
+
+def _read_excel(file_path, skip_rows, chunk_size):
+    df = pd.read_excel(
+        file_path,
+        usecols=_wanted_column,
+        skiprows=range(1, skip_rows + 1)
+    )
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start:start + chunk_size]
+
+def _skip(chunks, skip_rows):
+    """drop the first skip_rows rows from a stream of chunks"""
+    position = 0
+    for chunk in chunks:
+        start = max(0, skip_rows - position)
+        position += len(chunk)
+        if start >= len(chunk):
+            continue
+        yield chunk.iloc[start:] if start else chunk
@@ -0,0 +1,289 @@
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from . import codec
+
+# queued -> running -> done
+#             |-> queued again (after a backoff) if it raised
+#             |-> dead once it's failed max_attempts times
+QUEUED, RUNNING, DONE, DEAD = 'queued', 'running', 'done', 'dead'
+
+class JobQueue:
+    """
+    background jobs for the slow stuff (matching, invitations, emails) so
+    the web requests can hand it off and return straight away
+    - jobs live in a sqlite table, so they survive restarts and every
+      gunicorn worker can share one queue
+    - a pool of worker threads runs them with the handler registered for
+      their kind: queue.register('email', send_email)
+    - a job that raises is retried with exponential backoff, and after
+      max_attempts tries it's dead-lettered (status 'dead' + the error)
+    - a worker holds a job on a lease (renewed while the handler runs) -
+      if its process dies the job goes back to being claimable once the
+      lease runs out, and counts as a failed attempt. each claim gets its
+      own token, so a worker that lost its lease can't overwrite the job
+    - get(job_id) tells you how it's going, for the page to poll
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            run_after REAL NOT NULL,
+            lease_until REAL,
+            claim_token TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            result TEXT,
+            last_error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status_run_after ON jobs(status, run_after);
+    """
+
+    def __init__(self, path, workers=None, max_attempts=None, retry_delay=None,
+                 lease_seconds=None, poll_interval=1.0, clock=time.time):
+        self.path = path
+        self.workers = workers if workers is not None else int(os.getenv('JOB_WORKERS', 2))
+        self.max_attempts = max_attempts or int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+        self.retry_delay = retry_delay if retry_delay is not None else float(
+            os.getenv('JOB_RETRY_DELAY', 2))
+        self.lease_seconds = lease_seconds or float(os.getenv('JOB_LEASE_SECONDS', 300))
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self._handlers = {}
+        self._threads = []
+        self._stopping = threading.Event()
+        self._wake = threading.Condition()
+        # sqlite connections can't be shared between threads, so one each
+        self._connections = threading.local()
+
+        conn = self._connection()
+        conn.executescript(self.SCHEMA)
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if 'claim_token' not in columns:
+            # queues made before claims had tokens
+            conn.execute("ALTER TABLE jobs ADD COLUMN claim_token TEXT")
+        conn.commit()
+
+    def _connection(self):
+        conn = getattr(self._connections, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._connections.conn = conn
+        return conn
+
+    def register(self, kind, handler):
+        """handler(payload) -> result (anything json-able) - raise to have it retried"""
+        self._handlers[kind] = handler
+
+    def enqueue(self, kind, payload=None, max_attempts=None):
+        """add a job + wake a worker up for it, returns the job id"""
+        job_id = str(uuid.uuid4())
+        now = self.clock()
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, payload, status, max_attempts, run_after, "
+                "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, codec.dumps(payload or {}).decode('utf-8'), QUEUED,
+                 max_attempts or self.max_attempts, now, now, now))
+        with self._wake:
+            self._wake.notify()
+        return job_id
+
+    def get(self, job_id):
+        """
+        where a job's got to, as a dict:
+        {'id', 'kind', 'status', 'attempts', 'max_attempts', 'result', 'error', ...}
+        (None if there's no such job)
+        """
+        row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def dead_letters(self, limit=100):
+        """the jobs that ran out of attempts, newest first"""
+        rows = self._connection().execute(
+            "SELECT * FROM jobs WHERE status = ? ORDER BY updated_at DESC LIMIT ?", (DEAD, limit))
+        return [self._job(row) for row in rows]
+
+    def retry(self, job_id):
+        """give a dead job another full set of attempts"""
+        conn = self._connection()
+        with conn:
+            updated = conn.execute(
+                "UPDATE jobs SET status = ?, attempts = 0, run_after = ?, updated_at = ? "
+                "WHERE id = ? AND status = ?",
+                (QUEUED, self.clock(), self.clock(), job_id, DEAD)).rowcount
+        with self._wake:
+            self._wake.notify()
+        return bool(updated)
+
+    def _job(self, row):
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'payload': codec.loads(row['payload']),
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'max_attempts': row['max_attempts'],
+            'result': codec.loads(row['result']) if row['result'] is not None else None,
+            'error': row['last_error'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at']
+        }
+
+    def _claim(self):
+        """
+        grab the next job that's due (or whose worker's lease ran out) -
+        BEGIN IMMEDIATE so two workers can't both take the same one
+        """
+        now = self.clock()
+        token = uuid.uuid4().hex
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            while True:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE (status = ? AND run_after <= ?) "
+                    "OR (status = ? AND lease_until < ?) ORDER BY run_after LIMIT 1",
+                    (QUEUED, now, RUNNING, now)).fetchone()
+                if row is None:
+                    conn.commit()
+                    return None
+                if row['status'] == RUNNING and row['attempts'] >= row['max_attempts']:
+                    # its worker keeps dying on it - don't take the next one down too
+                    print(f"Job {row['id']} ({row['kind']}) failed for good after "
+                          f"{row['attempts']} attempts: its worker never finished it")
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, last_error = ?, lease_until = NULL, "
+                        "claim_token = NULL, updated_at = ? WHERE id = ?",
+                        (DEAD, "lease expired - the worker running it stopped or hung",
+                         now, row['id']))
+                    continue
+                break
+            conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, "
+                "claim_token = ?, updated_at = ? WHERE id = ?",
+                (RUNNING, now + self.lease_seconds, token, now, row['id']))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        job = self._job(row)
+        job['attempts'] += 1
+        job['claim_token'] = token
+        return job
+
+    def work_once(self):
+        """run the next due job, if there is one - returns whether there was"""
+        job = self._claim()
+        if job is None:
+            return False
+
+        finished = self._keep_lease(job)
+        try:
+            handler = self._handlers.get(job['kind'])
+            if handler is None:
+                raise LookupError(f"no handler registered for {job['kind']!r} jobs")
+            result = codec.dumps(handler(job['payload'])).decode('utf-8')
+        except Exception as e:
+            self._failed(job, e)
+        else:
+            self._finish(job, DONE, result=result)
+        finally:
+            finished.set()
+        return True
+
+    def _keep_lease(self, job):
+        """
+        push the job's lease out every lease_seconds / 3 until the returned
+        event is set, so a slow handler isn't mistaken for a dead one
+        """
+        finished = threading.Event()
+
+        def renew():
+            while not finished.wait(self.lease_seconds / 3):
+                try:
+                    conn = self._connection()
+                    with conn:
+                        conn.execute(
+                            "UPDATE jobs SET lease_until = ? WHERE id = ? AND claim_token = ?",
+                            (self.clock() + self.lease_seconds, job['id'], job['claim_token']))
+                except sqlite3.Error as e:
+                    # try again next time round - the lease has some slack
+                    print(f"Job {job['id']} lease renewal failed: {e!r}")
+
+        threading.Thread(target=renew, name=f"job-lease-{job['id']}", daemon=True).start()
+        return finished
+
+    def run_until_empty(self):
+        """run jobs on this thread until none are due (handy for tests + scripts)"""
+        while self.work_once():
+            pass
+
+    def _failed(self, job, error):
+        message = ''.join(traceback.format_exception_only(type(error), error)).strip()
+        if job['attempts'] >= job['max_attempts']:
+            print(f"Job {job['id']} ({job['kind']}) failed for good after "
+                  f"{job['attempts']} attempts: {message}")
+            self._finish(job, DEAD, error=message)
+            return
+
+        # 1x, 2x, 4x... retry_delay before the next go
+        delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+        print(f"Job {job['id']} ({job['kind']}) failed, retrying in {delay:.0f}s: {message}")
+        self._finish(job, QUEUED, error=message, run_after=self.clock() + delay)
+
+    def _finish(self, job, status, result=None, error=None, run_after=None):
+        """save how a run went - only if this claim still owns the job"""
+        conn = self._connection()
+        with conn:
+            updated = conn.execute(
+                "UPDATE jobs SET status = ?, result = COALESCE(?, result), last_error = ?, "
+                "run_after = COALESCE(?, run_after), lease_until = NULL, claim_token = NULL, "
+                "updated_at = ? WHERE id = ? AND claim_token = ?",
+                (status, result, error, run_after, self.clock(), job['id'],
+                 job['claim_token'])).rowcount
+        if not updated:
+            print(f"Job {job['id']} ({job['kind']}) lost its lease to another worker - "
+                  f"not saving this run's outcome ({status})")
+
+    def start(self):
+        """start the worker threads (JOB_WORKERS of them, default 2)"""
+        if self._threads:
+            return
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work_forever, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """let the workers finish what they're on, then stop them"""
+        self._stopping.set()
+        with self._wake:
+            self._wake.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _work_forever(self):
+        while not self._stopping.is_set():
+            try:
+                if self.work_once():
+                    continue
+            except Exception as e:
+                # never let a worker thread die - log it + carry on
+                print(f"Job queue error: {e!r}")
+            # nothing due - sleep until a new job comes in (or a retry might be due)
+            with self._wake:
+                self._wake.wait(self.poll_interval)
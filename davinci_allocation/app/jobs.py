@@ -0,0 +1,105 @@
+import os
+
+class AllocationJobs:
+    """
+    the slow bits of the allocation pages, as job queue handlers - every
+    one takes a json payload and is safe to run again if it fails halfway
+    (that's what a retry does)
+    """
+    def __init__(self, queue, data_processor, teacher_matcher, crimson_api,
+                 async_crimson_api, email_service):
+        self.queue = queue
+        self.data_processor = data_processor
+        self.teacher_matcher = teacher_matcher
+        self.crimson_api = crimson_api
+        self.async_crimson_api = async_crimson_api
+        self.email_service = email_service
+
+        queue.register('match', self.match)
+        queue.register('plan', self.plan)
+        queue.register('invite', self.invite)
+        queue.register('confirm', self.confirm)
+        queue.register('email', self.email)
+
+    def _allocation(self, allocation_id):
+        allocation = self.data_processor.get_allocation_by_id(allocation_id)
+        if not allocation:
+            # won't turn up on a retry either, so no point raising
+            print(f"Job skipped - allocation {allocation_id} not found")
+        return allocation
+
+    def match(self, payload):
+        """{'allocation_id'} - run the matcher + save the top matches"""
+        allocation = self._allocation(payload['allocation_id'])
+        if not allocation:
+            return {'matched': 0}
+
+        matching_teachers = self.teacher_matcher.find_matching_teachers(
+            allocation, k=int(os.getenv('MATCH_TOP_K', 10)))
+        self.data_processor.update_matching_teachers(allocation.id, matching_teachers)
+        return {'matched': len(matching_teachers)}
+
+    def plan(self, payload):
+        """{} - plan teachers for every in-progress allocation nobody's been invited for"""
+        waiting = [allocation for allocation in self.data_processor.get_in_progress_allocations()
+                   if not allocation.invited_teachers and not allocation.child_allocation_ids]
+
+        plan = self.teacher_matcher.plan_allocations(waiting)
+        self.data_processor.update_matching_teachers_many(
+            {allocation_id: [teacher] for allocation_id, teacher in plan.items()})
+        return {'planned': len(plan), 'waiting': len(waiting)}
+
+    def invite(self, payload):
+        """
+        {'allocation_id', 'teacher_ids'} - invite them all at once
+        teachers already invited (by an earlier try) are skipped, and if any
+        invitation fails the job raises so just those get tried again
+        """
+        allocation = self._allocation(payload['allocation_id'])
+        if not allocation:
+            return {'invited': []}
+
+        teacher_ids = [teacher_id for teacher_id in payload['teacher_ids']
+                       if teacher_id not in allocation.invited_teachers]
+        results = self.async_crimson_api.run(
+            self.async_crimson_api.send_teacher_invitations(allocation, teacher_ids))
+        invited = [teacher_id for teacher_id, success in results.items() if success]
+        self.data_processor.add_invited_teachers(allocation.id, invited)
+
+        failed = [teacher_id for teacher_id, success in results.items() if not success]
+        if failed:
+            raise RuntimeError(f"invitations failed for {', '.join(failed)}")
+        return {'invited': invited}
+
+    def confirm(self, payload):
+        """
+        {'allocation_id', 'teacher_id'} - save the teacher + mark it done in
+        one write, then queue the confirmation email as its own job (so a
+        flaky mail server doesn't redo the rest)
+        """
+        allocation_id = payload['allocation_id']
+        teacher_info = self.crimson_api.get_teacher_info(payload['teacher_id'])
+        if not teacher_info:
+            # an unknown teacher won't turn up on a retry either
+            print(f"Job skipped - no info for teacher {payload['teacher_id']}")
+            return {'confirmed': False}
+
+        with self.data_processor.transaction() as repo:
+            if not repo.get(allocation_id):
+                print(f"Job skipped - allocation {allocation_id} not found")
+                return {'confirmed': False}
+            self.data_processor.confirm_teacher(allocation_id, teacher_info)
+            self.data_processor.mark_as_completed(allocation_id)
+
+        email_job_id = self.queue.enqueue('email', {'allocation_id': allocation_id})
+        return {'confirmed': True, 'email_job_id': email_job_id}
+
+    def email(self, payload):
+        """{'allocation_id'} - send the confirmation email for its confirmed teacher"""
+        allocation = self._allocation(payload['allocation_id'])
+        if not allocation or not allocation.confirmed_teacher:
+            return {'sent': False}
+
+        if not self.email_service.send_confirmation_email(allocation, allocation.confirmed_teacher):
+            raise RuntimeError("confirmation email didn't send")
+        return {'sent': True}
@@ -10,7 +10,18 @@ class AllocationStatus(Enum):
 class Allocation:
     """
     this is for handling a student + specific subject combo in the da vinci program
+    slotted so 100k of these don't each drag a __dict__ around
     """
+    __slots__ = (
+        'id', 'student_name', 'student_email', 'guardian_email', 'request_email',
+        'subjects', 'current_subject', 'all_subjects', 'start_date', 'end_date',
+        'package_hours', 'session_frequency', 'student_availability',
+        'holiday_schedule', 'additional_notes', 'status', 'staff_member',
+        'date_created', 'date_started', 'date_completed', 'matching_teachers',
+        'invited_teachers', 'confirmed_teacher', 'parent_allocation_id',
+        'child_allocation_ids'
+    )
+    
     def __init__(self, 
                  student_name, 
                  student_email, 
@@ -87,47 +98,53 @@ class Allocation:
     
     @classmethod
     def from_dict(cls, data):
-        """goes from a dict back to an allocation - needed when loading from json"""
-        allocation = cls(
-            student_name=data.get('student_name'),
-            student_email=data.get('student_email'),
-            guardian_email=data.get('guardian_email'),
-            request_email=data.get('request_email'),
-            subjects=data.get('subjects', []),
-            start_date=data.get('start_date'),
-            package_hours=data.get('package_hours'),
-            session_frequency=data.get('session_frequency'),
-            student_availability=data.get('student_availability'),
-            holiday_schedule=data.get('holiday_schedule'),
-            additional_notes=data.get('additional_notes')
-        )
+        """
+        goes from a dict back to an allocation - needed when loading from json
+        skips __init__ so we don't make a uuid + read the clock just to
+        overwrite them straight away
+        """
+        allocation = cls.__new__(cls)
+        get = data.get
         
-        # put the ID back if we have it
-        if 'id' in data:
-            allocation.id = data['id']
-            
-        # get all the other props back
-        allocation.current_subject = data.get('current_subject')
-        allocation.all_subjects = data.get('all_subjects', data.get('subjects', []))
-        allocation.end_date = data.get('end_date')
-        allocation.status = AllocationStatus(data.get('status', 'pending'))
-        allocation.staff_member = data.get('staff_member')
+        # only make up an id / created date if the data doesn't have one
+        allocation.id = data['id'] if 'id' in data else str(uuid.uuid4())
+        allocation.student_name = get('student_name')
+        allocation.student_email = get('student_email')
+        allocation.guardian_email = get('guardian_email')
+        allocation.request_email = get('request_email')
+        allocation.subjects = get('subjects', [])
+        allocation.current_subject = get('current_subject')
+        allocation.all_subjects = get('all_subjects', allocation.subjects)
+        allocation.start_date = get('start_date')
+        allocation.end_date = get('end_date')
+        allocation.package_hours = get('package_hours')
+        allocation.session_frequency = get('session_frequency')
+        allocation.student_availability = get('student_availability')
+        allocation.holiday_schedule = get('holiday_schedule')
+        allocation.additional_notes = get('additional_notes')
+        allocation.status = _STATUS_BY_VALUE[get('status', 'pending')]
+        allocation.staff_member = get('staff_member')
         
         # bring back the dates
-        if data.get('date_created'):
-            allocation.date_created = datetime.fromisoformat(data['date_created'])
-        if data.get('date_started'):
-            allocation.date_started = datetime.fromisoformat(data['date_started'])
-        if data.get('date_completed'):
-            allocation.date_completed = datetime.fromisoformat(data['date_completed'])
-            
+        date_created = get('date_created')
+        allocation.date_created = (_parse_datetime(date_created) if date_created
+                                   else datetime.now())
+        allocation.date_started = _parse_datetime(get('date_started'))
+        allocation.date_completed = _parse_datetime(get('date_completed'))
+        
         # teacher matching stuff
-        allocation.matching_teachers = data.get('matching_teachers', [])
-        allocation.invited_teachers = data.get('invited_teachers', [])
-        allocation.confirmed_teacher = data.get('confirmed_teacher')
+        allocation.matching_teachers = get('matching_teachers', [])
+        allocation.invited_teachers = get('invited_teachers', [])
+        allocation.confirmed_teacher = get('confirmed_teacher')
         
         # parent/child stuff from multi-subject
-        allocation.parent_allocation_id = data.get('parent_allocation_id')
-        allocation.child_allocation_ids = data.get('child_allocation_ids', [])
+        allocation.parent_allocation_id = get('parent_allocation_id')
+        allocation.child_allocation_ids = get('child_allocation_ids', [])
         
-        return allocation 
\ No newline at end of file
+        return allocation
+
+# enum lookups by value go through a few layers - a plain dict is quicker
+_STATUS_BY_VALUE = {status.value: status for status in AllocationStatus}
+
+def _parse_datetime(value):
+    return datetime.fromisoformat(value) if value else None
@@ -0,0 +1,294 @@
+from bisect import bisect_left, bisect_right, insort
+from .models import AllocationStatus
+
+# what list_allocations can sort by
+SORT_FIELDS = ('date_created', 'date_started', 'date_completed', 'student_name')
+
+def sort_key(allocation, field):
+    """
+    (value, id) to order allocations by - the id breaks ties so every key
+    is unique, which is what lets a page start "after" the last one shown
+    missing values sort first (as ''), names ignore case, dates are compared
+    as iso strings (same order as the datetimes)
+    """
+    value = getattr(allocation, field)
+    if value is None:
+        value = ''
+    elif field == 'student_name':
+        value = str(value).lower()
+    else:
+        value = value.isoformat()
+    return (value, allocation.id)
+
+def matches_search(allocation, search):
+    """does the student name or a subject contain this text (any case)"""
+    search = search.lower()
+    return (search in (allocation.student_name or '').lower()
+            or any(search in subject.lower() for subject in allocation.subjects)
+            or search in (allocation.current_subject or '').lower())
+
+class AllocationRepository:
+    """
+    holds allocations in memory with a few indexes on top so we don't have
+    to scan the whole list for every lookup:
+    - id -> allocation
+    - status -> allocations with that status
+    - parent id -> ids of the kids that got split off it
+    - student email -> how many allocations have it
+    - (status, sort field) -> sorted keys, for paging (built when first
+      asked for, then kept sorted by moving just the keys that changed)
+    the indexes get patched on every add/update instead of being rebuilt
+
+    inside a storage transaction it also remembers what changed, so the
+    storage can write just that (see track_changes)
+    """
+    def __init__(self, allocations=()):
+        self._by_id = {}
+        self._seq = {}  # id -> position it was added in, keeps file order
+        self._next_seq = 0
+        self._status_of = {}  # id -> status bucket it currently sits in
+        self._by_status = {status: {} for status in AllocationStatus}
+        self._unsorted = set()  # buckets that got something added out of order
+        self._parent_of = {}
+        self._children = {}
+        self._email_of = {}
+        self._email_counts = {}
+        self._sorted = {}  # (status or None, field) -> sorted [sort_key]
+        self._keys_of = {}  # id -> {field: sort_key} it's filed under in _sorted
+        self._changes = None  # list of (event, id, fields) while tracking
+
+        for allocation in allocations:
+            self.add(allocation)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def __contains__(self, allocation_id):
+        return allocation_id in self._by_id
+
+    def all(self):
+        """everything, in the order it was first added"""
+        return list(self._by_id.values())
+
+    def get(self, allocation_id):
+        """find one allocation by id (or None)"""
+        return self._by_id.get(allocation_id)
+
+    def by_status(self, status):
+        """all allocations with this status, in the order they were added"""
+        bucket = self._by_status[status]
+        if status in self._unsorted:
+            # something moved in from another bucket - put it back in place
+            ordered = sorted(bucket.items(), key=lambda item: self._seq[item[0]])
+            bucket.clear()
+            bucket.update(ordered)
+            self._unsorted.discard(status)
+        return list(bucket.values())
+
+    def children_of(self, parent_allocation_id):
+        """the allocations split off this parent"""
+        return [self._by_id[child_id]
+                for child_id in self._children.get(parent_allocation_id, [])]
+
+    def student_emails(self):
+        """every student email we've got an allocation for"""
+        return set(self._email_counts)
+
+    def existing_emails(self, emails):
+        """which of these student emails we already have allocations for"""
+        return {email for email in emails if email in self._email_counts}
+
+    def page(self, status=None, sort='date_created', descending=False,
+             after=None, limit=25, search=None):
+        """
+        up to limit allocations in sort order, starting just past the key
+        `after` (see sort_key) - a binary search to find the spot, so a
+        later page costs the same as the first one
+        returns (allocations, whether there are more)
+        """
+        keys = self._sorted_keys(status, sort)
+        if descending:
+            end = bisect_left(keys, after) if after is not None else len(keys)
+            candidates = (keys[i] for i in range(end - 1, -1, -1))
+        else:
+            start = bisect_right(keys, after) if after is not None else 0
+            candidates = (keys[i] for i in range(start, len(keys)))
+
+        found = []
+        for _, allocation_id in candidates:
+            allocation = self._by_id[allocation_id]
+            if search and not matches_search(allocation, search):
+                continue
+            if len(found) == limit:
+                return found, True
+            found.append(allocation)
+        return found, False
+
+    def _sorted_keys(self, status, field):
+        keys = self._sorted.get((status, field))
+        if keys is None:
+            # from the keys we filed them under, so later moves find them
+            allocation_ids = self._by_status[status] if status is not None else self._by_id
+            keys = sorted(self._keys_of[allocation_id][field] for allocation_id in allocation_ids)
+            self._sorted[(status, field)] = keys
+        return keys
+
+    def track_changes(self):
+        """start remembering what gets added/updated"""
+        self._changes = []
+
+    def drain_changes(self):
+        """
+        stop tracking + hand back [(event, id, fields)] - fields None means
+        all (or that it was removed, if the id isn't here any more)
+        """
+        changes, self._changes = self._changes or [], None
+        return changes
+
+    def add(self, allocation, event='create'):
+        """put an allocation in (or update it if we've already got it)"""
+        if allocation.id in self._by_id:
+            self.update(allocation, event=event)
+            return
+
+        if self._changes is not None:
+            self._changes.append((event, allocation.id, None))
+
+        self._by_id[allocation.id] = allocation
+        self._seq[allocation.id] = self._next_seq
+        self._next_seq += 1
+        self._index_sorted(allocation)
+        self._index_status(allocation)
+        self._index_parent(allocation)
+        self._index_email(allocation)
+
+    def add_many(self, allocations, event='create'):
+        """add a batch of allocations"""
+        for allocation in allocations:
+            self.add(allocation, event=event)
+
+    def update(self, allocation, fields=None, event='update'):
+        """
+        re-index an allocation after it changed
+        (or swap in a new object for the same id)
+        fields = which ones changed, if you know - None means maybe all of them
+        """
+        if allocation.id not in self._by_id:
+            self.add(allocation, event=event)
+            return
+
+        if self._changes is not None:
+            self._changes.append((event, allocation.id, fields))
+
+        self._by_id[allocation.id] = allocation
+        if fields is None or {'status', *SORT_FIELDS} & set(fields):
+            self._index_sorted(allocation)
+        self._index_status(allocation)
+        self._index_parent(allocation)
+        self._index_email(allocation)
+
+    def remove(self, allocation_id, event='remove'):
+        """drop an allocation + all its index entries"""
+        allocation = self._by_id.pop(allocation_id, None)
+        if allocation is None:
+            return None
+
+        if self._changes is not None:
+            self._changes.append((event, allocation_id, None))
+
+        self._unlink_sorted(allocation_id)
+        self._seq.pop(allocation_id)
+        self._by_status[self._status_of.pop(allocation_id)].pop(allocation_id)
+        self._unlink_parent(allocation_id)
+        self._unlink_email(allocation_id)
+        return allocation
+
+    def _index_status(self, allocation):
+        """move the allocation into the right status bucket"""
+        old_status = self._status_of.get(allocation.id)
+        bucket = self._by_status[allocation.status]
+
+        if old_status is not None and old_status != allocation.status:
+            self._by_status[old_status].pop(allocation.id)
+
+        # new entries land at the end of the bucket - only a problem if
+        # something newer is already in there
+        if allocation.id not in bucket and bucket:
+            last_id = next(reversed(bucket))
+            if self._seq[last_id] > self._seq[allocation.id]:
+                self._unsorted.add(allocation.status)
+
+        bucket[allocation.id] = allocation
+        self._status_of[allocation.id] = allocation.status
+
+    def _index_sorted(self, allocation):
+        """
+        move the allocation's keys in the sorted lists that have been built -
+        only the all-statuses list + the buckets it left/joined get touched,
+        and only for the fields whose key actually changed
+        (call before _index_status, while _status_of still has the old one)
+        """
+        old_status = self._status_of.get(allocation.id)
+        old_keys = self._keys_of.get(allocation.id)
+        new_keys = {field: sort_key(allocation, field) for field in SORT_FIELDS}
+        self._keys_of[allocation.id] = new_keys
+
+        for (status, field), keys in self._sorted.items():
+            was_in = old_keys is not None and status in (None, old_status)
+            is_in = status in (None, allocation.status)
+            if was_in and is_in and old_keys[field] == new_keys[field]:
+                continue
+            if was_in:
+                del keys[bisect_left(keys, old_keys[field])]
+            if is_in:
+                insort(keys, new_keys[field])
+
+    def _unlink_sorted(self, allocation_id):
+        old_status = self._status_of.get(allocation_id)
+        old_keys = self._keys_of.pop(allocation_id)
+        for (status, field), keys in self._sorted.items():
+            if status in (None, old_status):
+                del keys[bisect_left(keys, old_keys[field])]
+
+    def _index_parent(self, allocation):
+        """keep the parent -> kids map in step with parent_allocation_id"""
+        parent_id = allocation.parent_allocation_id
+        if self._parent_of.get(allocation.id) == parent_id:
+            return
+
+        self._unlink_parent(allocation.id)
+        if parent_id is not None:
+            self._parent_of[allocation.id] = parent_id
+            self._children.setdefault(parent_id, []).append(allocation.id)
+
+    def _unlink_parent(self, allocation_id):
+        parent_id = self._parent_of.pop(allocation_id, None)
+        if parent_id is None:
+            return
+
+        siblings = self._children[parent_id]
+        siblings.remove(allocation_id)
+        if not siblings:
+            del self._children[parent_id]
+
+    def _index_email(self, allocation):
+        """keep the email counts in step with student_email"""
+        email = allocation.student_email
+        if allocation.id in self._email_of and self._email_of[allocation.id] == email:
+            return
+
+        self._unlink_email(allocation.id)
+        self._email_of[allocation.id] = email
+        self._email_counts[email] = self._email_counts.get(email, 0) + 1
+
+    def _unlink_email(self, allocation_id):
+        if allocation_id not in self._email_of:
+            return
+
+        email = self._email_of.pop(allocation_id)
+        self._email_counts[email] -= 1
+        if not self._email_counts[email]:
+            del self._email_counts[email]
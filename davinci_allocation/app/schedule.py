@@ -0,0 +1,299 @@
+import os
+import re
+from datetime import datetime
+from functools import lru_cache
+import numpy as np
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:  # python < 3.9
+    ZoneInfo = None
+
+# everything is minutes into a UTC week, monday 00:00 = 0
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+DAY_NAMES = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# offsets (minutes from UTC) for the zone abbreviations people actually write
+TIMEZONE_OFFSETS = {
+    'UTC': 0, 'GMT': 0, 'BST': 60, 'CET': 60, 'CEST': 120,
+    'EST': -300, 'EDT': -240, 'ET': -300,
+    'CST': -360, 'CDT': -300, 'CT': -360,
+    'MST': -420, 'MDT': -360, 'MT': -420,
+    'PST': -480, 'PDT': -420, 'PT': -480,
+    'IST': 330, 'SGT': 480, 'HKT': 480, 'JST': 540,
+    'AEST': 600, 'AEDT': 660, 'NZST': 720, 'NZDT': 780
+}
+
+# bitmaps: the week cut into 15 minute slots (7 x 96 = 672), packed into
+# 11 uint64 words - bit i of word w is slot w * 64 + i
+SLOT_MINUTES = 15
+SLOTS_PER_WEEK = MINUTES_PER_WEEK // SLOT_MINUTES
+BITMAP_WORDS = -(-SLOTS_PER_WEEK // 64)
+
+# IANA names (America/New_York) get their offset on this date, so the same
+# text always gives the same answer whatever day we run on
+REFERENCE_DATE = datetime(2024, 1, 15)
+
+_DAY_PATTERN = (r'mon(?:day)?|tue(?:s(?:day)?)?|wed(?:nesday)?|thu(?:r(?:s(?:day)?)?)?'
+                r'|fri(?:day)?|sat(?:urday)?|sun(?:day)?')
+_TIME_PATTERN = r'(\d{1,2})(?::(\d{2}))?(?:\s*([ap])\.?m\b\.?)?'
+
+_TOKENS = re.compile(
+    rf'(?P<day_range>\b(?:{_DAY_PATTERN})\b\s*(?:-|–|to|through|thru)\s*\b(?:{_DAY_PATTERN})\b)'
+    rf'|(?P<day>\b(?:{_DAY_PATTERN})\b)'
+    r'|(?P<weekdays>\bweekdays?\b)'
+    r'|(?P<weekends>\bweekends?\b)'
+    r'|(?P<every_day>\b(?:daily|every\s*day|any\s*day)\b)'
+    rf'|(?P<time_range>{_TIME_PATTERN}\s*(?:-|–|to|until)\s*{_TIME_PATTERN})'
+    r'|(?P<zone>\b[A-Za-z]+/[A-Za-z_]+\b|\b[A-Z]{2,4}\b)',
+    re.IGNORECASE
+)
+
+def default_timezone():
+    """zone for times that don't say (SCHEDULE_DEFAULT_TIMEZONE, UTC if unset)"""
+    return os.getenv('SCHEDULE_DEFAULT_TIMEZONE', 'UTC')
+
+def timezone_offset(name):
+    """minutes from UTC for a zone abbreviation or IANA name (None if we don't know it)"""
+    if not name:
+        return None
+    offset = TIMEZONE_OFFSETS.get(name.upper())
+    if offset is not None:
+        return offset
+    if ZoneInfo is None or '/' not in name:
+        return None
+    try:
+        zone = ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+    return int(zone.utcoffset(REFERENCE_DATE).total_seconds() // 60)
+
+def _day_index(name):
+    return DAY_NAMES.index(next(day for day in DAY_NAMES if day.startswith(name.lower()[:3])))
+
+def _day_span(first, last):
+    """days from first to last inclusive, wrapping past sunday (fri-mon)"""
+    start, end = _day_index(first), _day_index(last)
+    return [(start + i) % 7 for i in range((end - start) % 7 + 1)]
+
+def _minutes(hour, minute, meridiem):
+    hour, minute = int(hour), int(minute or 0)
+    if meridiem:
+        hour = hour % 12 + (12 if meridiem.lower() == 'p' else 0)
+    return hour * 60 + minute
+
+def _time_range(match):
+    """(start, end) minutes into the day - end past 24:00 if it runs overnight"""
+    start_hour, start_minute, start_meridiem, end_hour, end_minute, end_meridiem = match
+    end = _minutes(end_hour, end_minute, end_meridiem)
+
+    if start_meridiem or not end_meridiem:
+        start = _minutes(start_hour, start_minute, start_meridiem)
+    else:
+        # "4-8pm" - the start takes the end's am/pm, unless that puts it after
+        # the end ("11-1pm" is 11am)
+        start = _minutes(start_hour, start_minute, end_meridiem)
+        if start >= end:
+            start = _minutes(start_hour, start_minute, 'a' if end_meridiem.lower() == 'p' else 'p')
+
+    if end <= start:
+        end += MINUTES_PER_DAY
+    return start, end
+
+def normalize(intervals):
+    """
+    sort + merge (start, end) minute intervals, folding anything that falls off
+    either end of the week back around - gives back a tuple of tuples
+    """
+    pieces = []
+    for start, end in intervals:
+        if end - start >= MINUTES_PER_WEEK:
+            return ((0, MINUTES_PER_WEEK),)
+        start, end = start % MINUTES_PER_WEEK, start % MINUTES_PER_WEEK + (end - start)
+        if end > MINUTES_PER_WEEK:
+            pieces.append((start, MINUTES_PER_WEEK))
+            pieces.append((0, end - MINUTES_PER_WEEK))
+        elif end > start:
+            pieces.append((start, end))
+
+    merged = []
+    for start, end in sorted(pieces):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return tuple(merged)
+
+def _week_intervals(days, day_ranges, offset):
+    """local (days x time ranges) -> UTC minutes into the week"""
+    return [(day * MINUTES_PER_DAY + start - offset, day * MINUTES_PER_DAY + end - offset)
+            for day in days for start, end in day_ranges]
+
+@lru_cache(maxsize=4096)
+def parse_availability_text(text, default_tz=None):
+    """
+    turn a free text availability ("Monday-Friday, 3:00 PM - 7:00 PM EST",
+    "Weekdays 4-8pm", "Tue, Thu 16:00-18:00; Sat 10am-2pm") into UTC weekly
+    intervals. each time range goes with the days written before it (or
+    the previous range's days, or every day if none were given)
+    nothing recognisable -> empty tuple
+    """
+    if not text:
+        return ()
+
+    segments = []  # (days, (start, end))
+    pending_days = []
+    days_given = False  # did the first time range have its own days?
+    zone = None
+    for match in _TOKENS.finditer(text):
+        kind = match.lastgroup
+        if kind == 'day_range':
+            first, last = re.split(r'\s*(?:-|–|to|through|thru)\s*', match.group(kind),
+                                   maxsplit=1, flags=re.IGNORECASE)
+            pending_days.extend(_day_span(first, last))
+        elif kind == 'day':
+            pending_days.append(_day_index(match.group(kind)))
+        elif kind == 'weekdays':
+            pending_days.extend(range(5))
+        elif kind == 'weekends':
+            pending_days.extend([5, 6])
+        elif kind == 'every_day':
+            pending_days.extend(range(7))
+        elif kind == 'time_range':
+            if not segments:
+                days_given = bool(pending_days)
+            days = pending_days or (segments[-1][0] if segments else list(range(7)))
+            # the 6 groups inside time_range come straight after it
+            segments.append((days, _time_range(match.groups()[match.lastindex:match.lastindex + 6])))
+            pending_days = []
+        elif timezone_offset(match.group(kind)) is not None:
+            zone = match.group(kind)
+
+    # "3-7pm weekdays" - days after the only time range still belong to it
+    if pending_days and len(segments) == 1 and not days_given:
+        segments = [(pending_days, segments[0][1])]
+
+    offset = timezone_offset(zone or default_tz or default_timezone()) or 0
+    intervals = []
+    for days, day_range in segments:
+        intervals.extend(_week_intervals(sorted(set(days)), [day_range], offset))
+    return normalize(intervals)
+
+@lru_cache(maxsize=16384)
+def _parse_teacher_slots(weekdays, time_slots, zone):
+    days = sorted({_day_index(day) for day in weekdays if re.fullmatch(_DAY_PATTERN, day, re.IGNORECASE)})
+    day_ranges = []
+    for slot in time_slots:
+        match = re.fullmatch(rf'\s*{_TIME_PATTERN}\s*(?:-|–|to|until)\s*{_TIME_PATTERN}\s*',
+                             slot, re.IGNORECASE)
+        if match:
+            day_ranges.append(_time_range(match.groups()))
+
+    offset = timezone_offset(zone) or 0
+    return normalize(_week_intervals(days, day_ranges, offset))
+
+def parse_teacher_availability(availability, default_tz=None):
+    """
+    a teacher's {'weekdays': [...], 'time_slots': ["8:00-10:00", ...],
+    'timezone': optional} -> UTC weekly intervals (every slot on every day)
+    """
+    if not availability:
+        return ()
+    zone = availability.get('timezone') or default_tz or default_timezone()
+    return _parse_teacher_slots(tuple(availability.get('weekdays', ())),
+                                tuple(availability.get('time_slots', ())), zone)
+
+def total_minutes(intervals):
+    return sum(end - start for start, end in intervals)
+
+def overlap_minutes(a, b):
+    """minutes two normalized interval sets share - one sweep over both"""
+    i = j = 0
+    overlap = 0
+    while i < len(a) and j < len(b):
+        start = max(a[i][0], b[j][0])
+        end = min(a[i][1], b[j][1])
+        if end > start:
+            overlap += end - start
+        # move past whichever finishes first
+        if a[i][1] <= b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return overlap
+
+def schedule_compatibility(teacher_availability, student_availability):
+    """
+    how much of the student's free time the teacher is also free for
+    0 (no overlap) to 1 (teacher free whenever the student is)
+    0.5 when we can't tell (missing/unreadable availability on either side)
+    """
+    student = parse_availability_text(student_availability)
+    teacher = parse_teacher_availability(teacher_availability)
+    if not student or not teacher:
+        return 0.5
+    return overlap_minutes(student, teacher) / total_minutes(student)
+
+def intervals_to_bitmap(intervals):
+    """
+    normalized intervals -> packed slot bitmap (uint64 array of BITMAP_WORDS)
+    interval ends get rounded to the nearest 15 minute slot
+    """
+    slots = np.zeros(BITMAP_WORDS * 64, dtype=bool)
+    for start, end in intervals:
+        first = (start + SLOT_MINUTES // 2) // SLOT_MINUTES
+        last = (end + SLOT_MINUTES // 2) // SLOT_MINUTES
+        slots[first:last] = True
+    # little endian bit order, so slot w * 64 + i lands on bit i of word w
+    return np.packbits(slots, bitorder='little').view('<u8').astype(np.uint64)
+
+def popcount(words):
+    """number of set bits along the last axis of a uint64 array"""
+    if hasattr(np, 'bitwise_count'):  # numpy 2
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    as_bytes = np.ascontiguousarray(words).view(np.uint8)
+    return np.unpackbits(as_bytes, axis=-1).sum(axis=-1, dtype=np.int64)
+
+EMPTY_BITMAP = np.zeros(BITMAP_WORDS, dtype=np.uint64)
+
+@lru_cache(maxsize=4096)
+def _text_bitmap(text, default_tz):
+    bitmap = intervals_to_bitmap(parse_availability_text(text, default_tz))
+    bitmap.flags.writeable = False  # shared out of the cache
+    return bitmap
+
+def student_bitmap(student_availability, default_tz=None):
+    """free text availability -> slot bitmap (all zeros if we can't read it)"""
+    if not student_availability:
+        return EMPTY_BITMAP
+    return _text_bitmap(student_availability, default_tz)
+
+@lru_cache(maxsize=16384)
+def _intervals_bitmap(intervals):
+    bitmap = intervals_to_bitmap(intervals)
+    bitmap.flags.writeable = False  # shared out of the cache
+    return bitmap
+
+def teacher_bitmap(teacher_availability, default_tz=None):
+    """teacher availability dict -> slot bitmap (read only, copy to change it)"""
+    return _intervals_bitmap(parse_teacher_availability(teacher_availability, default_tz))
+
+def bitmap_compatibility(teacher_bitmaps, student):
+    """
+    schedule_compatibility for a whole (n, BITMAP_WORDS) stack of teacher
+    bitmaps at once - one AND + popcount, no python loop
+    same rules: share of the student's slots covered, 0.5 when either side is empty
+    """
+    teacher_bitmaps = np.asarray(teacher_bitmaps, dtype=np.uint64).reshape(-1, BITMAP_WORDS)
+    student_slots = int(popcount(student))
+    if not student_slots:
+        return np.full(len(teacher_bitmaps), 0.5)
+
+    overlap = popcount(teacher_bitmaps & student)
+    compatibility = overlap / student_slots
+    compatibility[popcount(teacher_bitmaps) == 0] = 0.5
+    return compatibility
+
@@ -0,0 +1,105 @@
+from .analytics import AllocationAnalytics
+from .models import AllocationStatus
+
+class StatisticsAggregates:
+    """
+    running totals behind the /stats page, so it doesn't have to load every
+    allocation each time:
+    - how many allocations are in each status
+    - sum + count of completion times (hours) -> the average
+    - how many allocations ask for each subject
+    - the time-to-start/complete percentiles (see analytics.py)
+    everything is a plain sum, so an allocation changing is just
+    count(old version, -1) then count(new version, +1)
+    """
+    def __init__(self, status_counts=None, completion_hours_sum=0.0,
+                 completion_count=0, subjects_count=None, analytics=None):
+        self.status_counts = {status.value: 0 for status in AllocationStatus}
+        self.status_counts.update(status_counts or {})
+        self.completion_hours_sum = completion_hours_sum
+        self.completion_count = completion_count
+        self.subjects_count = dict(subjects_count or {})
+        self.analytics = analytics or AllocationAnalytics()
+
+    @classmethod
+    def from_allocations(cls, allocations):
+        """build the totals from scratch (the slow way - see rebuild_statistics)"""
+        aggregates = cls()
+        for allocation in allocations:
+            aggregates.count(allocation)
+        return aggregates
+
+    def __bool__(self):
+        return bool(any(self.status_counts.values()) or self.completion_count
+                    or self.completion_hours_sum or any(self.subjects_count.values())
+                    or not self.analytics.is_empty())
+
+    def count(self, allocation, sign=1):
+        """add an allocation to the totals (sign=-1 takes it back out)"""
+        status = allocation.status.value
+        self.status_counts[status] = self.status_counts.get(status, 0) + sign
+
+        hours = completion_hours(allocation)
+        if hours is not None:
+            self.completion_hours_sum += sign * hours
+            self.completion_count += sign
+
+        for subject in allocation.subjects:
+            self.subjects_count[subject] = self.subjects_count.get(subject, 0) + sign
+            if not self.subjects_count[subject]:
+                del self.subjects_count[subject]
+
+        self.analytics.count(allocation, sign)
+
+    def merge(self, other):
+        """add another set of totals (e.g. the changes from one transaction) onto these"""
+        for status, count in other.status_counts.items():
+            self.status_counts[status] = self.status_counts.get(status, 0) + count
+        self.completion_hours_sum += other.completion_hours_sum
+        self.completion_count += other.completion_count
+        for subject, count in other.subjects_count.items():
+            self.subjects_count[subject] = self.subjects_count.get(subject, 0) + count
+            if not self.subjects_count[subject]:
+                del self.subjects_count[subject]
+        if not self.completion_count:
+            # don't let float rounding leave a tiny leftover sum behind
+            self.completion_hours_sum = 0.0
+        self.analytics.merge(other.analytics)
+
+    def summary(self):
+        """the numbers the stats page shows (same keys get_statistics always had)"""
+        counts = self.status_counts
+        return {
+            'total_allocations': sum(counts.values()),
+            'pending_allocations': counts.get(AllocationStatus.PENDING.value, 0),
+            'in_progress_allocations': counts.get(AllocationStatus.IN_PROGRESS.value, 0),
+            'completed_allocations': counts.get(AllocationStatus.COMPLETED.value, 0),
+            'avg_completion_time_hours': (self.completion_hours_sum / self.completion_count
+                                          if self.completion_count else 0),
+            'subjects_count': dict(self.subjects_count),
+            'analytics': self.analytics.summary()
+        }
+
+    def to_dict(self):
+        return {
+            'status_counts': self.status_counts,
+            'completion_hours_sum': self.completion_hours_sum,
+            'completion_count': self.completion_count,
+            'subjects_count': self.subjects_count,
+            'analytics': self.analytics.to_dict()
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(status_counts=data['status_counts'],
+                   completion_hours_sum=data['completion_hours_sum'],
+                   completion_count=data['completion_count'],
+                   subjects_count=data['subjects_count'],
+                   analytics=AllocationAnalytics.from_dict(data['analytics']))
+
+def completion_hours(allocation):
+    """hours from created to completed - None unless it's done + has both dates"""
+    if (allocation.status != AllocationStatus.COMPLETED
+            or not allocation.date_completed or not allocation.date_created):
+        return None
+    return (allocation.date_completed - allocation.date_created).total_seconds() / 3600
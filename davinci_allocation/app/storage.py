@@ -0,0 +1,710 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from . import codec
+from .models import Allocation
+from .repository import AllocationRepository, SORT_FIELDS
+
+try:
+    import fcntl
+except ImportError:
+    # windows - no flock, so _locked only keeps out other threads in this
+    # process (with a threading.Lock per lock file), not other processes
+    fcntl = None
+
+# process-wide cache of parsed json files
+# key -> (signature, repository) - only trusted while the file(s) still
+# look exactly like they did when we loaded/saved them
+_json_cache = {}
+_json_cache_lock = threading.Lock()
+
+# lock file path -> threading.Lock, only used when there's no fcntl
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+def _thread_lock(lock_path):
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(os.path.abspath(lock_path), threading.Lock())
+
+@contextmanager
+def _locked(lock_path):
+    """hold an exclusive flock on lock_path (shared by every worker process)"""
+    if not fcntl:
+        with _thread_lock(lock_path):
+            yield
+        return
+
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+class AllocationStorage:
+    """
+    base class for the places we can keep allocations
+    backends only *have* to do load_all/save_all, everything else has a
+    slow-but-correct default that the faster backends override
+
+    all writes go through transaction():
+        with storage.transaction() as repo:
+            allocation = repo.get(allocation_id)
+            allocation.staff_member = 'someone'
+            repo.update(allocation, fields=('staff_member',))
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def load_all(self):
+        raise NotImplementedError
+
+    def save_all(self, allocations):
+        raise NotImplementedError
+
+    @contextmanager
+    def transaction(self):
+        """
+        yields a repository to read/change - saved when the block exits,
+        thrown away if it raises. nested calls share the outer transaction
+        """
+        current = getattr(self._local, 'transaction', None)
+        if current is not None:
+            yield current
+            return
+
+        with self._exclusive():
+            repository = self._begin()
+            repository.track_changes()
+            self._local.transaction = repository
+            self._local.after_commit = callbacks = []
+            try:
+                yield repository
+                self._commit(repository, repository.drain_changes())
+            except BaseException:
+                repository.drain_changes()
+                self._rollback(repository)
+                raise
+            finally:
+                self._local.transaction = None
+                self._local.after_commit = None
+            for callback in callbacks:
+                callback()
+
+    def after_commit(self, callback):
+        """
+        run callback() once the current transaction has been saved, while
+        other writers are still locked out - it's dropped if the transaction
+        rolls back (or fails to save). runs straight away outside a
+        transaction. callbacks mustn't start another transaction
+        """
+        callbacks = getattr(self._local, 'after_commit', None)
+        if callbacks is None:
+            callback()
+        else:
+            callbacks.append(callback)
+
+    @contextmanager
+    def _exclusive(self):
+        """hold whatever lock keeps other writers out while we're busy"""
+        yield
+
+    def _begin(self):
+        return AllocationRepository(self.load_all())
+
+    def _commit(self, repository, changes):
+        self.save_all(repository.all())
+
+    def _rollback(self, repository):
+        pass
+
+    def get(self, allocation_id):
+        """find one allocation by id"""
+        for allocation in self.load_all():
+            if allocation.id == allocation_id:
+                return allocation
+        return None
+
+    def put(self, allocation, event='update'):
+        """insert or replace a single allocation"""
+        self.put_many([allocation], event=event)
+
+    def put_many(self, allocations, event='update'):
+        """
+        insert or replace a bunch of allocations in one go
+        event is just a label for what happened (create, split, ...) -
+        only backends that keep a history care about it
+        """
+        with self.transaction() as repository:
+            repository.add_many(allocations, event=event)
+
+    def find_by_status(self, status):
+        """all the allocations with this status"""
+        return [a for a in self.load_all() if a.status == status]
+
+    def find_by_parent(self, parent_allocation_id):
+        """all the kids that got split off this allocation"""
+        return [a for a in self.load_all() if a.parent_allocation_id == parent_allocation_id]
+
+    def student_emails(self):
+        """every student email we've already got an allocation for"""
+        return {a.student_email for a in self.load_all()}
+
+    def page(self, status=None, sort='date_created', descending=False,
+             after=None, limit=25, search=None):
+        """
+        one page of allocations in sort order, starting after the sort key
+        `after` - see AllocationRepository.page
+        returns (allocations, whether there are more)
+        """
+        return AllocationRepository(self.load_all()).page(
+            status, sort, descending, after, limit, search)
+
+class JsonStorage(AllocationStorage):
+    """
+    the og storage - everything lives in one big json file
+    writers take an flock on <file>.lock and swap a fully written temp file
+    in with os.replace, so several gunicorn workers can share the file
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.lock_path = path + '.lock'
+        self._cache_key = os.path.abspath(path)
+        # guards in-process cache refreshes, never held while waiting on flock
+        self._lock = threading.RLock()
+
+        # create empty json file if needed
+        if not os.path.exists(path):
+            atomic_write_json(path, [])
+
+    def _file_signature(self):
+        """mtime + size - if neither moved, the file hasn't changed under us"""
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def repository(self):
+        """
+        the indexed, in-memory copy of our json file
+        only actually parses the file when it changed since last time - the
+        allocations in it are shared, so only change them in a transaction
+        """
+        with self._lock:
+            signature = self._file_signature()
+            with _json_cache_lock:
+                cached = _json_cache.get(self._cache_key)
+            if cached and cached[0] == signature:
+                return cached[1]
+
+            with open(self.path, 'rb') as f:
+                allocations_data = codec.loads(f.read())
+
+            repository = AllocationRepository(
+                Allocation.from_dict(data) for data in allocations_data)
+            self._remember(signature, repository)
+            return repository
+
+    def _write(self, repository):
+        """dump everything to json + keep the cache in step with what we wrote"""
+        with self._lock:
+            atomic_write_json(self.path, [allocation.to_dict() for allocation in repository])
+            self._remember(self._file_signature(), repository)
+
+    def _remember(self, signature, repository):
+        with _json_cache_lock:
+            _json_cache[self._cache_key] = (signature, repository)
+
+    def invalidate_cache(self):
+        """forget what we've cached so the next read goes back to the file"""
+        with _json_cache_lock:
+            _json_cache.pop(self._cache_key, None)
+
+    def _exclusive(self):
+        return _locked(self.lock_path)
+
+    def _begin(self):
+        # re-reads the file if another worker saved since we last looked
+        return self.repository()
+
+    def _commit(self, repository, changes):
+        if changes:
+            self._write(repository)
+
+    def _rollback(self, repository):
+        # the cached allocations may have been half changed - drop them
+        self.invalidate_cache()
+
+    def load_all(self):
+        return self.repository().all()
+
+    def save_all(self, allocations):
+        with self.transaction():
+            self._write(AllocationRepository(allocations))
+
+    def get(self, allocation_id):
+        return self.repository().get(allocation_id)
+
+    def find_by_status(self, status):
+        return self.repository().by_status(status)
+
+    def find_by_parent(self, parent_allocation_id):
+        return self.repository().children_of(parent_allocation_id)
+
+    def student_emails(self):
+        return self.repository().student_emails()
+
+    def page(self, status=None, sort='date_created', descending=False,
+             after=None, limit=25, search=None):
+        return self.repository().page(status, sort, descending, after, limit, search)
+
+class JournalStorage(JsonStorage):
+    """
+    allocations.json only holds the last snapshot - every change after that
+    is appended to allocations.log as one compact json line like
+    {"event": "invite", "id": "...", "set": {"invited_teachers": [...]}}
+    (or {"event": "archive", "id": "...", "remove": true} when one goes)
+    reading = snapshot + replay the log on top. once the log passes
+    compact_bytes a background thread folds it into a fresh snapshot
+
+    events only ever *set* fields (a create just sets all of them), so
+    replaying one twice is harmless - a crash between writing the new
+    snapshot and swapping in an empty log can't corrupt anything
+    the log is swapped for a new file rather than truncated, so a reader
+    holding an offset into the old one sees a different inode and reloads
+    """
+    def __init__(self, path, log_path=None, compact_bytes=None):
+        super().__init__(path)
+        self._cache_key = ('journal', os.path.abspath(path))
+        self.log_path = log_path or os.path.splitext(path)[0] + '.log'
+        self.compact_bytes = compact_bytes or int(
+            os.getenv('JOURNAL_COMPACT_BYTES', 1024 * 1024))
+        self._compactor = None
+
+        if not os.path.exists(self.log_path):
+            open(self.log_path, 'a').close()
+
+    def _log_signature(self):
+        stat = os.stat(self.log_path)
+        return stat.st_ino, stat.st_size
+
+    def _read_log(self, offset):
+        """
+        read events from offset onwards
+        returns (events, offset just past the last complete line, inode of
+        the log we actually read) - a torn last line from a crash mid-append
+        is left alone
+        """
+        with open(self.log_path, 'rb') as f:
+            log_ino = os.fstat(f.fileno()).st_ino
+            f.seek(offset)
+            chunk = f.read()
+
+        end = chunk.rfind(b'\n') + 1
+        events = []
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                events.append(codec.loads(line))
+            except codec.DecodeError:
+                # junk left over from a torn write - skip it
+                print(f"Skipping unreadable journal line in {self.log_path}")
+        return events, offset + end, log_ino
+
+    def repository(self):
+        """
+        snapshot + log, kept in memory
+        if only the log grew since last time we just replay the new bit
+        """
+        with self._lock:
+            snapshot = self._file_signature()
+            log_ino, log_size = self._log_signature()
+
+            with _json_cache_lock:
+                cached = _json_cache.get(self._cache_key)
+            if cached:
+                (cached_snapshot, cached_ino, offset), repository = cached
+                if (cached_snapshot == snapshot and cached_ino == log_ino
+                        and log_size >= offset):
+                    if log_size == offset:
+                        return repository
+                    events, new_offset, read_ino = self._read_log(offset)
+                    # only if the log wasn't swapped between the stat + the read
+                    if read_ino == log_ino:
+                        for event in events:
+                            self._apply(repository, event)
+                        self._remember((snapshot, log_ino, new_offset), repository)
+                        return repository
+
+            # something moved under us (or first load) - start from scratch
+            with open(self.path, 'rb') as f:
+                records = {data['id']: data for data in codec.loads(f.read())}
+            events, offset, log_ino = self._read_log(0)
+            for event in events:
+                if event.get('remove'):
+                    records.pop(event['id'], None)
+                else:
+                    records.setdefault(event['id'], {}).update(event['set'])
+
+            repository = AllocationRepository(
+                Allocation.from_dict(data) for data in records.values())
+            self._remember((snapshot, log_ino, offset), repository)
+            return repository
+
+    def _apply(self, repository, event):
+        """replay one event onto an already loaded repository"""
+        if event.get('remove'):
+            repository.remove(event['id'])
+            return
+        existing = repository.get(event['id'])
+        data = existing.to_dict() if existing else {}
+        data.update(event['set'])
+        repository.update(Allocation.from_dict(data))
+
+    def _commit(self, repository, changes):
+        """only the fields each change touched go in the log"""
+        events = []
+        for event, allocation_id, fields in changes:
+            allocation = repository.get(allocation_id)
+            if allocation is None:
+                # removed (e.g. archived) - anything logged for it before goes too
+                events.append({'event': event, 'id': allocation_id, 'remove': True})
+                continue
+            data = allocation.to_dict()
+            if fields is not None:
+                data = {field: data[field] for field in fields}
+            events.append({'event': event, 'id': allocation_id, 'set': data})
+
+        if events:
+            self._append(events)
+
+    def _append(self, events):
+        """write events to the end of the log (+ fsync), then maybe compact"""
+        lines = b''.join(codec.dumps(event) + b'\n' for event in events)
+
+        with self._lock:
+            with _json_cache_lock:
+                cached = _json_cache.get(self._cache_key)
+
+            with open(self.log_path, 'ab') as f:
+                start = f.tell()
+                if start and not self._ends_with_newline(start):
+                    # don't glue our line onto a torn one
+                    lines = b'\n' + lines
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+                end = f.tell()
+
+            # we hold the file lock so nobody else appended since our read -
+            # just move the cached offset past our own lines
+            if cached and cached[0][2] == start:
+                snapshot, log_ino, _ = cached[0]
+                self._remember((snapshot, log_ino, end), cached[1])
+
+        if end > self.compact_bytes:
+            self._start_compaction()
+
+    def _ends_with_newline(self, size):
+        with open(self.log_path, 'rb') as f:
+            f.seek(size - 1)
+            return f.read(1) == b'\n'
+
+    def _write(self, repository):
+        """full rewrite = fresh snapshot + empty log"""
+        with self._lock:
+            atomic_write_json(self.path, [a.to_dict() for a in repository])
+            self._rotate_log()
+            log_ino, _ = self._log_signature()
+            self._remember((self._file_signature(), log_ino, 0), repository)
+
+    def _rotate_log(self):
+        """
+        swap in a new empty log file - never truncate in place, the inode
+        changing is how other workers know their cached offset is no good
+        """
+        tmp_path = f"{self.log_path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        try:
+            open(tmp_path, 'wb').close()
+            os.replace(tmp_path, self.log_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _start_compaction(self):
+        """fold the log into a snapshot on a background thread"""
+        with self._lock:
+            if self._compactor and self._compactor.is_alive():
+                return
+            self._compactor = threading.Thread(target=self.compact, daemon=True)
+            self._compactor.start()
+
+    def compact(self):
+        """write everything we know to a new snapshot and empty the log"""
+        with self.transaction() as repository:
+            self._write(repository)
+
+class _SQLiteSession:
+    """
+    the repository you get inside a sqlite transaction - same methods as
+    AllocationRepository but every call goes straight to the db
+    """
+    def __init__(self, storage, conn):
+        self._storage = storage
+        self._conn = conn
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM allocations").fetchone()[0]
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def __contains__(self, allocation_id):
+        return self.get(allocation_id) is not None
+
+    def all(self):
+        return self._storage._select(conn=self._conn)
+
+    def get(self, allocation_id):
+        found = self._storage._select("WHERE id = ?", (allocation_id,), conn=self._conn)
+        return found[0] if found else None
+
+    def by_status(self, status):
+        return self._storage._select("WHERE status = ?", (status.value,), conn=self._conn)
+
+    def children_of(self, parent_allocation_id):
+        return self._storage._select(
+            "WHERE parent_allocation_id = ?", (parent_allocation_id,), conn=self._conn)
+
+    def student_emails(self):
+        rows = self._conn.execute("SELECT DISTINCT student_email FROM allocations")
+        return {email for (email,) in rows}
+
+    def existing_emails(self, emails):
+        # goes through the student_email index in chunks, sqlite caps the
+        # number of ? placeholders per query
+        emails = list(emails)
+        found = set()
+        for start in range(0, len(emails), 500):
+            chunk = emails[start:start + 500]
+            rows = self._conn.execute(
+                "SELECT DISTINCT student_email FROM allocations WHERE student_email IN "
+                f"({', '.join('?' * len(chunk))})", chunk)
+            found.update(email for (email,) in rows)
+        return found
+
+    def add(self, allocation, event='create'):
+        self._storage._upsert(self._conn, [allocation])
+
+    def add_many(self, allocations, event='create'):
+        self._storage._upsert(self._conn, allocations)
+
+    def update(self, allocation, fields=None, event='update'):
+        self._storage._upsert(self._conn, [allocation])
+
+    def remove(self, allocation_id, event='remove'):
+        allocation = self.get(allocation_id)
+        self._conn.execute("DELETE FROM allocations WHERE id = ?", (allocation_id,))
+        return allocation
+
+# sql versions of repository.sort_key, over the json in the data column
+_SORT_EXPRESSIONS = {
+    field: f"COALESCE(json_extract(data, '$.{field}'), '')" for field in SORT_FIELDS
+}
+_SORT_EXPRESSIONS['student_name'] = "lower(COALESCE(json_extract(data, '$.student_name'), ''))"
+
+class SQLiteStorage(AllocationStorage):
+    """
+    keeps each allocation in its own row of a sqlite db (WAL mode)
+    the columns we search on get pulled out + indexed, the full record
+    lives in the data column as json
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS allocations (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            student_email TEXT,
+            parent_allocation_id TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_allocations_status ON allocations(status);
+        CREATE INDEX IF NOT EXISTS idx_allocations_student_email ON allocations(student_email);
+        CREATE INDEX IF NOT EXISTS idx_allocations_parent ON allocations(parent_allocation_id);
+    """ + ''.join(
+        # one per sort field, so a page is a seek + a short walk along the index
+        f"CREATE INDEX IF NOT EXISTS idx_allocations_status_{field} "
+        f"ON allocations(status, {_SORT_EXPRESSIONS[field]}, id);"
+        for field in SORT_FIELDS)
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.lock_path = path + '.lock'
+        # sqlite connections can't be shared between threads, so one each
+        self._connections = threading.local()
+
+        conn = self._connection()
+        conn.executescript(self.SCHEMA)
+        conn.commit()
+
+    def _connection(self):
+        """get (or open) the connection for this thread"""
+        conn = getattr(self._connections, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            # WAL lets readers carry on while someone is writing
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._connections.conn = conn
+        return conn
+
+    def _row(self, allocation):
+        """turn an allocation into the values for one table row"""
+        return (
+            allocation.id,
+            allocation.status.value,
+            allocation.student_email,
+            allocation.parent_allocation_id,
+            codec.dumps(allocation.to_dict()).decode('utf-8')
+        )
+
+    def _select(self, where='', params=(), conn=None):
+        """run a select and turn the rows back into allocations"""
+        rows = (conn or self._connection()).execute(
+            f"SELECT data FROM allocations {where} ORDER BY rowid", params)
+        return [Allocation.from_dict(codec.loads(data)) for (data,) in rows]
+
+    def _upsert(self, conn, allocations):
+        # upsert keeps the rowid, so list order doesn't shuffle on updates
+        conn.executemany(
+            "INSERT INTO allocations (id, status, student_email, parent_allocation_id, data) "
+            "VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET status = excluded.status, "
+            "student_email = excluded.student_email, "
+            "parent_allocation_id = excluded.parent_allocation_id, "
+            "data = excluded.data",
+            [self._row(a) for a in allocations])
+
+    @contextmanager
+    def transaction(self):
+        """
+        BEGIN IMMEDIATE grabs sqlite's write lock up front, so two workers
+        can't both read-modify-write the same rows. the lock file is held
+        too, so after_commit callbacks still run with other writers kept out
+        """
+        current = getattr(self._local, 'transaction', None)
+        if current is not None:
+            yield current
+            return
+
+        with _locked(self.lock_path):
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            session = _SQLiteSession(self, conn)
+            self._local.transaction = session
+            self._local.after_commit = callbacks = []
+            try:
+                yield session
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._local.transaction = None
+                self._local.after_commit = None
+            for callback in callbacks:
+                callback()
+
+    def load_all(self):
+        return self._select()
+
+    def save_all(self, allocations):
+        """replace the whole table with this list"""
+        with self.transaction() as session:
+            session._conn.execute("DELETE FROM allocations")
+            self._upsert(session._conn, allocations)
+
+    def get(self, allocation_id):
+        found = self._select("WHERE id = ?", (allocation_id,))
+        return found[0] if found else None
+
+    def find_by_status(self, status):
+        return self._select("WHERE status = ?", (status.value,))
+
+    def find_by_parent(self, parent_allocation_id):
+        return self._select("WHERE parent_allocation_id = ?", (parent_allocation_id,))
+
+    def student_emails(self):
+        rows = self._connection().execute(
+            "SELECT DISTINCT student_email FROM allocations")
+        return {email for (email,) in rows}
+
+    def page(self, status=None, sort='date_created', descending=False,
+             after=None, limit=25, search=None):
+        expression = _SORT_EXPRESSIONS[sort]
+        conditions, params = [], []
+        if status is not None:
+            conditions.append("status = ?")
+            params.append(status.value)
+        if after is not None:
+            # keyset - carry on from the last key instead of OFFSET-ing past rows
+            conditions.append(f"({expression}, id) {'<' if descending else '>'} (?, ?)")
+            params.extend(after)
+        if search:
+            pattern = '%' + search.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            conditions.append(
+                "(lower(json_extract(data, '$.student_name')) LIKE ? ESCAPE '\\' "
+                "OR lower(json_extract(data, '$.subjects')) LIKE ? ESCAPE '\\' "
+                "OR lower(json_extract(data, '$.current_subject')) LIKE ? ESCAPE '\\')")
+            params.extend([pattern] * 3)
+
+        order = 'DESC' if descending else 'ASC'
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        rows = self._connection().execute(
+            f"SELECT data FROM allocations {where} "
+            f"ORDER BY {expression} {order}, id {order} LIMIT ?", (*params, limit + 1))
+        found = [Allocation.from_dict(codec.loads(data)) for (data,) in rows]
+        return found[:limit], len(found) > limit
+
+def atomic_write_json(path, data):
+    """
+    write json to a temp file next to path, fsync it, then swap it in -
+    readers see either the old file or the new one, never half of one
+    """
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(codec.dumps(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def create_storage(data_dir, backend=None):
+    """
+    pick a storage backend - json (default), journal or sqlite
+    can be set with the ALLOCATION_STORAGE env var
+    """
+    backend = (backend or os.getenv('ALLOCATION_STORAGE', 'json')).lower()
+
+    if backend == 'json':
+        return JsonStorage(os.path.join(data_dir, 'allocations.json'))
+    if backend == 'journal':
+        return JournalStorage(os.path.join(data_dir, 'allocations.json'))
+    if backend == 'sqlite':
+        return SQLiteStorage(os.path.join(data_dir, 'allocations.db'))
+
+    raise ValueError(f"unknown allocation storage backend: {backend}")
+
+def migrate_json_to_sqlite(json_path, db_path):
+    """
+    copy everything from an old allocations.json into a sqlite db
+    safe to run more than once - rows get upserted by id
+    returns how many allocations we copied
+    """
+    allocations = JsonStorage(json_path).load_all()
+    SQLiteStorage(db_path).put_many(allocations)
+    return len(allocations)
@@ -0,0 +1,118 @@
+import os
+import json
+import threading
+import numpy as np
+from .schedule import BITMAP_WORDS, teacher_bitmap
+
+class TeacherCatalogue:
+    """
+    every teacher from a teachers json file, loaded once with indexes on top:
+    - id -> teacher
+    - subject -> ids of the teachers who teach it
+    - a weekly availability bitmap per teacher (see schedule.py), as one
+      (teachers x words) numpy array so matching can score them all at once
+    checks the file's mtime/size on each use and reloads if it changed
+    the teacher dicts are shared, so copy before changing them
+    """
+    def __init__(self, path):
+        self.path = path
+        self.version = 0  # goes up every time we (re)load
+        self._signature = None
+        # (id -> teacher, subject -> ids, id -> bitmap row, bitmaps) - one
+        # tuple so a reload swaps everything
+        self._indexes = ({}, {}, {}, np.zeros((0, BITMAP_WORDS), dtype=np.uint64))
+        self._lock = threading.Lock()
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def refresh(self):
+        """reload if the file changed - returns True if it did"""
+        signature = self._file_signature()
+        if signature == self._signature:
+            return False
+
+        with self._lock:
+            if signature == self._signature:
+                return False
+            self._load(signature)
+            return True
+
+    def _load(self, signature):
+        try:
+            with open(self.path, 'r') as f:
+                teachers = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            teachers = []
+
+        by_id = {}
+        by_subject = {}
+        for teacher in teachers:
+            by_id[teacher['id']] = teacher
+            for subject in teacher.get('subjects', []):
+                by_subject.setdefault(subject, []).append(teacher['id'])
+
+        row_of = {teacher_id: row for row, teacher_id in enumerate(by_id)}
+        bitmaps = np.zeros((len(by_id), BITMAP_WORDS), dtype=np.uint64)
+        for row, teacher in enumerate(by_id.values()):
+            bitmaps[row] = teacher_bitmap(teacher.get('availability'))
+
+        # swap everything in at once so readers never see half a reload
+        self._indexes = (by_id, by_subject, row_of, bitmaps)
+        self._signature = signature
+        self.version += 1
+
+    def __len__(self):
+        self.refresh()
+        return len(self._indexes[0])
+
+    def all(self):
+        """every teacher, in file order"""
+        self.refresh()
+        return list(self._indexes[0].values())
+
+    def get(self, teacher_id):
+        """one teacher by id (or None)"""
+        self.refresh()
+        return self._indexes[0].get(teacher_id)
+
+    def get_many(self, teacher_ids):
+        """a list of teachers (None where we don't have one) - one freshness check for the lot"""
+        self.refresh()
+        by_id = self._indexes[0]
+        return [by_id.get(teacher_id) for teacher_id in teacher_ids]
+
+    def for_subject(self, subject):
+        """the teachers who teach this subject, in file order"""
+        self.refresh()
+        by_id, by_subject = self._indexes[:2]
+        return [by_id[teacher_id] for teacher_id in by_subject.get(subject, [])]
+
+    def availability_bitmaps(self, teacher_ids):
+        """
+        the precomputed availability bitmaps for these teachers, one row each
+        (all zeros for ids we don't have)
+        """
+        self.refresh()
+        _, _, row_of, bitmaps = self._indexes
+        rows = np.array([row_of.get(teacher_id, -1) for teacher_id in teacher_ids], dtype=np.intp)
+        result = bitmaps[np.maximum(rows, 0)] if len(bitmaps) else np.zeros(
+            (len(rows), BITMAP_WORDS), dtype=np.uint64)
+        result[rows < 0] = 0
+        return result
+
+# one catalogue per file for the whole process
+_catalogues = {}
+_catalogues_lock = threading.Lock()
+
+def get_catalogue(path):
+    """the shared catalogue for this teachers file"""
+    key = os.path.abspath(path)
+    with _catalogues_lock:
+        if key not in _catalogues:
+            _catalogues[key] = TeacherCatalogue(path)
+        return _catalogues[key]
@@ -1,19 +1,34 @@
+from .api_cache import TTLCache
 from .crimson_api import CrimsonAPI
+from .batch_matcher import plan_assignments, teacher_capacity
+from .schedule import (schedule_compatibility, student_bitmap, teacher_bitmap,
+                       bitmap_compatibility, default_timezone)
 import os
+import heapq
+import numpy as np
 
 class TeacherMatcher:
     """
     finds the best teachers for each student based on a bunch of factors
     """
-    def __init__(self):
-        self.crimson_api = CrimsonAPI(
+    def __init__(self, crimson_api=None):
+        # hand in the app's client so an invitation clearing its cache is
+        # seen here too, instead of us keeping a separate (stale) copy
+        self.crimson_api = crimson_api or CrimsonAPI(
             api_key=os.getenv('CRIMSON_APP_API_KEY', 'test_key')
         )
+        
+        # scores we've already worked out, by (allocation key, teacher id,
+        # teacher version) - a score never changes for the same inputs, so
+        # entries don't expire, they just get dropped when the catalogue reloads
+        self.score_cache = TTLCache(max_entries=int(os.getenv('MATCH_SCORE_CACHE_SIZE', 100000)))
+        self._catalogue_version = None
     
-    def find_matching_teachers(self, allocation):
+    def find_matching_teachers(self, allocation, k=None):
         """
         looks for teachers that match this allocation
-        gives back a list with all their info + scores
+        gives back a list with all their info + scores, best first
+        k = only the best k (much cheaper when there are lots of teachers)
         """
         # figure out which subject we need
         subject = allocation.current_subject
@@ -26,13 +41,45 @@ class TeacherMatcher:
         # ask the API for available teachers
         available_teachers = self.crimson_api.get_available_teachers(subject)
         
-        # rate each teacher with our algorithm
-        scored_teachers = self._score_teachers(available_teachers, allocation)
+        # up to date student counts for all of them in one go
+        workloads = self.get_teachers_workload([teacher['id'] for teacher in available_teachers])
+        available_teachers = self._with_workloads(available_teachers, workloads)
         
-        # best matches first
-        scored_teachers.sort(key=lambda t: t['score'], reverse=True)
+        if k is not None:
+            return self._top_k_teachers(available_teachers, allocation, k)
         
-        return scored_teachers
+        # rate each teacher with our algorithm - comes back best matches first
+        return self._score_teachers_vectorized(available_teachers, allocation)
+    
+    def plan_allocations(self, allocations):
+        """
+        matches a whole batch of allocations at once, so the best teachers
+        don't all get handed to everyone - finds the assignment with the
+        best total score where nobody gets more new students than their
+        workload says they have room for (see batch_matcher.py)
+        gives back {allocation_id: {'id': teacher_id, 'score': score}}
+        """
+        teachers = {}
+        for subject in {allocation.current_subject or (allocation.subjects or [None])[0]
+                        for allocation in allocations} - {None}:
+            for teacher in self.crimson_api.get_available_teachers(subject) or []:
+                teachers.setdefault(teacher['id'], teacher)
+        
+        workloads = self.get_teachers_workload(list(teachers))
+        teachers = self._with_workloads(list(teachers.values()), workloads)
+        capacities = {teacher_id: teacher_capacity(workload)
+                      for teacher_id, workload in workloads.items()}
+        
+        return plan_assignments(allocations, teachers, capacities,
+                                self._teacher_bitmaps(teachers))
+    
+    def _with_workloads(self, teachers, workloads):
+        """copies of the teachers with their live student counts (where we got one)"""
+        return [
+            dict(teacher, active_students=workloads[teacher['id']]['active_students'])
+            if workloads.get(teacher['id']) else teacher
+            for teacher in teachers
+        ]
     
     def _score_teachers(self, teachers, allocation):
         """
@@ -41,10 +88,15 @@ class TeacherMatcher:
         - how good they are at this subject
         - if their schedule works with the student
         - ratings from past students
+        one teacher at a time - this is the reference version,
+        _score_teachers_vectorized has to give exactly the same scores
         """
         scored_teachers = []
         
-        for teacher in teachers:
+        # schedule overlap for everyone at once
+        compatibilities = self._schedule_compatibilities(teachers, allocation).tolist()
+        
+        for teacher, compatibility in zip(teachers, compatibilities):
             score = 100  # start at 100pts
             
             # too many students = bad
@@ -61,10 +113,6 @@ class TeacherMatcher:
             score += (subject_expertise - 3) * 5  # -10 to +10 pts
             
             # can they actually meet when the student is free?
-            compatibility = self._calculate_schedule_compatibility(
-                teacher.get('availability', {}),
-                allocation.student_availability
-            )
             score += compatibility * 20  # 0 to 20 pts
             
             # past ratings (1-5 scale)
@@ -78,19 +126,227 @@ class TeacherMatcher:
         
         return scored_teachers
     
+    def _score_teachers_vectorized(self, teachers, allocation, k=None):
+        """
+        same scoring as _score_teachers, but on numpy columns for the whole
+        candidate list at once. gives back the best k (all of them if k is
+        None), best first - ties keep the order they came in, like a stable
+        sort - and only those k teacher dicts get copied
+        """
+        if not teachers:
+            return []
+        
+        count = len(teachers)
+        rounded = self._scores(teachers, allocation)
+        
+        if k is not None and k < count:
+            # everything strictly better than the k-th best, then the earliest
+            # of the ones tied with it
+            kth_best = rounded[np.argpartition(-rounded, k - 1)[k - 1]]
+            better = np.flatnonzero(rounded > kth_best)
+            tied = np.flatnonzero(rounded == kth_best)[:k - len(better)]
+            top = np.concatenate([better, tied])
+        else:
+            top = np.arange(count)
+        top = top[np.lexsort((top, -rounded[top]))]
+        
+        return [dict(teachers[i], score=rounded[i].item()) for i in top.tolist()]
+    
+    def _scores(self, teachers, allocation):
+        """
+        rounded scores for all these teachers, from the score cache where we
+        can - only the ones we haven't seen (or that changed) get computed
+        """
+        keys = self._score_keys(teachers, allocation)
+        scores = np.empty(len(teachers))
+        missing = []
+        for i, key in enumerate(keys):
+            entry, fresh = self.score_cache.lookup(key)
+            if fresh:
+                scores[i] = entry.value
+            else:
+                missing.append(i)
+        
+        if missing:
+            computed = self._compute_scores([teachers[i] for i in missing], allocation)
+            scores[missing] = computed
+            for i, score in zip(missing, computed.tolist()):
+                self.score_cache.store(keys[i], score, float('inf'))
+        return scores
+    
+    def _score_keys(self, teachers, allocation):
+        """score cache keys for these teachers"""
+        self._check_catalogue_version()
+        allocation_key = self._allocation_key(allocation)
+        return [(allocation_key, teacher.get('id'), self._teacher_version(teacher))
+                for teacher in teachers]
+    
+    def _check_catalogue_version(self):
+        """drop every cached score if the teacher catalogue got reloaded"""
+        catalogue = self.crimson_api.teacher_catalogue
+        catalogue.refresh()
+        if catalogue.version != self._catalogue_version:
+            self.score_cache.clear()
+            self._catalogue_version = catalogue.version
+    
+    def _allocation_key(self, allocation):
+        """everything about the allocation that goes into a score"""
+        subject = allocation.current_subject or (allocation.subjects or [None])[0]
+        return (subject, allocation.student_availability, default_timezone())
+    
+    def _teacher_version(self, teacher):
+        """
+        the teacher's version/etag if the api gives one, otherwise the fields
+        that go into the score. the live student count is always in there -
+        it gets patched over the record (see _with_workloads), so the
+        record's version doesn't change when it does
+        """
+        version = teacher.get('version') or teacher.get('etag')
+        if version is not None:
+            return (version, teacher.get('active_students', 0))
+        availability = teacher.get('availability') or {}
+        return (
+            teacher.get('active_students', 0), teacher.get('subject_expertise', 3),
+            teacher.get('average_rating', 4.0), tuple(availability.get('weekdays', ())),
+            tuple(availability.get('time_slots', ())), availability.get('timezone')
+        )
+    
+    def _compute_scores(self, teachers, allocation):
+        """the numpy scoring behind _score_teachers_vectorized -> rounded scores"""
+        count = len(teachers)
+        student_counts = np.fromiter(
+            (teacher.get('active_students', 0) for teacher in teachers), dtype=float, count=count)
+        expertise = np.fromiter(
+            (teacher.get('subject_expertise', 3) for teacher in teachers), dtype=float, count=count)
+        ratings = np.fromiter(
+            (teacher.get('average_rating', 4.0) for teacher in teachers), dtype=float, count=count)
+        compatibilities = self._schedule_compatibilities(teachers, allocation)
+        
+        # same terms added in the same order as the scalar version, so the
+        # floats come out bit for bit the same
+        scores = 100 + np.select(
+            [student_counts > 30, student_counts > 20, student_counts < 10],
+            [-20, -10, 10], default=0)
+        scores = scores + (expertise - 3) * 5
+        scores = scores + compatibilities * 20
+        scores = scores + (ratings - 4.0) * 10
+        # python's round (not np.round) so the 2dp scores match exactly
+        return np.array([round(score, 2) for score in scores.tolist()])
+    
+    def _top_k_teachers(self, teachers, allocation, k):
+        """
+        the best k teachers, without scoring everyone:
+        - everything except the schedule is cheap, and the schedule is worth
+          at most 20pts, so that gives an upper bound for each teacher
+        - go through them best upper bound first, keeping the k best so far
+          in a heap, and stop once nobody left could beat the k-th best
+        same scores + order as _score_teachers_vectorized(..., k=k)
+        """
+        if k <= 0 or not teachers:
+            return []
+        
+        # (workload + expertise, rating) points for everyone - cheap
+        partial_scores = [self._score_without_schedule(teacher) for teacher in teachers]
+        upper_bounds = [base + 20 + rating for base, rating in partial_scores]
+        # best upper bound first, input order between equals
+        order = sorted(range(len(teachers)), key=lambda i: -upper_bounds[i])
+        
+        catalogue = self.crimson_api.teacher_catalogue
+        teacher_ids = [teacher.get('id') for teacher in teachers]
+        known_teachers = catalogue.get_many(teacher_ids)
+        known_bitmaps = catalogue.availability_bitmaps(teacher_ids)
+        zone = default_timezone()
+        student = student_bitmap(allocation.student_availability)
+        self._check_catalogue_version()
+        allocation_key = self._allocation_key(allocation)
+        heap = []  # (score, -position, position) - worst of the k best on top
+        
+        for i in order:
+            # can't beat the k-th best, and nobody after can either (a tie
+            # still gets looked at - it wins if it came first in the list)
+            if len(heap) == k and round(upper_bounds[i], 2) < heap[0][0]:
+                break
+            
+            teacher, known = teachers[i], known_teachers[i]
+            key = (allocation_key, teacher.get('id'), self._teacher_version(teacher))
+            cached, fresh = self.score_cache.lookup(key)
+            if fresh:
+                score = cached.value
+            else:
+                if known is teacher or (
+                        known is not None and known.get('availability') == teacher.get('availability')):
+                    bitmap = known_bitmaps[i]
+                else:
+                    bitmap = teacher_bitmap(teacher.get('availability'), zone)
+                compatibility = bitmap_compatibility(bitmap, student)[0].item()
+                
+                base, rating = partial_scores[i]
+                score = round(base + compatibility * 20 + rating, 2)
+                self.score_cache.store(key, score, float('inf'))
+            
+            entry = (score, -i, i)
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+        
+        best = sorted(heap, reverse=True)
+        return [dict(teachers[i], score=score) for score, _, i in best]
+    
+    def _score_without_schedule(self, teacher):
+        """
+        (workload + expertise points, rating points) - the score minus the
+        schedule part, kept apart so adding it all up happens in the same
+        order as _score_teachers (and gives the exact same float)
+        """
+        score = 100
+        student_count = teacher.get('active_students', 0)
+        if student_count > 30:
+            score -= 20
+        elif student_count > 20:
+            score -= 10
+        elif student_count < 10:
+            score += 10
+        score += (teacher.get('subject_expertise', 3) - 3) * 5
+        return score, (teacher.get('average_rating', 4.0) - 4.0) * 10
+    
+    def _schedule_compatibilities(self, teachers, allocation):
+        """
+        schedule compatibility (0-1) for every teacher, in one vectorized
+        AND + popcount over their weekly availability bitmaps
+        """
+        return bitmap_compatibility(self._teacher_bitmaps(teachers),
+                                    student_bitmap(allocation.student_availability))
+    
+    def _teacher_bitmaps(self, teachers):
+        """
+        weekly availability bitmaps for these teachers, one row each
+        catalogue teachers have theirs precomputed, anyone else gets built here
+        """
+        catalogue = self.crimson_api.teacher_catalogue
+        teacher_ids = [teacher.get('id') for teacher in teachers]
+        bitmaps = catalogue.availability_bitmaps(teacher_ids)
+        zone = default_timezone()
+        for row, (teacher, known) in enumerate(zip(teachers, catalogue.get_many(teacher_ids))):
+            if known is not teacher and (
+                    known is None or known.get('availability') != teacher.get('availability')):
+                bitmaps[row] = teacher_bitmap(teacher.get('availability'), zone)
+        return bitmaps
+    
     def _calculate_schedule_compatibility(self, teacher_availability, student_availability):
         """
         checks how well schedules line up
         returns 0 (no overlap) to 1 (perfect match)
+        both sides get turned into UTC weekly time intervals (see schedule.py)
+        so different timezones line up properly
+        (one teacher at a time - _schedule_compatibilities does the lot)
         """
-        # super simplified for now
-        # in real life we'd parse the text and compare time slots
-        
-        # just random for demo purposes
-        # TODO: actually implement proper schedule parsing & matching
-        import random
-        return random.uniform(0.5, 1.0)
+        return schedule_compatibility(teacher_availability, student_availability)
     
     def get_teacher_workload(self, teacher_id):
         """check how busy this teacher is"""
-        return self.crimson_api.get_teacher_workload(teacher_id) 
\ No newline at end of file
+        return self.crimson_api.get_teacher_workload(teacher_id)
+    
+    def get_teachers_workload(self, teacher_ids):
+        """how busy a bunch of teachers are -> {teacher_id: workload}"""
+        return self.crimson_api.get_teachers_workload(teacher_ids)
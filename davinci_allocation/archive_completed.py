@@ -0,0 +1,11 @@
+import sys
+from app.data_processor import DataProcessor
+
+def archive(data_dir='data', days=None):
+    """Move allocations completed more than `days` ago into data/archive/"""
+    count = DataProcessor(data_dir=data_dir).archive_completed(days)
+    print(f"Archived {count} completed allocations")
+
+if __name__ == "__main__":
+    archive(sys.argv[1] if len(sys.argv) > 1 else 'data',
+            int(sys.argv[2]) if len(sys.argv) > 2 else None)
@@ -0,0 +1,19 @@
+import os
+import sys
+from app.storage import migrate_json_to_sqlite
+
+def migrate(data_dir='data'):
+    """Copy data/allocations.json into data/allocations.db"""
+    json_path = os.path.join(data_dir, 'allocations.json')
+    db_path = os.path.join(data_dir, 'allocations.db')
+    
+    if not os.path.exists(json_path):
+        print(f"Nothing to migrate - {json_path} doesn't exist")
+        return
+    
+    count = migrate_json_to_sqlite(json_path, db_path)
+    print(f"Copied {count} allocations into {db_path}")
+    print("Set ALLOCATION_STORAGE=sqlite in your .env file to start using it")
+
+if __name__ == "__main__":
+    migrate(sys.argv[1] if len(sys.argv) > 1 else 'data')
@@ -0,0 +1,12 @@
+import sys
+from app.data_processor import DataProcessor
+
+def rebuild(data_dir='data'):
+    """Recount data/statistics.json from every allocation"""
+    stats = DataProcessor(data_dir=data_dir).rebuild_statistics().summary()
+    print(f"Rebuilt statistics for {stats['total_allocations']} allocations "
+          f"({stats['pending_allocations']} pending, {stats['in_progress_allocations']} in progress, "
+          f"{stats['completed_allocations']} completed)")
+
+if __name__ == "__main__":
+    rebuild(sys.argv[1] if len(sys.argv) > 1 else 'data')
@@ -1,11 +1,37 @@
+import asyncio
 import os
+import importlib.util
+import json
 import sys
+import sqlite3
+import tempfile
+import threading
+import time
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+import pandas as pd
 import unittest
 from app.models import Allocation, AllocationStatus
 from app.data_processor import DataProcessor
-from app.teacher_matcher import TeacherMatcher
+from app.teacher_matcher_algorithm import TeacherMatcher
 from app.email_service import EmailService
 from app.crimson_api import CrimsonAPI
+from app.api_cache import TTLCache
+from app.crimson_api_async import AsyncCrimsonAPI
+from app import codec
+from app.job_forms import read_job_forms
+from app.repository import AllocationRepository
+from app.teacher_catalogue import TeacherCatalogue
+from app import schedule, batch_matcher
+from app.analytics import QuantileSketch, AllocationAnalytics
+from app.job_queue import JobQueue
+from app.jobs import AllocationJobs
+from app.storage import (SQLiteStorage, JsonStorage, JournalStorage, atomic_write_json,
+                         migrate_json_to_sqlite)
 from dotenv import load_dotenv
 
 # grab our env vars
@@ -33,6 +59,8 @@ class TestDaVinciAllocationSystem(unittest.TestCase):
         allocations_file = os.path.join(self.test_data_dir, 'allocations.json')
         if os.path.exists(allocations_file):
             os.remove(allocations_file)
+        if os.path.exists(self.data_processor.statistics_file):
+            os.remove(self.data_processor.statistics_file)
     
     def test_allocation_creation(self):
         """make sure we can create an allocation properly"""
@@ -183,5 +211,1950 @@ class TestDaVinciAllocationSystem(unittest.TestCase):
         # should get something back
         self.assertIsNotNone(teachers)
 
+
+def make_test_allocation(**overrides):
+    """quick helper so the newer tests don't repeat the whole constructor"""
+    fields = dict(
+        student_name="Test Student",
+        student_email="test@example.com",
+        guardian_email="parent@example.com",
+        request_email="ao@cga.edu",
+        subjects=["Math", "English"],
+        start_date="2023-01-01",
+        package_hours=20,
+        session_frequency="2 times per week",
+        student_availability="Weekdays 4-8pm",
+        holiday_schedule="Dec 24-Jan 2",
+        additional_notes="Test notes"
+    )
+    fields.update(overrides)
+    return Allocation(**fields)
+
+class TestSQLiteStorage(unittest.TestCase):
+    """test the sqlite storage backend"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.storage = SQLiteStorage(os.path.join(self.tmp.name, 'allocations.db'))
+        self.data_processor = DataProcessor(data_dir=self.tmp.name, storage=self.storage)
+    
+    def tearDown(self):
+        self.tmp.cleanup()
+    
+    def test_point_lookups_and_updates(self):
+        """single allocations can be found + updated without a full rewrite"""
+        first = make_test_allocation(student_email="a@example.com")
+        second = make_test_allocation(student_email="b@example.com")
+        self.storage.put_many([first, second])
+        
+        self.data_processor.mark_as_in_progress(second.id, "Test Staff")
+        
+        loaded = self.data_processor.get_allocation_by_id(second.id)
+        self.assertEqual(loaded.status, AllocationStatus.IN_PROGRESS)
+        self.assertEqual(loaded.staff_member, "Test Staff")
+        self.assertEqual([a.id for a in self.data_processor.get_pending_allocations()], [first.id])
+        self.assertEqual(self.storage.student_emails(), {"a@example.com", "b@example.com"})
+        with self.storage.transaction() as repo:
+            self.assertEqual(repo.existing_emails(["b@example.com", "c@example.com"]), {"b@example.com"})
+        
+        # updates shouldn't shuffle the order things were added in
+        self.assertEqual([a.id for a in self.storage.load_all()], [first.id, second.id])
+    
+    def test_split_subjects(self):
+        """kids can be found by their parent id"""
+        allocation = make_test_allocation()
+        self.storage.put(allocation)
+        
+        child_ids = self.data_processor.split_subjects(allocation.id)
+        
+        children = self.storage.find_by_parent(allocation.id)
+        self.assertEqual(sorted(c.id for c in children), sorted(child_ids))
+        self.assertEqual(self.storage.get(allocation.id).status, AllocationStatus.COMPLETED)
+    
+    def test_migration_from_json(self):
+        """old allocations.json files can be copied into sqlite"""
+        json_path = os.path.join(self.tmp.name, 'old.json')
+        allocations = [make_test_allocation(student_email=f"{i}@example.com") for i in range(3)]
+        JsonStorage(json_path).save_all(allocations)
+        
+        db_path = os.path.join(self.tmp.name, 'migrated.db')
+        self.assertEqual(migrate_json_to_sqlite(json_path, db_path), 3)
+        # running it again shouldn't duplicate anything
+        migrate_json_to_sqlite(json_path, db_path)
+        
+        migrated = SQLiteStorage(db_path).load_all()
+        self.assertEqual([a.id for a in migrated], [a.id for a in allocations])
+
+class TestAllocationCache(unittest.TestCase):
+    """test the in-memory cache in front of allocations.json"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data_processor = DataProcessor(data_dir=self.tmp.name)
+    
+    def tearDown(self):
+        self.tmp.cleanup()
+    
+    def test_cache_hits_reuse_parsed_allocations(self):
+        """reading twice without changes shouldn't parse the file again"""
+        allocation = make_test_allocation()
+        self.data_processor._save_allocations([allocation])
+        
+        first = self.data_processor.get_pending_allocations()
+        second = self.data_processor.get_pending_allocations()
+        self.assertIs(first[0], second[0])
+        
+        # mutators keep the cache up to date too
+        self.data_processor.mark_as_in_progress(allocation.id, "Test Staff")
+        self.assertIs(self.data_processor.get_in_progress_allocations()[0], first[0])
+    
+    def test_cache_notices_outside_changes(self):
+        """somebody else writing the file should throw our cached copy away"""
+        allocation = make_test_allocation()
+        self.data_processor._save_allocations([allocation])
+        self.data_processor.get_pending_allocations()
+        
+        # another process (well, another storage object) rewrites the file
+        other = make_test_allocation(student_email="other@example.com")
+        data = [allocation.to_dict(), other.to_dict()]
+        with open(self.data_processor.allocations_file, 'w') as f:
+            json.dump(data, f)
+        
+        ids = [a.id for a in self.data_processor.get_pending_allocations()]
+        self.assertEqual(ids, [allocation.id, other.id])
+
+class TestAllocationRepository(unittest.TestCase):
+    """test the indexes kept by the allocation repository"""
+    
+    def test_status_buckets_follow_changes(self):
+        """changing status moves allocations between buckets, keeping order"""
+        allocations = [make_test_allocation(student_email=f"{i}@example.com") for i in range(3)]
+        repo = AllocationRepository(allocations)
+        
+        allocations[0].status = AllocationStatus.IN_PROGRESS
+        repo.update(allocations[0])
+        self.assertEqual(repo.by_status(AllocationStatus.PENDING), allocations[1:])
+        
+        # moving it back should put it back at the front
+        allocations[0].status = AllocationStatus.PENDING
+        repo.update(allocations[0])
+        self.assertEqual(repo.by_status(AllocationStatus.PENDING), allocations)
+        self.assertEqual(repo.by_status(AllocationStatus.IN_PROGRESS), [])
+        self.assertIs(repo.get(allocations[2].id), allocations[2])
+    
+    def test_email_index(self):
+        """the email index keeps up with adds, changes and removals"""
+        allocation = make_test_allocation(student_email="a@example.com")
+        repo = AllocationRepository([allocation, make_test_allocation(student_email="b@example.com")])
+        self.assertEqual(repo.existing_emails(["a@example.com", "c@example.com"]), {"a@example.com"})
+        
+        allocation.student_email = "c@example.com"
+        repo.update(allocation)
+        self.assertEqual(repo.student_emails(), {"b@example.com", "c@example.com"})
+        
+        repo.remove(allocation.id)
+        self.assertEqual(repo.existing_emails(["c@example.com"]), set())
+    
+    def test_children_index(self):
+        """kids are found through their parent id"""
+        parent = make_test_allocation()
+        child = make_test_allocation()
+        child.parent_allocation_id = parent.id
+        repo = AllocationRepository([parent, child])
+        
+        self.assertEqual(repo.children_of(parent.id), [child])
+        
+        repo.remove(child.id)
+        self.assertEqual(repo.children_of(parent.id), [])
+        self.assertEqual(len(repo), 1)
+
+    def test_sorted_keys_follow_changes(self):
+        """paging lists are patched in place - ones the change doesn't touch are left alone"""
+        allocations = [make_test_allocation(student_email=f"{i}@example.com") for i in range(6)]
+        for i, allocation in enumerate(allocations):
+            allocation.student_name = f"Student {5 - i}"
+            allocation.date_created = datetime(2024, 1, 1 + i)
+        allocations[5].status = AllocationStatus.COMPLETED
+        repo = AllocationRepository(allocations)
+        built = [(status, field) for status in (None, *AllocationStatus)
+                 for field in ('date_created', 'student_name')]
+        for status, field in built:
+            repo.page(status=status, sort=field)
+        completed = repo._sorted[(AllocationStatus.COMPLETED, 'date_created')]
+
+        allocations[0].status = AllocationStatus.IN_PROGRESS
+        allocations[0].student_name = "Aaron"
+        repo.update(allocations[0], fields=['status', 'student_name'])
+        allocations[1].date_created = datetime(2025, 1, 1)
+        repo.update(allocations[1])
+        repo.remove(allocations[2].id)
+        repo.add(make_test_allocation(student_email="new@example.com"))
+
+        self.assertIs(repo._sorted[(AllocationStatus.COMPLETED, 'date_created')], completed)
+        fresh = AllocationRepository(repo.all())
+        for status, field in built:
+            self.assertEqual(repo._sorted[(status, field)], fresh._sorted_keys(status, field))
+
+class TestJournalStorage(unittest.TestCase):
+    """test the append-only journal storage"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'allocations.json')
+        self.storage = JournalStorage(self.path)
+        self.data_processor = DataProcessor(data_dir=self.tmp.name, storage=self.storage)
+    
+    def tearDown(self):
+        self.tmp.cleanup()
+    
+    def reopen(self):
+        """throw away anything cached, like a fresh process starting up"""
+        JournalStorage(self.path).invalidate_cache()
+        return JournalStorage(self.path)
+    
+    def test_mutations_append_events(self):
+        """changes go to the log, not the snapshot, and survive a restart"""
+        allocation = make_test_allocation()
+        self.storage.put(allocation, event='create')
+        self.data_processor.mark_as_in_progress(allocation.id, "Test Staff")
+        self.data_processor.add_invited_teacher(allocation.id, "t001")
+        
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), [])
+        with open(self.storage.log_path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([e['event'] for e in events], ['create', 'status', 'invite'])
+        self.assertEqual(events[2]['set'], {'invited_teachers': ['t001']})
+        
+        reloaded = self.reopen().get(allocation.id)
+        self.assertEqual(reloaded.status, AllocationStatus.IN_PROGRESS)
+        self.assertEqual(reloaded.invited_teachers, ["t001"])
+    
+    def test_torn_last_line_is_ignored(self):
+        """a half-written event from a crash doesn't break startup"""
+        allocation = make_test_allocation()
+        self.storage.put(allocation, event='create')
+        with open(self.storage.log_path, 'a') as f:
+            f.write('{"event": "invite", "id"')
+        
+        storage = self.reopen()
+        self.assertEqual(storage.get(allocation.id).id, allocation.id)
+        
+        # and new events still land on their own line
+        DataProcessor(data_dir=self.tmp.name, storage=storage).add_invited_teacher(allocation.id, "t002")
+        self.assertEqual(self.reopen().get(allocation.id).invited_teachers, ["t002"])
+    
+    def test_compaction_folds_log_into_snapshot(self):
+        """once compacted, the snapshot has everything and the log is empty"""
+        allocation = make_test_allocation()
+        self.storage.put(allocation, event='create')
+        self.data_processor.split_subjects(allocation.id)
+        
+        self.storage.compact()
+        
+        self.assertEqual(os.path.getsize(self.storage.log_path), 0)
+        with open(self.path) as f:
+            self.assertEqual(len(json.load(f)), 3)
+        self.assertEqual(len(self.reopen().find_by_parent(allocation.id)), 2)
+    
+    def test_background_compaction_past_threshold(self):
+        """going over the size limit kicks off compaction by itself"""
+        storage = JournalStorage(self.path, compact_bytes=1)
+        storage.put(make_test_allocation(), event='create')
+        storage._compactor.join(5)
+        self.assertEqual(os.path.getsize(storage.log_path), 0)
+
+    def test_reader_mid_compaction_doesnt_skip_events(self):
+        """another worker reading between the new snapshot and the new log still sees everything"""
+        # a second worker process = its own storage object + its own cache
+        other = JournalStorage(self.path)
+        other_cache = {}
+        def read_as_other():
+            with mock.patch('app.storage._json_cache', other_cache):
+                return other.repository()
+
+        self.storage.put_many([make_test_allocation() for _ in range(3)], event='create')
+        read_as_other()
+
+        write_snapshot = atomic_write_json
+        def write_then_read(*args):
+            write_snapshot(*args)
+            read_as_other()  # ...before the log has been emptied
+        with mock.patch('app.storage.atomic_write_json', side_effect=write_then_read):
+            self.storage.compact()
+
+        self.storage.put_many([make_test_allocation() for _ in range(4)], event='create')
+        self.assertEqual(len(read_as_other()), 7)
+        self.assertEqual(len(self.reopen().load_all()), 7)
+
+class TestTransactions(unittest.TestCase):
+    """test locked read-modify-write on the json store"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data_processor = DataProcessor(data_dir=self.tmp.name)
+        self.allocation = make_test_allocation()
+        self.data_processor._save_allocations([self.allocation])
+    
+    def tearDown(self):
+        self.tmp.cleanup()
+    
+    def test_concurrent_writers_dont_lose_updates(self):
+        """lots of workers inviting at once should all end up saved"""
+        def invite(teacher_id):
+            # separate storage objects, like separate gunicorn workers
+            DataProcessor(data_dir=self.tmp.name).add_invited_teacher(self.allocation.id, teacher_id)
+        
+        threads = [threading.Thread(target=invite, args=(f"t{i:03d}",)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        JsonStorage(self.data_processor.allocations_file).invalidate_cache()
+        invited = self.data_processor.get_allocation_by_id(self.allocation.id).invited_teachers
+        self.assertEqual(sorted(invited), [f"t{i:03d}" for i in range(10)])
+
+    def test_threads_still_locked_out_without_flock(self):
+        """no fcntl (windows) - threads in one process still take turns"""
+        with mock.patch('app.storage.fcntl', None):
+            self.test_concurrent_writers_dont_lose_updates()
+
+    def test_failed_transaction_is_rolled_back(self):
+        """an error halfway through shouldn't save anything"""
+        with self.assertRaises(RuntimeError):
+            with self.data_processor.transaction() as repo:
+                allocation = repo.get(self.allocation.id)
+                allocation.staff_member = "Half Done"
+                repo.update(allocation, fields=('staff_member',))
+                raise RuntimeError("boom")
+        
+        self.assertIsNone(self.data_processor.get_allocation_by_id(self.allocation.id).staff_member)
+        # and no temp files left lying around
+        self.assertFalse(any('.tmp.' in name for name in os.listdir(self.tmp.name)))
+
+class TestStatisticsAggregates(unittest.TestCase):
+    """test the running totals behind /stats"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+    
+    def tearDown(self):
+        self.tmp.cleanup()
+    
+    def assert_stats_match_full_count(self, data_processor):
+        """the running totals should be exactly what a recount gives"""
+        stats = data_processor.get_statistics()
+        recounted = data_processor.rebuild_statistics().summary()
+        self.assertAlmostEqual(stats.pop('avg_completion_time_hours'),
+                               recounted.pop('avg_completion_time_hours'))
+        self.assertEqual(stats, recounted)
+    
+    def run_mutations(self, data_processor):
+        first = make_test_allocation(student_email="a@example.com")
+        second = make_test_allocation(student_email="b@example.com", subjects=["Physics"])
+        third = make_test_allocation(student_email="c@example.com", subjects=["Math"])
+        third.date_created = datetime(2024, 1, 1)
+        data_processor._save_allocations([first, second, third])
+        
+        data_processor.mark_as_in_progress(first.id, "Test Staff")
+        data_processor.split_subjects(first.id)
+        data_processor.mark_as_in_progress(third.id, "Test Staff")
+        data_processor.mark_as_completed(third.id)
+        data_processor.add_invited_teacher(second.id, "t001")
+        return first, second, third
+    
+    def test_totals_follow_every_change(self):
+        """status moves, splits + completions all show up without a recount"""
+        data_processor = DataProcessor(data_dir=self.tmp.name)
+        first, second, third = self.run_mutations(data_processor)
+        
+        with mock.patch.object(data_processor, '_load_allocations',
+                               side_effect=AssertionError("stats shouldn't load everything")):
+            stats = data_processor.get_statistics()
+        
+        # first got split into 2 kids (in progress) + is completed itself
+        self.assertEqual(stats['total_allocations'], 5)
+        self.assertEqual(stats['pending_allocations'], 1)
+        self.assertEqual(stats['in_progress_allocations'], 2)
+        self.assertEqual(stats['completed_allocations'], 2)
+        self.assertEqual(stats['subjects_count'], {"Math": 3, "English": 2, "Physics": 1})
+        # only third has a completion date
+        expected_hours = (data_processor.get_allocation_by_id(third.id).date_completed
+                          - datetime(2024, 1, 1)).total_seconds() / 3600
+        self.assertAlmostEqual(stats['avg_completion_time_hours'], expected_hours, places=3)
+        self.assert_stats_match_full_count(data_processor)
+    
+    def test_sqlite_backend(self):
+        """same totals when the allocations live in sqlite"""
+        storage = SQLiteStorage(os.path.join(self.tmp.name, 'allocations.db'))
+        data_processor = DataProcessor(data_dir=self.tmp.name, storage=storage)
+        self.run_mutations(data_processor)
+        self.assert_stats_match_full_count(data_processor)
+    
+    def test_failed_transaction_leaves_totals_alone(self):
+        """a rolled back change shouldn't count"""
+        data_processor = DataProcessor(data_dir=self.tmp.name)
+        allocation = make_test_allocation()
+        data_processor._save_allocations([allocation])
+        before = data_processor.get_statistics()
+        
+        with self.assertRaises(RuntimeError):
+            with data_processor.transaction() as repo:
+                data_processor._split_subjects(repo, allocation.id)
+                raise RuntimeError("boom")
+        
+        self.assertEqual(data_processor.get_statistics(), before)
+
+    def test_failed_save_leaves_totals_alone(self):
+        """the totals are only written once the store has saved the change"""
+        json_storage = JsonStorage(os.path.join(self.tmp.name, 'allocations.json'))
+        sqlite_storage = SQLiteStorage(os.path.join(self.tmp.name, 'allocations.db'))
+        # sqlite's commit can't be patched on the connection itself, so wrap it
+        conn = mock.Mock(wraps=sqlite_storage._connection())
+        conn.commit.side_effect = sqlite3.OperationalError("disk I/O error")
+        for storage, broken in [(json_storage, mock.patch.object(json_storage, '_commit',
+                                                                 side_effect=OSError("disk full"))),
+                                (sqlite_storage, mock.patch.object(sqlite_storage, '_connection',
+                                                                   return_value=conn))]:
+            with self.subTest(backend=type(storage).__name__):
+                data_processor = DataProcessor(data_dir=self.tmp.name, storage=storage)
+                allocation = make_test_allocation()
+                data_processor._save_allocations([allocation])
+                before = data_processor.get_statistics()
+
+                with broken, self.assertRaises((OSError, sqlite3.Error)):
+                    data_processor.mark_as_in_progress(allocation.id, "Test Staff")
+
+                self.assertEqual(data_processor.get_statistics(), before)
+                self.assert_stats_match_full_count(data_processor)
+
+    def test_missing_or_broken_totals_get_rebuilt(self):
+        """no statistics.json (e.g. an old data dir) -> counted from scratch"""
+        data_processor = DataProcessor(data_dir=self.tmp.name)
+        data_processor._save_allocations([make_test_allocation()])
+        os.remove(data_processor.statistics_file)
+        
+        self.assertEqual(data_processor.get_statistics()['pending_allocations'], 1)
+        self.assertTrue(os.path.exists(data_processor.statistics_file))
+        
+        with open(data_processor.statistics_file, 'w') as f:
+            f.write("{not json")
+        self.assertEqual(data_processor.get_statistics()['total_allocations'], 1)
+
+class TestAnalytics(unittest.TestCase):
+    """test the percentile sketches behind the pipeline timings"""
+    
+    def test_sketch_quantiles_are_close(self):
+        """p50/p90/p99 should land within the sketch's relative accuracy"""
+        values = np.random.default_rng(7).lognormal(mean=3, sigma=1.5, size=20000)
+        sketch = QuantileSketch()
+        for value in values:
+            sketch.add(value)
+        
+        for q in (0.5, 0.9, 0.99):
+            expected = np.quantile(values, q, method='lower')
+            self.assertAlmostEqual(sketch.quantile(q) / expected, 1, delta=0.021)
+        # a few hundred buckets at most, not 20000 values
+        self.assertLess(len(sketch.bins), 400)
+    
+    def test_sketch_values_can_be_taken_back_out(self):
+        """adding then removing leaves the sketch exactly as it was"""
+        sketch = QuantileSketch()
+        for value in (0, 0.5, 3, 40):
+            sketch.add(value)
+        before = sketch.to_dict()
+        
+        sketch.add(12)
+        sketch.add(12, -1)
+        self.assertEqual(sketch.to_dict(), before)
+        self.assertEqual(QuantileSketch.from_dict(before).quantile(0.5), sketch.quantile(0.5))
+    
+    def test_only_recent_weeks_are_kept(self):
+        """the per-week breakdown stays bounded"""
+        analytics = AllocationAnalytics(max_weeks=3)
+        for week in range(10):
+            allocation = make_test_allocation()
+            allocation.staff_member = "Test Staff"
+            allocation.date_created = datetime(2024, 1, 1) + timedelta(weeks=week)
+            allocation.date_started = allocation.date_created + timedelta(days=1)
+            analytics.count(allocation)
+        
+        timings = analytics.summary()['time_to_start']
+        self.assertEqual(list(timings['week']), ['2024-W08', '2024-W09', '2024-W10'])
+        self.assertEqual(timings['overall']['count'], 10)
+        self.assertAlmostEqual(timings['overall']['p50'], 24, delta=0.5)
+        self.assertEqual(timings['staff_member']['Test Staff']['count'], 10)
+    
+    def test_data_processor_keeps_timings_up_to_date(self):
+        """starting/completing allocations shows up in get_statistics"""
+        with tempfile.TemporaryDirectory() as tmp:
+            data_processor = DataProcessor(data_dir=tmp)
+            allocation = make_test_allocation(subjects=["Physics"])
+            allocation.date_created = datetime.now() - timedelta(hours=10)
+            data_processor._save_allocations([allocation])
+            
+            data_processor.mark_as_in_progress(allocation.id, "Test Staff")
+            data_processor.mark_as_in_progress(allocation.id, "Test Staff")  # restarted
+            data_processor.mark_as_completed(allocation.id)
+            
+            analytics = data_processor.get_analytics()
+            self.assertEqual(analytics, data_processor.get_statistics()['analytics'])
+            for metric in ('time_to_start', 'time_to_complete'):
+                timings = analytics[metric]
+                # only counted once even though it was started twice
+                self.assertEqual(timings['overall']['count'], 1)
+                self.assertAlmostEqual(timings['overall']['p99'], 10, delta=0.3)
+                self.assertEqual(list(timings['subject']), ["Physics"])
+                self.assertEqual(list(timings['staff_member']), ["Test Staff"])
+            
+            self.assertEqual(data_processor.rebuild_statistics().summary()['analytics'], analytics)
+
+class TestPaginatedQueries(unittest.TestCase):
+    """test list_allocations paging on each backend"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.allocations = []
+        for i in range(23):
+            allocation = make_test_allocation(
+                student_name=f"Student {i:02d}", student_email=f"{i}@example.com",
+                subjects=["Physics"] if i % 3 == 0 else ["Math", "English"])
+            # a few share a created time, so the id has to break the tie
+            allocation.date_created = datetime(2024, 1, 1) + timedelta(hours=i // 2)
+            if i % 4 == 0:
+                allocation.status = AllocationStatus.COMPLETED
+            self.allocations.append(allocation)
+    
+    def tearDown(self):
+        self.tmp.cleanup()
+    
+    def data_processors(self):
+        """the same allocations in a json, journal + sqlite store"""
+        backends = {
+            'json': None,
+            'journal': JournalStorage(os.path.join(self.tmp.name, 'journal.json')),
+            'sqlite': SQLiteStorage(os.path.join(self.tmp.name, 'allocations.db'))
+        }
+        for name, storage in backends.items():
+            data_processor = DataProcessor(data_dir=os.path.join(self.tmp.name, name), storage=storage)
+            # copies, so changes on one backend don't leak into the next
+            data_processor._save_allocations(
+                [Allocation.from_dict(a.to_dict()) for a in self.allocations])
+            yield name, data_processor
+    
+    def all_pages(self, data_processor, **query):
+        pages, cursor = [], None
+        while True:
+            page = data_processor.list_allocations(limit=5, cursor=cursor, **query)
+            pages.append([a.id for a in page['allocations']])
+            cursor = page['next_cursor']
+            if not cursor:
+                return pages
+    
+    def expected(self, key, reverse=False, keep=lambda a: True):
+        return [a.id for a in sorted((a for a in self.allocations if keep(a)),
+                                     key=key, reverse=reverse)]
+    
+    def test_pages_cover_everything_once_in_order(self):
+        """walking the cursors gives every match exactly once, in sort order"""
+        by_created = self.expected(lambda a: (a.date_created, a.id))
+        pending = self.expected(lambda a: (a.date_created, a.id),
+                                keep=lambda a: a.status == AllocationStatus.PENDING)
+        by_name_desc = self.expected(lambda a: (a.student_name.lower(), a.id), reverse=True)
+        physics = self.expected(lambda a: (a.date_created, a.id), reverse=True,
+                                keep=lambda a: "Physics" in a.subjects)
+        
+        for name, data_processor in self.data_processors():
+            with self.subTest(backend=name):
+                pages = self.all_pages(data_processor)
+                self.assertEqual([len(page) for page in pages], [5, 5, 5, 5, 3])
+                self.assertEqual(sum(pages, []), by_created)
+                self.assertEqual(sum(self.all_pages(data_processor, status=AllocationStatus.PENDING), []),
+                                 pending)
+                self.assertEqual(sum(self.all_pages(data_processor, sort='-student_name'), []),
+                                 by_name_desc)
+                self.assertEqual(sum(self.all_pages(data_processor, sort='-date_created',
+                                                    search="phys"), []), physics)
+                self.assertEqual(sum(self.all_pages(data_processor, search="student 07"), []),
+                                 [self.allocations[7].id])
+    
+    def test_cursor_survives_changes(self):
+        """allocations moving status between pages don't shift what's next"""
+        for name, data_processor in self.data_processors():
+            with self.subTest(backend=name):
+                first = data_processor.list_allocations(status=AllocationStatus.PENDING, limit=5)
+                # someone starts one from the first page
+                data_processor.mark_as_in_progress(first['allocations'][0].id, "Test Staff")
+                second = data_processor.list_allocations(status=AllocationStatus.PENDING, limit=5,
+                                                         cursor=first['next_cursor'])
+                
+                pending = self.expected(lambda a: (a.date_created, a.id),
+                                        keep=lambda a: a.status == AllocationStatus.PENDING)
+                self.assertEqual([a.id for a in second['allocations']], pending[5:10])
+    
+    def test_bad_sort_or_cursor(self):
+        """unknown sort fields are refused, junk cursors start from the top"""
+        data_processor = DataProcessor(data_dir=self.tmp.name)
+        data_processor._save_allocations(self.allocations)
+        with self.assertRaises(ValueError):
+            data_processor.list_allocations(sort='student_email')
+        page = data_processor.list_allocations(limit=3, cursor="not-a-cursor")
+        self.assertEqual([a.id for a in page['allocations']],
+                         self.expected(lambda a: (a.date_created, a.id))[:3])
+    
+    def test_sqlite_pages_use_the_index(self):
+        """a later page seeks through the index rather than scanning + sorting"""
+        storage = SQLiteStorage(os.path.join(self.tmp.name, 'allocations.db'))
+        plan = storage._connection().execute(
+            "EXPLAIN QUERY PLAN SELECT data FROM allocations WHERE status = ? AND "
+            "(COALESCE(json_extract(data, '$.date_created'), ''), id) > (?, ?) "
+            "ORDER BY COALESCE(json_extract(data, '$.date_created'), ''), id LIMIT 6",
+            ('pending', '2024', 'x')).fetchall()
+        details = ' '.join(row[-1] for row in plan)
+        self.assertIn('idx_allocations_status_date_created', details)
+        self.assertNotIn('TEMP B-TREE', details)
+
+class TestCompletedArchive(unittest.TestCase):
+    """test moving old completed allocations out to parquet"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+    
+    def tearDown(self):
+        self.tmp.cleanup()
+    
+    def make_allocations(self):
+        allocations = []
+        for i, completed in enumerate([datetime(2024, 1, 5), datetime(2024, 1, 20),
+                                       datetime(2024, 2, 3), None]):
+            allocation = make_test_allocation(student_email=f"{i}@example.com")
+            allocation.date_created = datetime(2023, 12, 1)
+            if completed:
+                allocation.status = AllocationStatus.COMPLETED
+                allocation.staff_member = "Test Staff"
+                allocation.date_started = datetime(2023, 12, 2)
+                allocation.date_completed = completed
+            allocations.append(allocation)
+        return allocations
+    
+    def test_archive_on_each_backend(self):
+        """archived allocations leave the store but are still found + counted"""
+        backends = {
+            'json': lambda data_dir: None,
+            'journal': lambda data_dir: JournalStorage(os.path.join(data_dir, 'allocations.json')),
+            'sqlite': lambda data_dir: SQLiteStorage(os.path.join(data_dir, 'allocations.db'))
+        }
+        for name, make_storage in backends.items():
+            with self.subTest(backend=name):
+                data_dir = os.path.join(self.tmp.name, name)
+                os.makedirs(data_dir)
+                data_processor = DataProcessor(data_dir=data_dir, storage=make_storage(data_dir))
+                allocations = self.make_allocations()
+                data_processor._save_allocations(allocations)
+                before = data_processor.get_statistics()
+                
+                self.assertEqual(data_processor.archive_completed(days=30), 3)
+                self.assertEqual(data_processor.archive_completed(days=30), 0)
+                
+                # a fresh process sees the same thing (journal has to replay the removals)
+                reopened = DataProcessor(data_dir=data_dir, storage=make_storage(data_dir))
+                if name != 'sqlite':
+                    reopened.storage.invalidate_cache()
+                self.assertEqual([a.id for a in reopened._load_allocations()], [allocations[3].id])
+                self.assertEqual(sorted(os.listdir(os.path.join(data_dir, 'archive'))),
+                                 ['month=2024-01', 'month=2024-02'])
+                
+                archived = reopened.get_allocation_by_id(allocations[1].id)
+                self.assertEqual(archived.to_dict(), allocations[1].to_dict())
+                self.assertIsNone(reopened.get_allocation_by_id("no-such-id"))
+                
+                # moving them doesn't change the numbers, and a recount reads the archive
+                self.assertEqual(reopened.get_statistics(), before)
+                self.assertEqual(reopened.rebuild_statistics().summary(), before)
+    
+    def test_archive_statistics_skip_rows_still_in_the_store(self):
+        """a crash between writing the archive + saving the store can't double count"""
+        data_processor = DataProcessor(data_dir=self.tmp.name)
+        allocations = self.make_allocations()
+        data_processor._save_allocations(allocations)
+        before = data_processor.get_statistics()
+        
+        # archived, but the store never got saved
+        data_processor.archive.add(allocations[:3])
+        self.assertEqual(data_processor.rebuild_statistics().summary(), before)
+        self.assertEqual(len(data_processor.archive.load_all()), 3)
+
+class TestAllocationModel(unittest.TestCase):
+    """test the slotted allocation + its fast loading"""
+    
+    def test_from_dict_skips_wasted_work(self):
+        """loading a saved allocation shouldn't make a uuid or read the clock"""
+        data = make_test_allocation().to_dict()
+        
+        with mock.patch('app.models.uuid.uuid4') as uuid4, \
+                mock.patch('app.models.datetime') as fake_datetime:
+            fake_datetime.fromisoformat.side_effect = datetime.fromisoformat
+            loaded = Allocation.from_dict(data)
+        
+        uuid4.assert_not_called()
+        fake_datetime.now.assert_not_called()
+        self.assertEqual(loaded.to_dict(), data)
+        self.assertFalse(hasattr(loaded, '__dict__'))
+    
+    def test_codec_round_trip(self):
+        """whichever json library we ended up with reads back what it wrote"""
+        data = make_test_allocation().to_dict()
+        self.assertEqual(codec.loads(codec.dumps([data])), [data])
+
+class TestSpreadsheetImport(unittest.TestCase):
+    """test pulling allocations in from the job form spreadsheet"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data_processor = DataProcessor(data_dir=self.tmp.name)
+    
+    def tearDown(self):
+        self.tmp.cleanup()
+    
+    def write_job_forms(self, count, name='job_forms.xlsx'):
+        """make a little job form spreadsheet with `count` students"""
+        rows = []
+        for i in range(count):
+            row = make_test_allocation(student_email=f"student{i}@example.com").to_dict()
+            row['subjects'] = "Math 8, English 7, Biology"
+            rows.append(row)
+        
+        path = os.path.join(self.tmp.name, name)
+        pd.DataFrame(rows).to_excel(path, index=False)
+        return path
+    
+    def test_sync_skips_students_we_already_have(self):
+        """running the sync twice shouldn't import anyone twice"""
+        path = self.write_job_forms(5)
+        self.assertEqual(self.data_processor.sync_from_spreadsheet(path), 5)
+        self.assertEqual(self.data_processor.sync_from_spreadsheet(path), 0)
+        
+        pending = self.data_processor.get_pending_allocations()
+        self.assertEqual(len(pending), 5)
+        self.assertEqual(pending[0].subjects, ["Math 8", "English 7", "Biology"])
+    
+    def test_unchanged_file_isnt_parsed_again(self):
+        """a second sync of the same file shouldn't even open it with pandas"""
+        path = self.write_job_forms(3)
+        self.data_processor.sync_from_spreadsheet(path)
+        
+        with mock.patch('app.data_processor.pd.read_excel') as read_excel:
+            self.assertEqual(self.data_processor.sync_from_spreadsheet(path), 0)
+        read_excel.assert_not_called()
+    
+    def test_only_appended_rows_are_imported(self):
+        """rows added after the watermark get picked up, nothing else is re-read"""
+        path = self.write_job_forms(3)
+        self.data_processor.sync_from_spreadsheet(path)
+        self.write_job_forms(5)  # same file, two more students on the end
+        
+        with mock.patch('app.data_processor.pd.read_excel', wraps=pd.read_excel) as read_excel:
+            self.assertEqual(self.data_processor.sync_from_spreadsheet(path), 2)
+        self.assertEqual(read_excel.call_count, 1)
+        self.assertEqual(list(read_excel.call_args.kwargs['skiprows']), [1, 2])
+        self.assertEqual(len(self.data_processor.get_pending_allocations()), 5)
+    
+    def test_rows_inserted_above_watermark_trigger_a_rescan(self):
+        """if the sheet got reshuffled we fall back to reading all of it"""
+        path = self.write_job_forms(3)
+        self.data_processor.sync_from_spreadsheet(path)
+        
+        df = pd.read_excel(path)
+        inserted = dict(df.iloc[0], student_email="inserted@example.com")
+        df = pd.concat([pd.DataFrame([inserted]), df], ignore_index=True)
+        df.to_excel(path, index=False)
+        
+        self.assertEqual(self.data_processor.sync_from_spreadsheet(path), 1)
+        self.assertEqual(len(self.data_processor.get_pending_allocations()), 4)
+    
+    def test_streamed_formats(self):
+        """csv, jsonl and parquet exports are read in chunks, skipping extra columns"""
+        df = pd.read_excel(self.write_job_forms(7))
+        df['unused_column'] = 'ignore me'
+        
+        writers = {
+            'csv': lambda path: df.to_csv(path, index=False),
+            'jsonl': lambda path: df.to_json(path, orient='records', lines=True),
+        }
+        if importlib.util.find_spec('pyarrow'):
+            writers['parquet'] = lambda path: df.to_parquet(path, index=False)
+        
+        for extension, write in writers.items():
+            path = os.path.join(self.tmp.name, f'job_forms.{extension}')
+            write(path)
+            
+            chunks = list(read_job_forms(path, skip_rows=2, chunk_size=3))
+            self.assertEqual(sum(len(chunk) for chunk in chunks), 5)
+            self.assertTrue(all(len(chunk) <= 3 for chunk in chunks))
+            self.assertNotIn('unused_column', chunks[0].columns)
+            self.assertEqual(chunks[0]['student_email'].iloc[0], "student2@example.com")
+            
+            processor = DataProcessor(data_dir=tempfile.mkdtemp(dir=self.tmp.name))
+            self.assertEqual(processor.sync_from_spreadsheet(path), 7)
+    
+    def test_column_subject_parsing_matches_single_rows(self):
+        """the vectorized subject split agrees with _parse_subjects"""
+        values = ['Math, English', 'Math; Physics, Chemistry', None, '', ' ; ', 'Biology', 'A;B;']
+        parsed = self.data_processor._parse_subjects_column(pd.Series(values))
+        expected = [self.data_processor._parse_subjects(v) if v else [] for v in values]
+        self.assertEqual(parsed, expected)
+    
+    def test_duplicate_rows_in_one_sheet(self):
+        """the first row for a student wins, like before"""
+        df = pd.DataFrame([
+            dict(make_test_allocation(student_name="First").to_dict(), subjects="Math"),
+            dict(make_test_allocation(student_name="Second").to_dict(), subjects="English"),
+        ])
+        with self.data_processor.transaction() as repo:
+            self.assertEqual(self.data_processor._import_rows(repo, df), 1)
+        
+        [allocation] = self.data_processor.get_pending_allocations()
+        self.assertEqual(allocation.student_name, "First")
+        self.assertEqual(allocation.subjects, ["Math"])
+
+def make_test_teachers(count):
+    """a list of simple teacher dicts shaped like the mock api's"""
+    return [
+        {
+            'id': f"t{i:03d}",
+            'name': f"Teacher {i}",
+            'email': f"teacher{i}@cga.edu",
+            'subjects': ["Math 8", "Biology"] if i % 2 else ["English 7"],
+            'active_students': 5 + (i * 7) % 35,
+            'subject_expertise': 3 + i % 3,
+            'average_rating': round(3.5 + (i % 4) * 0.5, 1),
+            'availability': {
+                'weekdays': ['Monday', 'Wednesday', 'Friday'] if i % 2 else ['Tuesday', 'Thursday'],
+                'time_slots': ["8:00-10:00", "13:00-15:00", "16:00-18:00"]
+            }
+        }
+        for i in range(count)
+    ]
+
+def make_test_catalogue(test, count=10):
+    """a catalogue of make_test_teachers(count) in a temp file, removed after the test"""
+    tmp = tempfile.TemporaryDirectory()
+    test.addCleanup(tmp.cleanup)
+    path = os.path.join(tmp.name, 'teachers.json')
+    with open(path, 'w') as f:
+        json.dump(make_test_teachers(count), f)
+    return TeacherCatalogue(path)
+
+class TestTeacherCatalogue(unittest.TestCase):
+    """test the indexed teacher catalogue"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'teachers.json')
+        with open(self.path, 'w') as f:
+            json.dump(make_test_teachers(6), f)
+    
+    def tearDown(self):
+        self.tmp.cleanup()
+    
+    def test_lookups(self):
+        """teachers can be found by id and by subject"""
+        catalogue = TeacherCatalogue(self.path)
+        self.assertEqual([t['id'] for t in catalogue.for_subject("Biology")], ["t001", "t003", "t005"])
+        self.assertEqual(catalogue.get("t002")['name'], "Teacher 2")
+        self.assertIsNone(catalogue.get("nope"))
+        self.assertEqual(catalogue.for_subject("Underwater Basket Weaving"), [])
+    
+    def test_availability_bitmaps(self):
+        """every teacher's weekly bitmap is built once at load time"""
+        catalogue = TeacherCatalogue(self.path)
+        bitmaps = catalogue.availability_bitmaps(["t001", "nope", "t002"])
+        
+        self.assertEqual(bitmaps.shape, (3, schedule.BITMAP_WORDS))
+        np.testing.assert_array_equal(
+            bitmaps[0], schedule.teacher_bitmap(catalogue.get("t001")['availability']))
+        self.assertFalse(bitmaps[1].any())
+        # 3 days x 3 two-hour slots = 72 quarter hours
+        self.assertEqual(int(schedule.popcount(bitmaps[0])), 72)
+    
+    def test_reloads_when_file_changes(self):
+        """the catalogue is only re-read when the file actually changes"""
+        catalogue = TeacherCatalogue(self.path)
+        self.assertEqual(len(catalogue), 6)
+        version = catalogue.version
+        
+        self.assertFalse(catalogue.refresh())
+        self.assertEqual(catalogue.version, version)
+        
+        with open(self.path, 'w') as f:
+            json.dump(make_test_teachers(2), f)
+        self.assertEqual(len(catalogue), 2)
+        self.assertEqual(catalogue.version, version + 1)
+
+class StubCrimsonServer:
+    """
+    tiny local http server pretending to be the crimson api
+    counts connections + requests, and can be told to misbehave:
+    responses[path] is a list of (status, headers, body) to hand out first
+    """
+    def __init__(self):
+        self.connections = 0
+        self.requests = []
+        self.responses = {}
+        self.delay = 0
+        stub = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+            
+            def setup(self):
+                stub.connections += 1
+                super().setup()
+            
+            def log_message(self, *args):
+                pass
+            
+            def reply(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                stub.requests.append((self.command, self.path, dict(self.headers), body))
+                time.sleep(stub.delay)
+                
+                path = self.path.split('?')[0]
+                scripted = stub.responses.get(path)
+                if scripted:
+                    status, headers, payload = scripted.pop(0)
+                else:
+                    status, headers, payload = stub.default_response(
+                        self.command, path, body, dict(self.headers))
+                
+                data = json.dumps(payload).encode() if status != 304 else b''
+
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            do_GET = reply
+            do_POST = reply
+        
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+    
+    def default_response(self, method, path, body, headers=None):
+        return 200, {}, {'path': path}
+    
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class TestCrimsonAPIClient(unittest.TestCase):
+    """test the real (http) crimson client against a local stub server"""
+    
+    def setUp(self):
+        self.stub = StubCrimsonServer()
+        self.api = CrimsonAPI(api_key='real_key', base_url=self.stub.url,
+                              timeout=(1, 0.5), max_retries=3, backoff_factor=0.01)
+    
+    def tearDown(self):
+        self.api.session.close()
+        self.stub.close()
+    
+    def test_connections_are_reused(self):
+        """lots of calls should share one keep-alive connection"""
+        for i in range(10):
+            self.assertEqual(self.api.get_teacher_info(f"t{i:03d}"), {'path': f"/teachers/t{i:03d}"})
+        
+        self.assertEqual(self.stub.connections, 1)
+        self.assertEqual(self.stub.requests[0][2]['Authorization'], "Bearer real_key")
+    
+    def test_retries_honor_retry_after(self):
+        """429/5xx get retried, waiting as long as Retry-After says"""
+        self.stub.responses['/teachers/t001/workload'] = [
+            (429, {'Retry-After': '0.2'}, {}),
+            (503, {}, {}),
+        ]
+        
+        started = time.monotonic()
+        self.assertEqual(self.api.get_teacher_workload("t001"), {'path': "/teachers/t001/workload"})
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(len(self.stub.requests), 3)
+    
+    def test_gives_up_after_max_retries(self):
+        """a server that keeps failing costs max_retries + 1 tries, then None"""
+        self.stub.responses['/teachers/t001'] = [(500, {}, {})] * 10
+        self.assertIsNone(self.api.get_teacher_info("t001"))
+        self.assertEqual(len(self.stub.requests), 4)
+    
+    def test_posts_not_retried_after_server_error(self):
+        """a 500 on an invitation might mean it went through - don't resend"""
+        self.stub.responses['/students/s1/subjects'] = [(500, {}, {}), (200, {}, {})]
+        self.assertIsNone(self.api.add_subject("s1", {'subject': "Math"}))
+        self.assertEqual(len(self.stub.requests), 1)
+    
+    def test_slow_server_times_out(self):
+        """a hung upstream can't hold a request for longer than the timeouts allow"""
+        self.stub.delay = 1
+        api = CrimsonAPI(api_key='real_key', base_url=self.stub.url,
+                         timeout=(1, 0.2), max_retries=1, backoff_factor=0.01)
+        
+        started = time.monotonic()
+        self.assertIsNone(api.get_teacher_info("t001"))
+        self.assertLess(time.monotonic() - started, 1.5)
+        api.session.close()
+
+class FakeClock:
+    """a clock the tests can move forward by hand"""
+    def __init__(self):
+        self.now = 0.0
+    
+    def __call__(self):
+        return self.now
+
+class ETagCrimsonServer(StubCrimsonServer):
+    """stub server that tags every GET and answers 304 when the tag matches"""
+    def __init__(self):
+        self.version = 1
+        super().__init__()
+    
+    def default_response(self, method, path, body, headers=None):
+        etag = f'"v{self.version}"'
+        if method == 'GET' and (headers or {}).get('If-None-Match') == etag:
+            return 304, {'ETag': etag}, None
+        return 200, {'ETag': etag}, {'path': path, 'version': self.version}
+
+class TestCrimsonAPICache(unittest.TestCase):
+    """test the response cache in front of the crimson read endpoints"""
+    
+    def setUp(self):
+        self.stub = ETagCrimsonServer()
+        self.clock = FakeClock()
+        self.cache = TTLCache(max_entries=3, clock=self.clock)
+        self.api = CrimsonAPI(api_key='real_key', base_url=self.stub.url,
+                              timeout=(1, 0.5), max_retries=0, cache=self.cache,
+                              cache_ttls={'teacher_workload': 30, 'teacher_info': 300})
+    
+    def tearDown(self):
+        self.api.session.close()
+        self.stub.close()
+    
+    def test_fresh_entries_skip_the_network(self):
+        """repeat reads inside the ttl never leave the process"""
+        for _ in range(5):
+            self.assertEqual(self.api.get_teacher_info("t001")['version'], 1)
+        
+        self.assertEqual(len(self.stub.requests), 1)
+        stats = self.api.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (4, 1))
+        self.assertAlmostEqual(stats['hit_rate'], 0.8)
+    
+    def test_stale_entries_revalidate_with_etag(self):
+        """once the ttl runs out we ask with If-None-Match and keep our copy on a 304"""
+        self.api.get_teacher_workload("t001")
+        self.clock.now += 31
+        
+        self.assertEqual(self.api.get_teacher_workload("t001")['version'], 1)
+        self.assertEqual(self.stub.requests[-1][2]['If-None-Match'], '"v1"')
+        self.assertEqual(self.api.cache_stats()['revalidated'], 1)
+        
+        # fresh again after the 304
+        self.api.get_teacher_workload("t001")
+        self.assertEqual(len(self.stub.requests), 2)
+        
+        # the data changed upstream - we get the new copy
+        self.stub.version = 2
+        self.clock.now += 31
+        self.assertEqual(self.api.get_teacher_workload("t001")['version'], 2)
+    
+    def test_each_endpoint_has_its_own_ttl(self):
+        """workload goes stale long before teacher info does"""
+        self.api.get_teacher_info("t001")
+        self.api.get_teacher_workload("t001")
+        self.clock.now += 60
+        
+        self.api.get_teacher_info("t001")
+        self.api.get_teacher_workload("t001")
+        self.assertEqual([request[1] for request in self.stub.requests[2:]],
+                         ["/teachers/t001/workload"])
+    
+    def test_least_recently_used_gets_evicted(self):
+        """the cache stays bounded, dropping whatever was used longest ago"""
+        for teacher_id in ["t001", "t002", "t003"]:
+            self.api.get_teacher_info(teacher_id)
+        self.api.get_teacher_info("t001")  # t002 is now the oldest
+        self.api.get_teacher_info("t004")
+        
+        self.assertEqual(self.api.cache_stats()['evictions'], 1)
+        self.api.get_teacher_info("t001")
+        self.api.get_teacher_info("t002")
+        self.assertEqual([request[1] for request in self.stub.requests],
+                         ["/teachers/t001", "/teachers/t002", "/teachers/t003",
+                          "/teachers/t004", "/teachers/t002"])
+    
+    def test_invitation_invalidates_teacher(self):
+        """after an invite the teacher's workload + the available lists get re-read"""
+        self.api.get_teacher_workload("t001")
+        self.api.get_teacher_workload("t002")
+        self.api.get_available_teachers("Math 8")
+        
+        # the real api wants the crimson student id, which allocations don't carry yet
+        allocation = SimpleNamespace(**make_test_allocation().to_dict(), student_id="s1")
+        self.assertTrue(self.api.send_teacher_invitation(allocation, "t001"))
+        
+        self.api.get_teacher_workload("t001")
+        self.api.get_teacher_workload("t002")
+        self.api.get_available_teachers("Math 8")
+        self.assertEqual([request[1] for request in self.stub.requests[4:]],
+                         ["/teachers/t001/workload", "/teachers/available?subject=Math+8"])
+
+    def test_invitation_from_async_client_reaches_the_matcher(self):
+        """the matcher + async client share one cache, so an invite clears it for both"""
+        matcher = TeacherMatcher(crimson_api=self.api)
+        async_api = AsyncCrimsonAPI(self.api)
+        matcher.get_teacher_workload("t001")
+        matcher.crimson_api.get_available_teachers("Math 8")
+
+        allocation = SimpleNamespace(**make_test_allocation().to_dict(), student_id="s1")
+        results = async_api.run(async_api.send_teacher_invitations(allocation, ["t001"]))
+        self.assertTrue(results["t001"])
+        async_api.close()
+
+        matcher.get_teacher_workload("t001")
+        matcher.crimson_api.get_available_teachers("Math 8")
+        self.assertEqual([request[1] for request in self.stub.requests[3:]],
+                         ["/teachers/t001/workload", "/teachers/available?subject=Math+8"])
+
+    def test_cache_can_be_turned_off(self):
+        """CRIMSON_APP_CACHE_SIZE=0 means every read hits the server"""
+        with mock.patch.dict(os.environ, {'CRIMSON_APP_CACHE_SIZE': '0'}):
+            api = CrimsonAPI(api_key='real_key', base_url=self.stub.url, max_retries=0)
+        
+        api.get_teacher_info("t001")
+        api.get_teacher_info("t001")
+        self.assertIsNone(api.cache_stats())
+        self.assertEqual(len(self.stub.requests), 2)
+        api.session.close()
+
+class BulkCrimsonServer(StubCrimsonServer):
+    """stub server with the bulk teacher endpoints"""
+    def default_response(self, method, path, body, headers=None):
+        if path.startswith('/teachers/bulk'):
+            ids = self.requests[-1][1].split('ids=')[1].split('%2C')
+            return 200, {}, {teacher_id: {'id': teacher_id} for teacher_id in ids
+                             if teacher_id != "missing"}
+        return super().default_response(method, path, body, headers)
+
+class TestBulkTeacherLookups(unittest.TestCase):
+    """test looking lots of teachers up at once"""
+    
+    def setUp(self):
+        self.stub = BulkCrimsonServer()
+        self.api = CrimsonAPI(api_key='real_key', base_url=self.stub.url,
+                              timeout=(1, 1), max_retries=0)
+    
+    def tearDown(self):
+        self.api.session.close()
+        self.stub.close()
+    
+    def test_uses_bulk_endpoint(self):
+        """one round trip for the lot, and missing teachers come back as None"""
+        workloads = self.api.get_teachers_workload(["t001", "t002", "missing", "t001"])
+        
+        self.assertEqual(workloads, {"t001": {'id': "t001"}, "t002": {'id': "t002"},
+                                     "missing": None})
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertTrue(self.stub.requests[0][1].startswith("/teachers/bulk/workload?ids="))
+    
+    def test_only_asks_for_what_isnt_cached(self):
+        """teachers we already know about aren't fetched again"""
+        self.api.get_teacher_info("t001")
+        self.api.get_teachers_info(["t001", "t002"])
+        self.api.get_teachers_info(["t001", "t002"])
+        
+        self.assertEqual([request[1] for request in self.stub.requests],
+                         ["/teachers/t001", "/teachers/bulk?ids=t002"])
+    
+    def test_falls_back_to_concurrent_calls(self):
+        """no bulk endpoint -> per-teacher calls, all at once, and we stop asking for bulk"""
+        self.stub.responses['/teachers/bulk'] = [(404, {}, {})]
+        self.stub.delay = 0.2
+        teacher_ids = [f"t{i:03d}" for i in range(8)]
+        
+        started = time.monotonic()
+        info = self.api.get_teachers_info(teacher_ids)
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertEqual(info, {teacher_id: {'path': f"/teachers/{teacher_id}"}
+                                for teacher_id in teacher_ids})
+        
+        self.api.cache.clear()
+        self.api.get_teachers_info(["t001"])
+        self.assertEqual(self.stub.requests[-1][1], "/teachers/t001")
+        self.assertEqual(sum(request[1].startswith("/teachers/bulk")
+                             for request in self.stub.requests), 1)
+    
+    def test_long_id_lists_are_chunked(self):
+        """at most bulk_chunk_size ids per call, so the url never gets too long"""
+        api = CrimsonAPI(api_key='real_key', base_url=self.stub.url, max_retries=0,
+                         bulk_chunk_size=2)
+        teacher_ids = [f"t{i:03d}" for i in range(5)]
+
+        info = api.get_teachers_info(teacher_ids)
+        self.assertEqual(info, {teacher_id: {'id': teacher_id} for teacher_id in teacher_ids})
+        self.assertEqual([request[1] for request in self.stub.requests],
+                         ["/teachers/bulk?ids=t000%2Ct001", "/teachers/bulk?ids=t002%2Ct003",
+                          "/teachers/bulk?ids=t004"])
+        api.session.close()
+
+    def test_rejected_bulk_call_isnt_tried_again(self):
+        """a 414 (or any 'can't do that') means per-teacher calls from then on"""
+        self.stub.responses['/teachers/bulk'] = [(414, {}, {})]
+        self.assertEqual(self.api.get_teachers_info(["t001", "t002"])["t002"],
+                         {'path': "/teachers/t002"})
+
+        self.api.cache.clear()
+        self.api.get_teachers_info(["t001", "t002"])
+        self.assertEqual(sum(request[1].startswith("/teachers/bulk")
+                             for request in self.stub.requests), 1)
+
+    def test_async_client_batches_too(self):
+        """the asyncio client does the same, with gather for the fallback"""
+        api = AsyncCrimsonAPI(api_key='real_key', base_url=self.stub.url, max_retries=0)
+        self.stub.responses['/teachers/bulk/workload'] = [(501, {}, {})]
+        
+        workloads = api.run(api.get_teachers_workload(["t001", "t002"]))
+        self.assertEqual(workloads["t002"], {'path': "/teachers/t002/workload"})
+        self.assertEqual(len(self.stub.requests), 3)
+        api.close()
+    
+    def test_mock_uses_teacher_index(self):
+        """the mock answers straight from the catalogue"""
+        api = CrimsonAPI(api_key='test_key')
+        api.teacher_catalogue = make_test_catalogue(self)
+        teacher_ids = ["t001", "t002", "t005"]
+        
+        info = api.get_teachers_info(teacher_ids + ["nobody"])
+        workloads = api.get_teachers_workload(teacher_ids)
+        self.assertEqual([info[teacher_id]['id'] for teacher_id in teacher_ids], teacher_ids)
+        self.assertIsNone(info["nobody"])
+        self.assertEqual(workloads[teacher_ids[0]], api.get_teacher_workload(teacher_ids[0]))
+
+class TestAsyncCrimsonAPI(unittest.TestCase):
+    """test the asyncio crimson client + batch invitations"""
+    
+    def setUp(self):
+        self.stub = StubCrimsonServer()
+        self.stub.delay = 0.2
+        self.api = AsyncCrimsonAPI(api_key='real_key', base_url=self.stub.url,
+                                   timeout=(1, 1), max_retries=1, backoff_factor=0.01,
+                                   max_concurrency=20)
+        self.allocation = SimpleNamespace(**make_test_allocation().to_dict(), student_id="s1")
+    
+    def tearDown(self):
+        self.api.close()
+        self.stub.close()
+    
+    def test_invitations_go_out_concurrently(self):
+        """20 invites should take about one round trip, not twenty"""
+        teacher_ids = [f"t{i:03d}" for i in range(20)]
+        
+        started = time.monotonic()
+        results = self.api.run(self.api.send_teacher_invitations(self.allocation, teacher_ids))
+        
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(list(results), teacher_ids)
+        self.assertTrue(all(results.values()))
+        sent = sorted(body['teacher_id'] for _, _, _, body in self.stub.requests)
+        self.assertEqual(sent, teacher_ids)
+    
+    def test_concurrency_is_bounded(self):
+        """never more than max_concurrency requests in flight"""
+        api = AsyncCrimsonAPI(api_key='real_key', base_url=self.stub.url,
+                              timeout=(1, 1), max_retries=0, max_concurrency=2)
+        self.stub.delay = 0.1
+        
+        started = time.monotonic()
+        api.run(api.send_teacher_invitations(self.allocation, ["t1", "t2", "t3", "t4"]))
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertLessEqual(self.stub.connections, 2)
+        api.close()
+    
+    def test_failed_invites_are_reported(self):
+        """one teacher failing doesn't sink the rest of the batch"""
+        self.stub.delay = 0
+        self.stub.responses['/invitations'] = [(400, {}, {'error': "nope"})]
+        
+        results = self.api.run(self.api.send_teacher_invitations(self.allocation, ["t1", "t2"]))
+        self.assertEqual(sorted(bool(result) for result in results.values()), [False, True])
+    
+    def test_lookups_share_the_cache(self):
+        """async reads go through the same response cache as the sync client"""
+        self.stub.delay = 0
+        for _ in range(3):
+            info = self.api.run(self.api.get_teacher_info("t001"))
+        
+        self.assertEqual(info, {'path': "/teachers/t001"})
+        self.assertEqual(len(self.stub.requests), 1)
+    
+    def test_every_call_is_a_coroutine(self):
+        """the student calls are async too, and follow the same retry rules as the sync client"""
+        self.stub.delay = 0
+        self.stub.responses['/students/s1/subjects'] = [(500, {}, {}), (200, {}, {})]
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            self.assertEqual(self.api.run(self.api.get_student_info("s1")),
+                             {'path': "/students/s1"})
+            # a POST that got a 500 might have gone through - not resent
+            self.assertIsNone(self.api.run(self.api.add_subject("s1", {'subject': "Math"})))
+        self.assertEqual(len(self.stub.requests), 2)
+
+        api_methods = [name for name in dir(CrimsonAPI)
+                       if not name.startswith('_') and name != 'cache_stats']
+        self.assertIn('get_student_info', api_methods)
+        for name in api_methods:
+            self.assertTrue(asyncio.iscoroutinefunction(getattr(AsyncCrimsonAPI, name)), name)
+
+    def test_mock_mode_needs_no_server(self):
+        """with the test key everything is answered from the mock data"""
+        api = AsyncCrimsonAPI(api_key='test_key')
+        results = api.run(api.send_teacher_invitations(self.allocation, ["t001", "t002", "t001"]))
+        self.assertEqual(results, {"t001": True, "t002": True})
+        api.close()
+    
+    def test_batch_recorded_in_one_write(self):
+        """add_invited_teachers saves the whole batch in a single transaction"""
+        with tempfile.TemporaryDirectory() as tmp:
+            data_processor = DataProcessor(data_dir=tmp)
+            allocation = make_test_allocation()
+            data_processor._save_allocations([allocation])
+            data_processor.add_invited_teacher(allocation.id, "t001")
+            
+            with mock.patch.object(data_processor.storage, 'transaction',
+                                   wraps=data_processor.storage.transaction) as transaction:
+                data_processor.add_invited_teachers(allocation.id, ["t001", "t002", "t003", "t002"])
+            
+            self.assertEqual(transaction.call_count, 1)
+            saved = data_processor.get_allocation_by_id(allocation.id)
+            self.assertEqual(saved.invited_teachers, ["t001", "t002", "t003"])
+
+class TestScheduleEngine(unittest.TestCase):
+    """test turning availability into UTC weekly intervals + comparing them"""
+    
+    def test_parses_job_form_availability(self):
+        """the formats from the job forms come out as UTC minutes into the week"""
+        # 3-7pm EST = 20:00-00:00 UTC
+        self.assertEqual(
+            schedule.parse_availability_text("Monday-Friday, 3:00 PM - 7:00 PM EST"),
+            tuple((day * 1440 + 1200, day * 1440 + 1440) for day in range(5)))
+        self.assertEqual(
+            schedule.parse_availability_text("Weekdays 2:00 PM - 6:00 PM EST"),
+            tuple((day * 1440 + 1140, day * 1440 + 1380) for day in range(5)))
+        self.assertEqual(
+            schedule.parse_availability_text("Tuesday, Thursday, Saturday 4:00 PM - 8:00 PM EST"),
+            ((2700, 2940), (5580, 5820), (8460, 8700)))
+    
+    def test_short_forms_and_overnight(self):
+        """4-8pm, days after the time, ranges past midnight + sunday wrap"""
+        self.assertEqual(schedule.parse_availability_text("Weekdays 4-8pm", default_tz='UTC'),
+                         schedule.parse_availability_text("16:00-20:00 weekdays", default_tz='UTC'))
+        
+        # sunday 10pm-2am UTC runs into monday morning
+        self.assertEqual(schedule.parse_availability_text("Sunday 10pm-2am UTC"),
+                         ((0, 120), (9960, 10080)))
+        # monday 3am NZDT is still sunday afternoon in UTC
+        self.assertEqual(schedule.parse_availability_text("Mon 3am-5am NZDT"),
+                         ((9480, 9600),))
+        self.assertEqual(schedule.parse_availability_text("whenever really"), ())
+    
+    def test_overlap_sweep(self):
+        """overlap is the shared minutes of two sorted interval sets"""
+        a = schedule.normalize([(0, 100), (200, 300), (400, 500)])
+        b = schedule.normalize([(50, 250), (450, 1000)])
+        self.assertEqual(schedule.overlap_minutes(a, b), 50 + 50 + 50)
+        self.assertEqual(schedule.normalize([(10, 20), (15, 30), (-10, 5)]),
+                         ((0, 5), (10, 30), (10070, 10080)))
+    
+    def test_compatibility_is_timezone_aware(self):
+        """the same wall clock times only line up when the zones agree"""
+        teacher = {'weekdays': ['Monday', 'Wednesday'], 'time_slots': ["16:00-18:00"],
+                   'timezone': 'EST'}
+        
+        # monday + wednesday 4-6pm out of five 4-8pm slots
+        self.assertAlmostEqual(
+            schedule.schedule_compatibility(teacher, "Weekdays 4-8pm EST"), 0.2)
+        self.assertEqual(
+            schedule.schedule_compatibility(teacher, "Weekdays 4-8pm PST"), 0)
+        self.assertEqual(schedule.schedule_compatibility(teacher, "ask the parents"), 0.5)
+    
+    def test_bitmaps_match_intervals(self):
+        """the vectorized bitmap overlap agrees with the interval sweep"""
+        teachers = make_test_teachers(12)
+        for i, teacher in enumerate(teachers):
+            teacher['availability']['timezone'] = ['UTC', 'EST', 'NZDT', 'IST'][i % 4]
+        bitmaps = np.stack([schedule.teacher_bitmap(t['availability']) for t in teachers])
+        
+        for text in ["Monday-Friday, 3:00 PM - 7:00 PM EST", "Weekdays 2:00 PM - 6:00 PM EST",
+                     "Tue, Thu 8am-1:30pm", "Sunday 10pm-2am UTC", "no idea"]:
+            expected = [schedule.schedule_compatibility(t['availability'], text) for t in teachers]
+            np.testing.assert_allclose(
+                schedule.bitmap_compatibility(bitmaps, schedule.student_bitmap(text)), expected)
+    
+    def test_popcount_without_numpy_2(self):
+        """the unpackbits fallback counts the same bits as np.bitwise_count"""
+        words = np.array([[0, 1, 2 ** 63 + 5], [2 ** 64 - 1, 0, 0]], dtype=np.uint64)
+        self.assertEqual(schedule.popcount(words).tolist(), [4, 64])
+        if hasattr(np, 'bitwise_count'):
+            with mock.patch.object(np, 'bitwise_count'):
+                del np.bitwise_count  # put back when the patch ends
+                self.assertEqual(schedule.popcount(words).tolist(), [4, 64])
+    
+    def test_matching_is_deterministic(self):
+        """no more random schedule scores - the same input ranks the same way"""
+        matcher = TeacherMatcher()
+        matcher.crimson_api.teacher_catalogue = make_test_catalogue(self)
+        allocation = make_test_allocation(subjects=["Math 8"],
+                                          student_availability="Weekdays 4-8pm")
+        
+        first = matcher.find_matching_teachers(allocation)
+        self.assertEqual(len(first), 5)
+        second = matcher.find_matching_teachers(allocation)
+        self.assertEqual([(t['id'], t['score']) for t in first],
+                         [(t['id'], t['score']) for t in second])
+
+class TestVectorizedScoring(unittest.TestCase):
+    """test the numpy scoring path against the one-at-a-time reference"""
+    
+    def setUp(self):
+        self.matcher = TeacherMatcher()
+        self.allocation = make_test_allocation(
+            student_availability="Monday-Friday, 3:00 PM - 7:00 PM EST")
+        rng = np.random.default_rng(7)
+        self.teachers = make_test_teachers(500)
+        for teacher in self.teachers:
+            teacher['active_students'] = int(rng.integers(0, 45))
+            teacher['subject_expertise'] = int(rng.integers(1, 6))
+            teacher['average_rating'] = round(float(rng.uniform(1, 5)), 1)
+            teacher['availability']['timezone'] = str(rng.choice(['UTC', 'EST', 'PST']))
+    
+    def reference(self, teachers):
+        scored = self.matcher._score_teachers(teachers, self.allocation)
+        scored.sort(key=lambda t: t['score'], reverse=True)
+        return scored
+    
+    def test_scores_identical_to_scalar_path(self):
+        """same teachers, same scores, same order"""
+        expected = self.reference(self.teachers)
+        actual = self.matcher._score_teachers_vectorized(self.teachers, self.allocation)
+        
+        self.assertEqual([(t['id'], t['score']) for t in actual],
+                         [(t['id'], t['score']) for t in expected])
+        self.assertEqual(actual[0], expected[0])
+    
+    def test_top_k(self):
+        """top-k is exactly the head of the full ranking, ties included"""
+        expected = self.reference(self.teachers)
+        for k in [1, 7, 50, 499, 500, 1000]:
+            actual = self.matcher._score_teachers_vectorized(self.teachers, self.allocation, k=k)
+            self.assertEqual([t['id'] for t in actual], [t['id'] for t in expected[:k]])
+        
+        # everyone tied - the first k in the order they came in
+        tied = make_test_teachers(10)
+        for teacher in tied:
+            teacher.update(active_students=15, subject_expertise=3, average_rating=4.0)
+        actual = self.matcher._score_teachers_vectorized(tied, self.allocation, k=3)
+        self.assertEqual([t['id'] for t in actual], ["t000", "t001", "t002"])
+    
+    def test_originals_untouched(self):
+        """scores go on copies, and only the top-k get copied"""
+        actual = self.matcher._score_teachers_vectorized(self.teachers, self.allocation, k=5)
+        self.assertTrue(all('score' not in teacher for teacher in self.teachers))
+        self.assertEqual(len(actual), 5)
+        self.assertEqual(self.matcher._score_teachers_vectorized([], self.allocation), [])
+
+class TestTopKMatching(unittest.TestCase):
+    """test the top-k matcher with early termination"""
+    
+    def setUp(self):
+        self.matcher = TeacherMatcher()
+        self.allocation = make_test_allocation(student_availability="Weekdays 4-8pm")
+        rng = np.random.default_rng(11)
+        self.teachers = make_test_teachers(300)
+        for teacher in self.teachers:
+            teacher['active_students'] = int(rng.integers(0, 45))
+            teacher['subject_expertise'] = int(rng.integers(1, 6))
+            teacher['average_rating'] = round(float(rng.uniform(3, 5)), 1)
+    
+    def test_same_as_full_ranking(self):
+        """top-k gives exactly the head of the full ranking"""
+        expected = self.matcher._score_teachers_vectorized(self.teachers, self.allocation)
+        for k in [1, 5, 10, 299, 300, 400]:
+            actual = self.matcher._top_k_teachers(self.teachers, self.allocation, k)
+            self.assertEqual([(t['id'], t['score']) for t in actual],
+                             [(t['id'], t['score']) for t in expected[:k]])
+        self.assertEqual(self.matcher._top_k_teachers(self.teachers, self.allocation, 0), [])
+    
+    def test_prunes_hopeless_teachers(self):
+        """teachers whose best possible score can't make the cut never get a schedule check"""
+        with mock.patch('app.teacher_matcher_algorithm.bitmap_compatibility',
+                        wraps=schedule.bitmap_compatibility) as compatibility:
+            self.matcher._top_k_teachers(self.teachers, self.allocation, 5)
+        self.assertLess(compatibility.call_count, len(self.teachers) / 2)
+    
+    def test_ties_keep_input_order(self):
+        """equal scores keep the order the api gave us"""
+        tied = make_test_teachers(8)
+        for teacher in tied:
+            teacher.update(active_students=15, subject_expertise=3, average_rating=4.0,
+                           availability={})
+        actual = self.matcher._top_k_teachers(list(reversed(tied)), self.allocation, 3)
+        self.assertEqual([t['id'] for t in actual], ["t007", "t006", "t005"])
+    
+    def test_only_ids_and_scores_saved(self):
+        """the store keeps ids + scores, not whole teacher records"""
+        with tempfile.TemporaryDirectory() as tmp:
+            data_processor = DataProcessor(data_dir=tmp)
+            allocation = make_test_allocation(subjects=["Math 8"])
+            data_processor._save_allocations([allocation])
+            
+            matches = self.matcher.find_matching_teachers(allocation, k=3)
+            data_processor.update_matching_teachers(allocation.id, matches)
+            
+            saved = data_processor.get_allocation_by_id(allocation.id).matching_teachers
+            self.assertEqual(saved, [{'id': t['id'], 'score': t['score']} for t in matches])
+            self.assertLessEqual(len(saved), 3)
+
+class TestScoreCache(unittest.TestCase):
+    """test the matcher's memoized scores"""
+    
+    def setUp(self):
+        self.matcher = TeacherMatcher()
+        self.catalogue = make_test_catalogue(self, 20)
+        self.matcher.crimson_api.teacher_catalogue = self.catalogue
+        self.allocation = make_test_allocation(subjects=["Biology"],
+                                               student_availability="Weekdays 4-8pm")
+        self.teachers = self.catalogue.all()
+    
+    def scored_count(self, teachers, allocation):
+        """how many teachers actually got scored (not served from the cache)"""
+        with mock.patch.object(self.matcher, '_compute_scores',
+                               wraps=self.matcher._compute_scores) as compute:
+            result = self.matcher._score_teachers_vectorized(teachers, allocation)
+        return sum(len(call.args[0]) for call in compute.call_args_list), result
+    
+    def test_rematching_uses_cache(self):
+        """the second run for the same allocation scores nobody, with the same result"""
+        count, first = self.scored_count(self.teachers, self.allocation)
+        self.assertEqual(count, 20)
+        
+        count, second = self.scored_count(self.teachers, self.allocation)
+        self.assertEqual(count, 0)
+        self.assertEqual(first, second)
+        self.assertEqual(self.matcher.score_cache.stats()['hits'], 20)
+        
+        # a split child with the same subject + availability shares the scores
+        child = make_test_allocation(subjects=["Math 8", "Biology"],
+                                     student_availability="Weekdays 4-8pm")
+        child.current_subject = "Biology"
+        self.assertEqual(self.scored_count(self.teachers, child)[0], 0)
+    
+    def test_changes_are_rescored(self):
+        """a different allocation or a changed teacher misses the cache"""
+        self.scored_count(self.teachers, self.allocation)
+        
+        other = make_test_allocation(subjects=["Biology"], student_availability="Weekends 9am-1pm")
+        self.assertEqual(self.scored_count(self.teachers, other)[0], 20)
+        
+        busier = [dict(teacher) for teacher in self.teachers]
+        busier[3]['active_students'] = 44
+        count, result = self.scored_count(busier, self.allocation)
+        self.assertEqual(count, 1)
+        self.assertEqual(result, self.matcher._score_teachers_vectorized(
+            busier, self.allocation))
+        
+        # api teachers with a version only get rescored when it changes
+        versioned = [dict(teacher, version=1) for teacher in self.teachers[:3]]
+        self.scored_count(versioned, self.allocation)
+        versioned[0]['average_rating'] = 1.0  # same version - trust the cache
+        self.assertEqual(self.scored_count(versioned, self.allocation)[0], 0)
+        versioned[0]['version'] = 2
+        self.assertEqual(self.scored_count(versioned, self.allocation)[0], 1)
+        
+        # ...but the live workload is patched over the record without a new
+        # version, so the student count has to be part of the key
+        versioned[1]['active_students'] = 35
+        count, result = self.scored_count(versioned, self.allocation)
+        self.assertEqual(count, 1)
+        score_of = lambda scored: {teacher['id']: teacher['score'] for teacher in scored}
+        self.assertEqual(score_of(result)[versioned[1]['id']],
+                         score_of(self.matcher._score_teachers(versioned, self.allocation))[versioned[1]['id']])
+    
+    def test_catalogue_reload_clears_cache(self):
+        """when the teachers file changes every cached score is dropped"""
+        self.scored_count(self.teachers, self.allocation)
+        self.assertEqual(self.matcher.score_cache.stats()['entries'], 20)
+        
+        with open(self.catalogue.path, 'w') as f:
+            json.dump(make_test_teachers(5), f)
+        os.utime(self.catalogue.path, ns=(0, time.time_ns() + 10 ** 9))
+        
+        teachers = self.catalogue.all()
+        self.assertEqual(self.scored_count(teachers, self.allocation)[0], 5)
+        self.assertEqual(self.matcher.score_cache.stats()['entries'], 5)
+    
+    def test_top_k_uses_cache(self):
+        """the streaming top-k path reads + fills the same cache"""
+        expected = self.matcher._top_k_teachers(self.teachers, self.allocation, 3)
+        with mock.patch('app.teacher_matcher_algorithm.bitmap_compatibility') as compatibility:
+            again = self.matcher._top_k_teachers(self.teachers, self.allocation, 3)
+        self.assertFalse(compatibility.called)
+        self.assertEqual(again, expected)
+
+class TestBatchMatching(unittest.TestCase):
+    """test planning teachers for lots of allocations at once"""
+    
+    def make_problem(self, allocation_count, teacher_count, seed=3):
+        rng = np.random.default_rng(seed)
+        teachers = make_test_teachers(teacher_count)
+        for teacher in teachers:
+            teacher['active_students'] = int(rng.integers(0, 40))
+            teacher['average_rating'] = round(float(rng.uniform(3, 5)), 1)
+        subjects = ["Math 8", "English 7", "Biology"]
+        allocations = [
+            make_test_allocation(subjects=[subjects[i % 3]],
+                                 student_availability=["Weekdays 4-8pm", "Mon, Wed 8am-10am",
+                                                       "Tuesday 1pm-3pm"][i % 3])
+            for i in range(allocation_count)
+        ]
+        return allocations, teachers
+    
+    def test_respects_capacity(self):
+        """nobody gets more new students than they have room for"""
+        allocations, teachers = self.make_problem(30, 6)
+        capacities = {teacher['id']: 2 for teacher in teachers}
+        
+        plan = batch_matcher.plan_assignments(allocations, teachers, capacities)
+        counts = {}
+        for match in plan.values():
+            counts[match['id']] = counts.get(match['id'], 0) + 1
+        self.assertTrue(all(count <= 2 for count in counts.values()))
+        self.assertEqual(len(plan), 12)  # 6 teachers x 2 places
+        
+        # and only to teachers who teach the subject
+        teachers_by_id = {teacher['id']: teacher for teacher in teachers}
+        for allocation in allocations:
+            if allocation.id in plan:
+                self.assertIn(allocation.subjects[0],
+                              teachers_by_id[plan[allocation.id]['id']]['subjects'])
+    
+    def test_optimal_on_small_problem(self):
+        """the plan's total score is the best possible (checked by brute force)"""
+        import itertools
+        allocations, teachers = self.make_problem(4, 4, seed=5)
+        for allocation in allocations:
+            allocation.subjects = ["Biology"]
+        capacities = {teacher['id']: 1 for teacher in teachers}
+        
+        plan = batch_matcher.plan_assignments(allocations, teachers, capacities)
+        matcher = TeacherMatcher()
+        best = 0
+        biology = [teacher for teacher in teachers if "Biology" in teacher['subjects']]
+        for chosen in itertools.permutations(biology, min(len(biology), len(allocations))):
+            total = sum(matcher._score_teachers([teacher], allocation)[0]['score']
+                        for teacher, allocation in zip(chosen, allocations))
+            best = max(best, total)
+        self.assertAlmostEqual(sum(match['score'] for match in plan.values()), best, places=6)
+    
+    def test_busier_teachers_score_lower(self):
+        """each extra student counts against the teacher, like in the matcher"""
+        allocations, teachers = self.make_problem(3, 2)
+        teacher = dict(teachers[1], active_students=19)
+        for allocation in allocations:
+            allocation.subjects = ["Biology"]
+        
+        plan = batch_matcher.plan_assignments(allocations, [teacher], {teacher['id']: 3})
+        scores = sorted(match['score'] for match in plan.values())
+        # 19 -> 20 students is fine, 21 is "kinda busy"
+        self.assertEqual(len(plan), 3)
+        self.assertLess(scores[0], scores[-1])
+    
+    def test_copy_cap_doesnt_cost_assignments(self):
+        """teachers with little or no room don't shrink a roomy teacher's share"""
+        allocations, teachers = self.make_problem(10, 3)
+        for allocation in allocations:
+            allocation.subjects = ["Math"]
+        for teacher in teachers:
+            teacher['subjects'] = ["Math"]
+
+        for room in ([10, 0, 0], [10, 1, 1]):
+            with self.subTest(room=room):
+                capacities = {teacher['id']: n for teacher, n in zip(teachers, room)}
+                plan = batch_matcher.plan_assignments(allocations, teachers, capacities)
+                self.assertEqual(len(plan), 10)
+
+    def test_greedy_without_scipy(self):
+        """still gives a valid plan when scipy isn't installed"""
+        allocations, teachers = self.make_problem(20, 5)
+        capacities = {teacher['id']: 3 for teacher in teachers}
+        optimal = batch_matcher.plan_assignments(allocations, teachers, capacities)
+        with mock.patch.dict(sys.modules, {'scipy': None, 'scipy.optimize': None}):
+            plan = batch_matcher.plan_assignments(allocations, teachers, capacities)
+        
+        counts = {}
+        for match in plan.values():
+            counts[match['id']] = counts.get(match['id'], 0) + 1
+        self.assertTrue(all(count <= 3 for count in counts.values()))
+        self.assertTrue(plan)
+        self.assertLessEqual(sum(match['score'] for match in plan.values()),
+                             sum(match['score'] for match in optimal.values()))
+    
+    def test_thousand_by_thousand(self):
+        """a 1k x 1k backlog plans in seconds"""
+        allocations, teachers = self.make_problem(1000, 1000)
+        capacities = {teacher['id']: 3 for teacher in teachers}
+        
+        started = time.monotonic()
+        plan = batch_matcher.plan_assignments(allocations, teachers, capacities)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual(len(plan), 1000)
+    
+    def test_matcher_uses_workload_capacity(self):
+        """plan_allocations takes capacity from get_teacher_workload"""
+        matcher = TeacherMatcher()
+        matcher.crimson_api.teacher_catalogue = make_test_catalogue(self)
+        
+        allocations = [make_test_allocation(subjects=["Biology"]) for _ in range(200)]
+        plan = matcher.plan_allocations(allocations)
+        room = sum(batch_matcher.teacher_capacity(matcher.get_teacher_workload(f"t{i:03d}"))
+                   for i in range(1, 10, 2))
+        
+        self.assertGreater(room, 0)
+        self.assertEqual(len(plan), min(200, room))
+
+class TestJobQueue(unittest.TestCase):
+    """test the sqlite-backed background job queue"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'jobs.db')
+        self.clock = FakeClock()
+        self.queue = JobQueue(self.path, workers=0, max_attempts=3, retry_delay=10,
+                              lease_seconds=60, clock=self.clock)
+    
+    def tearDown(self):
+        self.queue.stop()
+        self.tmp.cleanup()
+    
+    def test_jobs_run_and_report_back(self):
+        """a job runs once + its result can be polled (from another queue object too)"""
+        self.queue.register('add', lambda payload: payload['a'] + payload['b'])
+        job_id = self.queue.enqueue('add', {'a': 2, 'b': 3})
+        self.assertEqual(self.queue.get(job_id)['status'], 'queued')
+        
+        self.queue.run_until_empty()
+        
+        job = JobQueue(self.path, workers=0).get(job_id)
+        self.assertEqual((job['status'], job['result'], job['attempts']), ('done', 5, 1))
+        self.assertIsNone(self.queue.get("no-such-job"))
+    
+    def test_failures_back_off_then_dead_letter(self):
+        """each retry waits twice as long, and after max_attempts it's dead"""
+        calls = []
+        def flaky(payload):
+            calls.append(self.clock.now)
+            raise ConnectionError("upstream down")
+        self.queue.register('flaky', flaky)
+        job_id = self.queue.enqueue('flaky')
+        
+        with mock.patch('builtins.print'):
+            self.queue.run_until_empty()
+            job = self.queue.get(job_id)
+            self.assertEqual((job['status'], job['attempts']), ('queued', 1))
+            self.assertIn('upstream down', job['error'])
+            
+            # not due yet
+            self.clock.now = 9
+            self.assertFalse(self.queue.work_once())
+            self.clock.now = 10
+            self.queue.run_until_empty()
+            self.clock.now = 30  # 10 + 20
+            self.queue.run_until_empty()
+        
+        self.assertEqual(calls, [0, 10, 30])
+        self.assertEqual(self.queue.get(job_id)['status'], 'dead')
+        self.assertEqual([job['id'] for job in self.queue.dead_letters()], [job_id])
+        
+        # a dead job can be given another go
+        self.queue.register('flaky', lambda payload: 'ok now')
+        self.assertTrue(self.queue.retry(job_id))
+        self.queue.run_until_empty()
+        self.assertEqual(self.queue.get(job_id)['result'], 'ok now')
+        self.assertEqual(self.queue.dead_letters(), [])
+    
+    def test_jobs_from_a_dead_worker_are_picked_up_again(self):
+        """a claimed job whose lease runs out goes back in the queue"""
+        self.queue.register('work', lambda payload: 'finished')
+        job_id = self.queue.enqueue('work')
+        self.assertEqual(self.queue._claim()['id'], job_id)  # ...and the worker dies
+        
+        self.assertFalse(self.queue.work_once())
+        self.clock.now = 61
+        self.assertTrue(self.queue.work_once())
+        job = self.queue.get(job_id)
+        self.assertEqual((job['status'], job['attempts']), ('done', 2))
+
+    def test_job_that_keeps_killing_its_worker_is_dead_lettered(self):
+        """a job whose lease runs out max_attempts times goes dead instead of being claimed again"""
+        job_id = self.queue.enqueue('work')
+        with mock.patch('builtins.print'):
+            for attempt in range(3):
+                self.clock.now = attempt * 61
+                self.assertEqual(self.queue._claim()['id'], job_id)  # ...and the worker dies
+            self.clock.now = 3 * 61
+            self.assertIsNone(self.queue._claim())
+
+        job = self.queue.get(job_id)
+        self.assertEqual((job['status'], job['attempts']), ('dead', 3))
+        self.assertIn('lease expired', job['error'])
+
+    def test_stale_worker_cant_overwrite_a_reclaimed_job(self):
+        """once another worker has reclaimed a job, the first one's outcome is dropped"""
+        job_id = self.queue.enqueue('work')
+        slow = self.queue._claim()
+        self.clock.now = 61
+        fast = self.queue._claim()
+        self.assertEqual(fast['id'], job_id)
+
+        self.queue._finish(fast, 'done', result='"second run"')
+        with mock.patch('builtins.print'):
+            self.queue._failed(slow, RuntimeError("too slow"))
+
+        job = self.queue.get(job_id)
+        self.assertEqual((job['status'], job['result'], job['error']), ('done', 'second run', None))
+
+    def test_unserializable_result_is_a_failure(self):
+        """a handler returning something that isn't json fails the job rather than the worker"""
+        self.queue.register('bad', lambda payload: object())
+        job_id = self.queue.enqueue('bad')
+        with mock.patch('builtins.print'):
+            self.assertTrue(self.queue.work_once())
+
+        job = self.queue.get(job_id)
+        self.assertEqual((job['status'], job['attempts']), ('queued', 1))
+        self.assertIn('TypeError', job['error'])
+
+    def test_worker_threads(self):
+        """started workers pick jobs up without anyone calling work_once"""
+        queue = JobQueue(self.path, workers=2, poll_interval=0.05)
+        done = threading.Event()
+        queue.register('ping', lambda payload: done.set() or 'pong')
+        queue.start()
+        try:
+            job_id = queue.enqueue('ping')
+            self.assertTrue(done.wait(5))
+            for _ in range(100):
+                if queue.get(job_id)['status'] == 'done':
+                    break
+                time.sleep(0.02)
+            self.assertEqual(queue.get(job_id)['result'], 'pong')
+        finally:
+            queue.stop()
+
+class TestAllocationJobs(unittest.TestCase):
+    """test the handlers behind the background matching/invite/confirm jobs"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data_processor = DataProcessor(data_dir=self.tmp.name)
+        self.allocation = make_test_allocation(subjects=["Math"])
+        self.data_processor._save_allocations([self.allocation])
+        self.data_processor.mark_as_in_progress(self.allocation.id, "Test Staff")
+        
+        self.queue = JobQueue(os.path.join(self.tmp.name, 'jobs.db'), workers=0,
+                              max_attempts=3, retry_delay=0)
+        self.crimson_api = mock.Mock()
+        self.async_crimson_api = mock.Mock()
+        self.email_service = mock.Mock()
+        self.teacher_matcher = mock.Mock()
+        AllocationJobs(self.queue, self.data_processor, self.teacher_matcher,
+                       self.crimson_api, self.async_crimson_api, self.email_service)
+    
+    def tearDown(self):
+        self.tmp.cleanup()
+    
+    def test_match_job_saves_matches(self):
+        self.teacher_matcher.find_matching_teachers.return_value = [{'id': 't001', 'score': 90}]
+        job_id = self.queue.enqueue('match', {'allocation_id': self.allocation.id})
+        self.queue.run_until_empty()
+        
+        self.assertEqual(self.queue.get(job_id)['result'], {'matched': 1})
+        self.assertEqual(self.data_processor.get_allocation_by_id(self.allocation.id).matching_teachers,
+                         [{'id': 't001', 'score': 90}])
+    
+    def test_invite_job_only_retries_failed_invitations(self):
+        """teachers invited on the first try aren't invited again"""
+        sent = []
+        async def send_teacher_invitations(allocation, teacher_ids):
+            sent.append(list(teacher_ids))
+            # t002 fails the first time round
+            return {teacher_id: teacher_id != 't002' or len(sent) > 1 for teacher_id in teacher_ids}
+        self.async_crimson_api.send_teacher_invitations = send_teacher_invitations
+        self.async_crimson_api.run = lambda coroutine: asyncio.run(coroutine)
+        
+        job_id = self.queue.enqueue('invite', {'allocation_id': self.allocation.id,
+                                               'teacher_ids': ['t001', 't002']})
+        with mock.patch('builtins.print'):
+            self.queue.run_until_empty()
+        
+        self.assertEqual(sent, [['t001', 't002'], ['t002']])
+        job = self.queue.get(job_id)
+        self.assertEqual((job['status'], job['attempts']), ('done', 2))
+        self.assertEqual(self.data_processor.get_allocation_by_id(self.allocation.id).invited_teachers,
+                         ['t001', 't002'])
+    
+    def test_confirm_job_saves_once_then_queues_the_email(self):
+        """confirm + complete are one write, the email is its own retryable job"""
+        teacher = {'id': 't001', 'name': 'Test Teacher', 'email': 't001@cga.edu'}
+        self.crimson_api.get_teacher_info.return_value = teacher
+        self.email_service.send_confirmation_email.side_effect = [False, True]
+        
+        with mock.patch.object(self.data_processor.storage, '_write',
+                               wraps=self.data_processor.storage._write) as write:
+            job_id = self.queue.enqueue('confirm', {'allocation_id': self.allocation.id,
+                                                    'teacher_id': 't001'})
+            self.queue.work_once()
+            self.assertEqual(write.call_count, 1)
+        
+        allocation = self.data_processor.get_allocation_by_id(self.allocation.id)
+        self.assertEqual(allocation.status, AllocationStatus.COMPLETED)
+        self.assertEqual(allocation.confirmed_teacher, teacher)
+        
+        email_job_id = self.queue.get(job_id)['result']['email_job_id']
+        with mock.patch('builtins.print'):
+            self.queue.run_until_empty()
+        email_job = self.queue.get(email_job_id)
+        self.assertEqual((email_job['status'], email_job['attempts']), ('done', 2))
+        self.assertEqual(self.email_service.send_confirmation_email.call_count, 2)
+        # the confirm part didn't run again
+        self.crimson_api.get_teacher_info.assert_called_once_with('t001')
+
+    def test_confirm_job_for_unknown_teacher_isnt_retried(self):
+        """no such teacher is permanent - the job ends straight away"""
+        self.crimson_api.get_teacher_info.return_value = None
+        job_id = self.queue.enqueue('confirm', {'allocation_id': self.allocation.id,
+                                                'teacher_id': 'nobody'})
+        with mock.patch('builtins.print'):
+            self.queue.run_until_empty()
+
+        job = self.queue.get(job_id)
+        self.assertEqual((job['status'], job['attempts'], job['result']),
+                         ('done', 1, {'confirmed': False}))
+        self.assertEqual(self.data_processor.get_allocation_by_id(self.allocation.id).status,
+                         AllocationStatus.IN_PROGRESS)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file